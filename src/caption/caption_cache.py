@@ -0,0 +1,116 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from google.cloud import storage
+
+
+def file_hash(path):
+    """SHA-256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CaptionCache:
+    """
+    Persistent caption cache keyed by image content hash, prompt hash and
+    model name, so unchanged images are never sent to Gemini twice.
+
+    Each entry keeps the caption and the token counts of the original call,
+    which is what a hit saves. The SQLite file can be exported to and
+    imported from a GCS bucket to share it between pipeline runs.
+    """
+
+    def __init__(self, db_path, model_name, prompt):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.prompt_hash = text_hash(prompt)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS captions (
+                image_hash TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                prompt_token_count INTEGER,
+                candidates_token_count INTEGER,
+                total_token_count INTEGER,
+                PRIMARY KEY (image_hash, prompt_hash, model_name)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def get(self, image_hash):
+        """Returns the cached (caption, prompt, candidates, total tokens) or None."""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT caption, prompt_token_count, candidates_token_count, total_token_count '
+                'FROM captions WHERE image_hash = ? AND prompt_hash = ? AND model_name = ?',
+                (image_hash, self.prompt_hash, self.model_name)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += row[3] or 0
+            return tuple(row)
+
+    def put(self, image_hash, caption, prompt_token, candidate_token, total_token):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (image_hash, self.prompt_hash, self.model_name, caption,
+                 prompt_token, candidate_token, total_token))
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tokens_saved': self.tokens_saved}
+
+    def export_to_bucket(self, bucket_name, blob_name):
+        """Uploads the cache database to gs://bucket_name/blob_name."""
+        with self.lock:
+            self.conn.commit()
+            bucket = storage.Client().bucket(bucket_name)
+            bucket.blob(blob_name).upload_from_filename(self.db_path)
+        print(f"Caption cache exported to gs://{bucket_name}/{blob_name}")
+
+    def import_from_bucket(self, bucket_name, blob_name):
+        """
+        Replaces the local cache with gs://bucket_name/blob_name if it exists.
+        Returns True when a cache was imported.
+        """
+        blob = storage.Client().bucket(bucket_name).blob(blob_name)
+        if not blob.exists():
+            print(f"No caption cache at gs://{bucket_name}/{blob_name}, starting empty")
+            return False
+        with self.lock:
+            self.conn.close()
+            blob.download_to_filename(self.db_path)
+        self._connect()
+        print(f"Caption cache imported from gs://{bucket_name}/{blob_name}")
+        return True
+
@@ -2,23 +2,75 @@ import json
 import os
 import io
 import argparse
+import itertools
+import shutil
 from pathlib import Path
 import pandas as pd
 import google.generativeai as genai
 import re
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from google.api_core import exceptions as google_exceptions
 from google.cloud import secretmanager
 from dotenv import load_dotenv
+from rate_limiter import RateLimiter
+from caption_cache import CaptionCache, file_hash
+from caption_stream import CaptionStream
+from image_preprocessing import prepare_images
 
 # Load the .env file
 load_dotenv()
 
-# Initialize the Secret Manager client and retrieve the Gemini API key
-secret_manager_client = secretmanager.SecretManagerServiceClient()
-secret_name = os.getenv("GEMINI_GCP_SECRET_ACCESS",
-                        "projects/1087474666309/secrets/GeminiAPI/versions/1")
-response = secret_manager_client.access_secret_version(
-    request={"name": secret_name})
-secret_value = response.payload.data.decode("UTF-8")
+# Gemini 1.5 Flash free tier quotas, override for paid projects
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "15"))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+CAPTION_WORKERS = int(os.getenv("CAPTION_WORKERS", "8"))
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+CAPTION_PROMPT = "For this image, come up with a caption that has 4 parts, and uses short phrases to answer each of the four categories below: - the style - the occasions that it’s worn in - material used - texture and patterns. You don't need to list the four categories."
+# Prompt for multi-image requests, asking for one caption per image in order
+BATCH_CAPTION_PROMPT = "For each of the {count} images above, in the order given, come up with a caption that has 4 parts, and uses short phrases to answer each of the four categories below: - the style - the occasions that it’s worn in - material used - texture and patterns. You don't need to list the four categories. Respond with only a JSON array of {count} strings, one caption per image."
+# Number of images sent in one Gemini request, 1 disables batching
+CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH_SIZE", "1"))
+# Images up to this size are sent inline, larger ones through the File API
+INLINE_IMAGE_MAX_BYTES = int(os.getenv("INLINE_IMAGE_MAX_BYTES", str(4 * 1024 * 1024)))
+# Folder for the caption stream, checkpoint and final outputs (mounted from the host)
+CAPTION_OUTPUT_DIR = os.getenv("CAPTION_OUTPUT_DIR", "/src/output")
+# Number of processed images between two checkpoints
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "50"))
+# Persistent caption cache, optionally shared through a GCS bucket
+CAPTION_CACHE_DB = os.getenv("CAPTION_CACHE_DB", "cache/caption_cache.sqlite")
+CAPTION_CACHE_BUCKET = os.getenv("CAPTION_CACHE_BUCKET")
+CAPTION_CACHE_BLOB = os.getenv("CAPTION_CACHE_BLOB", "caption_cache/caption_cache.sqlite")
+# Longest image side sent to Gemini, 0 sends images unchanged
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "768"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+# Images whose prompt tokens are counted before and after downscaling, 0 skips counting
+TOKEN_SAMPLE_SIZE = int(os.getenv("TOKEN_SAMPLE_SIZE", "0"))
+# Tokens charged to the limiter before a call, reconciled with the actual usage after
+ESTIMATED_TOKENS_PER_IMAGE = 350
+MAX_RETRIES = 5
+
+# Errors that mean the quota was hit and the request should be retried later
+QUOTA_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+)
+
+
+# The Gemini API key is fetched from Secret Manager on first use, so importing
+# this module (tests, short-lived pipeline containers) makes no network calls
+@lru_cache(maxsize=None)
+def get_gemini_api_key():
+    secret_manager_client = secretmanager.SecretManagerServiceClient()
+    secret_name = os.getenv("GEMINI_GCP_SECRET_ACCESS",
+                            "projects/1087474666309/secrets/GeminiAPI/versions/1")
+    response = secret_manager_client.access_secret_version(
+        request={"name": secret_name})
+    return response.payload.data.decode("UTF-8")
 
 
 def download_image_from_local(image_path):
@@ -37,32 +89,171 @@ def preprocess_text(text):
     return cleaned_text
 
 
-def generate_captions_with_gemini(image_path):
-    """Generates captions for the given image using the Gemini client."""
-    image_file, image_name = download_image_from_local(image_path)
-
-    genai.configure(api_key=secret_value)
-
+def image_mime_type(image_name):
     if image_name.endswith(('.jpg', '.jpeg')):
-        mime_type = 'image/jpeg'
+        return 'image/jpeg'
     elif image_name.endswith('.png'):
-        mime_type = 'image/png'
-    else:
-        raise ValueError("Unsupported image format.")
-
-    myfile = genai.upload_file(image_file, mime_type=mime_type)
-    model = genai.GenerativeModel("gemini-1.5-flash")
+        return 'image/png'
+    raise ValueError("Unsupported image format.")
+
+
+class BatchParseError(ValueError):
+    """
+    Raised when a multi-image response is not a JSON array with one caption
+    per image. total_tokens is what the request was billed, when known.
+    """
+
+    def __init__(self, message, total_tokens=None):
+        super().__init__(message)
+        self.total_tokens = total_tokens
+
+
+def parse_batch_captions(text, count):
+    """Validates a multi-image response and splits it into `count` captions."""
+    try:
+        captions = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise BatchParseError(f"Response is not valid JSON: {e}")
+    if not isinstance(captions, list) or len(captions) != count:
+        raise BatchParseError(f"Expected a JSON array of {count} captions")
+    # Accept {"caption": ...} objects as well as plain strings
+    captions = [caption.get('caption') if isinstance(caption, dict) else caption for caption in captions]
+    if not all(isinstance(caption, str) and caption.strip() for caption in captions):
+        raise BatchParseError("Every caption must be a non-empty string")
+    return [preprocess_text(caption) for caption in captions]
+
+
+def split_tokens(total, count):
+    """Splits a request's token count over its images, spreading the remainder."""
+    return [total // count + (1 if i < total % count else 0) for i in range(count)]
+
+
+class GeminiCaptioner:
+    """
+    Long-lived Gemini client: configured and the model built once, then
+    shared by every image (and every worker thread) of a run.
+
+    Images up to `inline_max_bytes` are sent inline with the request; larger
+    ones go through the File API. Per-image timings are kept in `timings`.
+    """
+
+    def __init__(self, api_key=None, model_name=GEMINI_MODEL_NAME, prompt=CAPTION_PROMPT,
+                 inline_max_bytes=INLINE_IMAGE_MAX_BYTES):
+        genai.configure(api_key=api_key or get_gemini_api_key())
+        self.model = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+        self.prompt = prompt
+        self.inline_max_bytes = inline_max_bytes
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def image_part(self, image_bytes, image_name):
+        """Returns the request part for an image, inline or uploaded."""
+        mime_type = image_mime_type(image_name)
+        if len(image_bytes) <= self.inline_max_bytes:
+            return {'mime_type': mime_type, 'data': image_bytes}, False
+        image_file = io.BytesIO(image_bytes)
+        image_file.name = image_name
+        return genai.upload_file(image_file, mime_type=mime_type), True
+
+    def caption(self, image_path, image_name=None):
+        """
+        Generates a caption, returning (caption, prompt, candidates, total tokens).
+        image_name names the result when image_path is a preprocessed copy.
+        """
+        start = time.perf_counter()
+        image_file, file_name = download_image_from_local(image_path)
+        image_bytes = image_file.getvalue()
+        part, uploaded = self.image_part(image_bytes, file_name)
+        image_name = image_name or file_name
+        prepared = time.perf_counter()
+
+        result = self.model.generate_content([part, "\n\n", self.prompt])
+        finished = time.perf_counter()
+
+        with self.lock:
+            self.timings[image_name] = {
+                'prepare_seconds': prepared - start,
+                'request_seconds': finished - prepared,
+                'image_bytes': len(image_bytes),
+                'uploaded': uploaded,
+            }
+
+        caption = preprocess_text(result.text)
+        prompt_token = result.usage_metadata.prompt_token_count
+        candidate_token = result.usage_metadata.candidates_token_count
+        total_token = result.usage_metadata.total_token_count
+
+        return caption, prompt_token, candidate_token, total_token
+
+    def caption_batch(self, image_paths, image_names=None):
+        """
+        Captions several images with one request. Returns one (caption, prompt,
+        candidates, total tokens) tuple per image, with the request's tokens
+        split over the images. Raises BatchParseError on a malformed response.
+        """
+        image_names = image_names or [None] * len(image_paths)
+        start = time.perf_counter()
+        contents, names, sizes = [], [], []
+        for i, (image_path, image_name) in enumerate(zip(image_paths, image_names), start=1):
+            image_file, file_name = download_image_from_local(image_path)
+            image_bytes = image_file.getvalue()
+            part, _ = self.image_part(image_bytes, file_name)
+            contents += [f"Image {i}:", part]
+            names.append(image_name or file_name)
+            sizes.append(len(image_bytes))
+        contents += ["\n\n", BATCH_CAPTION_PROMPT.format(count=len(image_paths))]
+        prepared = time.perf_counter()
+
+        result = self.model.generate_content(
+            contents, generation_config={'response_mime_type': 'application/json'})
+        finished = time.perf_counter()
 
-    result = model.generate_content(
-        [myfile, "\n\n", "For this image, come up with a caption that has 4 parts, and uses short phrases to answer each of the four categories below: - the style - the occasions that it’s worn in - material used - texture and patterns. You don't need to list the four categories."]
-    )
-
-    caption = preprocess_text(result.text)
-    prompt_token = result.usage_metadata.prompt_token_count
-    candidate_token = result.usage_metadata.candidates_token_count
-    total_token = result.usage_metadata.total_token_count
-
-    return caption, prompt_token, candidate_token, total_token
+        try:
+            captions = parse_batch_captions(result.text, len(image_paths))
+        except BatchParseError as e:
+            e.total_tokens = result.usage_metadata.total_token_count
+            raise
+        count = len(image_paths)
+        with self.lock:
+            for image_name, image_size in zip(names, sizes):
+                self.timings[image_name] = {
+                    'prepare_seconds': (prepared - start) / count,
+                    'request_seconds': finished - prepared,
+                    'image_bytes': image_size,
+                    'uploaded': image_size > self.inline_max_bytes,
+                    'batch_size': count,
+                }
+
+        usage = result.usage_metadata
+        return list(zip(captions,
+                        split_tokens(usage.prompt_token_count, count),
+                        split_tokens(usage.candidates_token_count, count),
+                        split_tokens(usage.total_token_count, count)))
+
+    def count_prompt_tokens(self, image_path):
+        """Prompt tokens Gemini would charge for an image, without generating."""
+        image_file, image_name = download_image_from_local(image_path)
+        part, _ = self.image_part(image_file.getvalue(), image_name)
+        return self.model.count_tokens([part, "\n\n", self.prompt]).total_tokens
+
+    def timing_summary(self):
+        """Mean and 95th percentile of the client-side and request times."""
+        with self.lock:
+            timings = list(self.timings.values())
+        summary = {'images': len(timings),
+                   'uploaded': sum(timing['uploaded'] for timing in timings)}
+        for key in ('prepare_seconds', 'request_seconds'):
+            values = sorted(timing[key] for timing in timings)
+            if values:
+                summary[f'mean_{key}'] = sum(values) / len(values)
+                summary[f'p95_{key}'] = values[min(len(values) - 1, int(0.95 * len(values)))]
+        return summary
+
+
+def generate_captions_with_gemini(image_path, api_key=None):
+    """Generates captions for a single image; runs over many images share a GeminiCaptioner."""
+    return GeminiCaptioner(api_key).caption(image_path)
 
 
 def save_intermediate_results(csv_data, json_data, failed_images, intermediate_folder, csv_output, json_output, failed_csv_output, batch_num):
@@ -81,7 +272,155 @@ def save_intermediate_results(csv_data, json_data, failed_images, intermediate_f
         failed_df.to_csv(failed_batch_output, index=False)
 
 
-def wrapper_function():
+def caption_with_retry(image_path, caption_fn, limiter=None, max_retries=MAX_RETRIES,
+                       estimated_tokens=ESTIMATED_TOKENS_PER_IMAGE, sleep=time.sleep):
+    """Calls caption_fn under the rate limiter, backing off and retrying on quota errors."""
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire(estimated_tokens)
+        # Failed calls refund the estimate they were charged, unless they were billed
+        used = 0
+        try:
+            result = caption_fn(image_path)
+            # Batch calls return one result per image
+            used = sum(item[3] for item in result) if isinstance(result, list) else result[3]
+            return result
+        except BatchParseError as e:
+            # The malformed response was still generated and billed
+            used = e.total_tokens if e.total_tokens is not None else estimated_tokens
+            raise
+        except QUOTA_ERRORS:
+            if attempt == max_retries:
+                raise
+            # Exponential backoff with jitter so workers do not retry in lockstep
+            sleep(min(60, 2 ** attempt) + random.uniform(0, 1))
+        finally:
+            if limiter is not None:
+                limiter.reconcile(estimated_tokens, used)
+
+
+def caption_batch_with_fallback(image_files, batch_fn, caption_fn, limiter=None, max_retries=MAX_RETRIES):
+    """
+    Captions a group of images with one request, falling back to one request
+    per image when the response cannot be split or is blocked or empty.
+    Returns (image_file, result, error) tuples.
+    """
+    try:
+        results = caption_with_retry(image_files, batch_fn, limiter, max_retries,
+                                     ESTIMATED_TOKENS_PER_IMAGE * len(image_files))
+        return [(image_file, result, None) for image_file, result in zip(image_files, results)]
+    except ValueError as e:
+        # BatchParseError, or a blocked or empty response without text
+        print(f"Batch of {len(image_files)} images failed ({e}), captioning one by one")
+
+    outcomes = []
+    for image_file in image_files:
+        try:
+            outcomes.append((image_file, caption_with_retry(image_file, caption_fn, limiter, max_retries), None))
+        except Exception as e:
+            outcomes.append((image_file, None, e))
+    return outcomes
+
+
+def caption_images(image_files, caption_fn=None, max_workers=CAPTION_WORKERS,
+                   limiter=None, max_retries=MAX_RETRIES, batch_fn=None, batch_size=1):
+    """
+    Captions images on a thread pool, since each call mostly waits on Gemini.
+    Yields (image_file, result, error) tuples in completion order, where
+    result is the (caption, prompt, candidates, total tokens) tuple.
+
+    With batch_fn and batch_size > 1, each request captions batch_size images.
+    """
+    caption_fn = caption_fn or generate_captions_with_gemini
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if batch_fn is not None and batch_size > 1:
+            batches = [image_files[i:i + batch_size] for i in range(0, len(image_files), batch_size)]
+            futures = {
+                executor.submit(caption_batch_with_fallback, batch, batch_fn, caption_fn, limiter, max_retries): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                try:
+                    yield from future.result()
+                except Exception as e:
+                    for image_file in futures[future]:
+                        yield image_file, None, e
+            return
+
+        futures = {
+            executor.submit(caption_with_retry, image_file, caption_fn, limiter, max_retries): image_file
+            for image_file in image_files
+        }
+        for future in as_completed(futures):
+            image_file = futures[future]
+            try:
+                yield image_file, future.result(), None
+            except Exception as e:
+                yield image_file, None, e
+
+
+def list_images(images_folder):
+    valid_image_extensions = ['.jpg', '.jpeg', '.png']
+    return sorted(image_file for image_file in Path(images_folder).glob('**/*')
+                  if image_file.suffix.lower() in valid_image_extensions)
+
+
+def measure_preprocessing_savings(captioner, prepared, sample_size=TOKEN_SAMPLE_SIZE, limiter=None):
+    """
+    Compares upload bytes for every image and, for a sample of sample_size
+    images, prompt tokens before and after downscaling. Token counts use
+    count_tokens under the rate limiter, so measuring costs no generation;
+    images whose tokens cannot be counted are left out of the sample.
+    """
+    report = {
+        'images': len(prepared),
+        'bytes_before': sum(original_bytes for _, original_bytes, _ in prepared.values()),
+        'bytes_after': sum(prepared_bytes for _, _, prepared_bytes in prepared.values()),
+        'sampled_images': 0,
+        'sample_prompt_tokens_before': 0,
+        'sample_prompt_tokens_after': 0,
+    }
+    for image_file, (prepared_path, _, _) in itertools.islice(prepared.items(), sample_size):
+        try:
+            counts = []
+            for path in (image_file, prepared_path):
+                if limiter is not None:
+                    limiter.acquire()
+                counts.append(captioner.count_prompt_tokens(path))
+        except Exception as e:
+            print(f"Could not count prompt tokens of {image_file.name}, leaving it out of the sample: {e}")
+            continue
+        report['sample_prompt_tokens_before'] += counts[0]
+        report['sample_prompt_tokens_after'] += counts[1]
+        report['sampled_images'] += 1
+    if report['sampled_images']:
+        saved_per_image = (report['sample_prompt_tokens_before'] -
+                           report['sample_prompt_tokens_after']) / report['sampled_images']
+        report['estimated_prompt_tokens_saved'] = round(saved_per_image * len(prepared))
+    return report
+
+
+def split_cached(image_files, cache):
+    """
+    Looks every image up in the caption cache. Returns the cached results as
+    (image_file, result) pairs, the images still to caption, and the content
+    hash of every image.
+    """
+    image_hashes = {image_file: file_hash(image_file) for image_file in image_files}
+    cached, to_caption = [], []
+    for image_file in image_files:
+        result = cache.get(image_hashes[image_file])
+        if result is None:
+            to_caption.append(image_file)
+        else:
+            cached.append((image_file, result))
+    return cached, to_caption, image_hashes
+
+
+def wrapper_function(max_workers=CAPTION_WORKERS, requests_per_minute=GEMINI_REQUESTS_PER_MINUTE,
+                     tokens_per_minute=GEMINI_TOKENS_PER_MINUTE, use_cache=True, resume=False,
+                     images_folder="data", output_dir=CAPTION_OUTPUT_DIR, max_side=IMAGE_MAX_SIDE,
+                     batch_size=CAPTION_BATCH_SIZE, token_sample_size=TOKEN_SAMPLE_SIZE):
     gemini_key_path = os.getenv("GEMINI_KEY_PATH")  # Environment variable set in Docker
     with open(gemini_key_path, 'r') as f:
         gemini_key_data = json.load(f)
@@ -91,48 +430,91 @@ def wrapper_function():
     if not gemini_key:
         raise ValueError("The API key is missing from the gemini_key.json file.")
 
-    images_folder = "data"
-    output_folder = "output"
-
     # Now you have the folder names for all the paths
     print(f"Images folder: {images_folder}")
-    print(f"Output folder: {output_folder}")
+    print(f"Output folder: {output_dir}")
 
     # Ensure directories exist
-    os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
-    csv_data = []
-    json_data = []
+    # Results are appended to the stream as they are produced
+    stream = CaptionStream(output_dir).open(resume)
     failed_images = []
 
-    total_images = 0
-    batch_num = 1
-
     # Iterate through images and generate captions
-    image_files = Path(images_folder).glob('**/*')
-    valid_image_extensions = ['.jpg', '.jpeg', '.png']
-
-    for image_file in image_files:
-        if image_file.suffix.lower() not in valid_image_extensions:
-            continue
-
-        total_images += 1
-        print(f"Processing image {total_images}: {image_file.name}")
-
-        try:
-            caption, prompt_token, candidate_token, total_token = generate_captions_with_gemini(
-                image_file)
-            csv_data.append({
-                'image_name': image_file.name,
-                'prompt_token_count': prompt_token,
-                'candidates_token_count': candidate_token,
-                'total_token_count': total_token
-            })
-            json_data.append({'image': image_file.name, 'caption': caption})
-
-        except Exception as e:
-            failed_images.append(
-                {'image_name': image_file.name, 'error': str(e)})
+    image_files = list_images(images_folder)
+    total_images = len(image_files)
+    if resume:
+        done = stream.processed_images()
+        image_files = [image_file for image_file in image_files if image_file.name not in done]
+        print(f"Resuming: {len(done)} images already captioned, {len(image_files)} left")
+
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    captioner = GeminiCaptioner(gemini_key)
+
+    # Images whose content, prompt and model are unchanged reuse their caption
+    cached, to_caption, image_hashes = [], image_files, {}
+    cache = None
+    if use_cache:
+        # Captions of downscaled images are only reused for the same max side
+        cache_model = f"{captioner.model_name}@{max_side}" if max_side else captioner.model_name
+        # Batched captions are keyed by the batch prompt, which also holds the batch size
+        cache_prompt = BATCH_CAPTION_PROMPT.format(count=batch_size) if batch_size > 1 else captioner.prompt
+        cache = CaptionCache(CAPTION_CACHE_DB, cache_model, cache_prompt)
+        if CAPTION_CACHE_BUCKET:
+            cache.import_from_bucket(CAPTION_CACHE_BUCKET, CAPTION_CACHE_BLOB)
+        cached, to_caption, image_hashes = split_cached(image_files, cache)
+        print(f"Caption cache: {len(cached)} cached, {len(to_caption)} to caption")
+
+    # Downscale and re-encode the images to caption to cut upload bytes and prompt tokens
+    prepared = {}
+    preprocessing_report = None
+    if max_side and to_caption:
+        prepared = prepare_images(to_caption, os.path.join(output_dir, "prepared"), max_side, IMAGE_JPEG_QUALITY)
+        preprocessing_report = measure_preprocessing_savings(captioner, prepared, token_sample_size, limiter)
+        print(f"Image preprocessing: {preprocessing_report}")
+
+    def source_of(image_file):
+        return prepared[image_file][0] if image_file in prepared else image_file
+
+    def caption_fn(image_file):
+        return captioner.caption(source_of(image_file), image_name=image_file.name)
+
+    def batch_fn(image_files):
+        return captioner.caption_batch([source_of(image_file) for image_file in image_files],
+                                       [image_file.name for image_file in image_files])
+
+    cached_files = {image_file for image_file, _ in cached}
+    results = [(image_file, result, None) for image_file, result in cached]
+    results = itertools.chain(results, caption_images(
+        to_caption, caption_fn, max_workers, limiter, batch_fn=batch_fn, batch_size=batch_size))
+
+    succeeded = 0
+    with stream:
+        for processed, (image_file, result, error) in enumerate(results, start=1):
+            print(f"Processed image {processed}/{len(image_files)}: {image_file.name}")
+
+            if error is None:
+                caption, prompt_token, candidate_token, total_token = result
+                if cache is not None and image_file not in cached_files:
+                    cache.put(image_hashes[image_file], caption, prompt_token, candidate_token, total_token)
+                stream.append({
+                    'image_name': image_file.name,
+                    'caption': caption,
+                    'prompt_token_count': prompt_token,
+                    'candidates_token_count': candidate_token,
+                    'total_token_count': total_token,
+                    **captioner.timings.get(image_file.name, {})
+                })
+                succeeded += 1
+            else:
+                failure = {'image_name': image_file.name, 'error': str(error)}
+                failed_images.append(failure)
+                stream.append_failure(failure)
+
+            if processed % CHECKPOINT_EVERY == 0:
+                stream.checkpoint(processed, succeeded, len(failed_images), len(image_files))
+        stream.checkpoint(len(image_files), succeeded, len(failed_images), len(image_files))
 
     # Print current working directory
     print("Current working directory (pwd):")
@@ -143,9 +525,7 @@ def wrapper_function():
     for item in os.listdir():
         print(item)
 
-    # Check if 'output' folder exists and list its contents
-    output_dir = 'output'
-
+    # Check if the output folder exists and list its contents
     if os.path.exists(output_dir) and os.path.isdir(output_dir):
         print(f"\nContents of '{output_dir}' folder:")
         for item in os.listdir(output_dir):
@@ -153,19 +533,67 @@ def wrapper_function():
     else:
         print(f"\n'{output_dir}' folder does not exist.")
 
-    # Final output saving
+    # Final output assembled from the stream, including results of earlier runs when resuming
+    records = stream.read()
+    csv_data = [{key: value for key, value in record.items() if key != 'caption'} for record in records]
+    json_data = [{'image': record['image_name'], 'caption': record['caption']} for record in records]
+
     csv_df = pd.DataFrame(csv_data)
-    output_path = f"/src/output/final_output.csv"
+    output_path = os.path.join(output_dir, "final_output.csv")
     csv_df.to_csv(output_path, index=False)
 
-    with open(f"/src/output/final_output.json", 'w') as json_file:
+    with open(os.path.join(output_dir, "final_output.json"), 'w') as json_file:
         json.dump(json_data, json_file, indent=4)
 
+    captioned_names = {image_file.name for image_file in to_caption}
+    if preprocessing_report is not None:
+        # Actual prompt tokens of this batch, as reported in usage_metadata
+        preprocessing_report['prompt_tokens_after'] = sum(
+            record.get('prompt_token_count') or 0 for record in records
+            if record['image_name'] in captioned_names)
+        with open(os.path.join(output_dir, "preprocessing_report.json"), 'w') as report_file:
+            json.dump(preprocessing_report, report_file, indent=4)
+        shutil.rmtree(os.path.join(output_dir, "prepared"), ignore_errors=True)
+
     print(
         f"Total images: {total_images}, successfully processed: {len(csv_data)}, failed: {len(failed_images)}")
+    print(f"Caption timings: {captioner.timing_summary()}")
+    new_records = [record for record in records if record['image_name'] in captioned_names]
+    if new_records:
+        print(f"Cost per image (batch size {batch_size}): "
+              f"{sum(record['total_token_count'] for record in new_records) / len(new_records):.1f} tokens")
+    if cache is not None:
+        print(f"Caption cache: {cache.stats()}")
+        if CAPTION_CACHE_BUCKET:
+            cache.export_to_bucket(CAPTION_CACHE_BUCKET, CAPTION_CACHE_BLOB)
+        cache.close()
 
     print(f"File saved at: {os.path.abspath(output_path)}")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate image captions with Gemini")
+    parser.add_argument("--workers", type=int, default=CAPTION_WORKERS,
+                        help="Number of concurrent Gemini requests.")
+    parser.add_argument("--requests_per_minute", type=int, default=GEMINI_REQUESTS_PER_MINUTE,
+                        help="Gemini requests per minute quota.")
+    parser.add_argument("--tokens_per_minute", type=int, default=GEMINI_TOKENS_PER_MINUTE,
+                        help="Gemini tokens per minute quota.")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Caption every image again instead of reusing cached captions.")
+    parser.add_argument("--max_side", type=int, default=IMAGE_MAX_SIDE,
+                        help="Downscale images to this longest side before captioning, 0 to disable.")
+    parser.add_argument("--batch_size", type=int, default=CAPTION_BATCH_SIZE,
+                        help="Number of images captioned per Gemini request.")
+    parser.add_argument("--token_sample_size", type=int, default=TOKEN_SAMPLE_SIZE,
+                        help="Images whose prompt tokens are counted before and after downscaling, 0 to skip.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip images already captioned in the output stream of a previous run.")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    wrapper_function()
+    args = parse_args()
+    wrapper_function(args.workers, args.requests_per_minute, args.tokens_per_minute,
+                     not args.no_cache, args.resume, max_side=args.max_side, batch_size=args.batch_size,
+                     token_sample_size=args.token_sample_size)
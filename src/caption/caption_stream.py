@@ -0,0 +1,83 @@
+import json
+import os
+import time
+
+
+class CaptionStream:
+    """
+    Append-only JSONL log of caption results plus a periodic checkpoint.
+
+    Every result is written and flushed as soon as it is produced, so a
+    crash loses at most the line being written. A resumed run skips the
+    images already in the stream, and the final JSON/CSV are built from it.
+    """
+
+    def __init__(self, output_folder, stream_name="captions.jsonl",
+                 failed_name="failed_images.jsonl", checkpoint_name="checkpoint.json"):
+        os.makedirs(output_folder, exist_ok=True)
+        self.stream_path = os.path.join(output_folder, stream_name)
+        self.failed_path = os.path.join(output_folder, failed_name)
+        self.checkpoint_path = os.path.join(output_folder, checkpoint_name)
+        self.stream_file = None
+        self.failed_file = None
+
+    def open(self, resume=False):
+        """Opens the stream for appending; without resume previous results are discarded."""
+        mode = 'a' if resume else 'w'
+        self.stream_file = open(self.stream_path, mode)
+        if resume and self.stream_file.tell() > 0:
+            # Terminate a line cut short by a crash so new records start cleanly
+            with open(self.stream_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.stream_file.write("\n")
+        # Failed images are retried on resume, so their log always starts empty
+        self.failed_file = open(self.failed_path, 'w')
+        return self
+
+    def close(self):
+        for f in (self.stream_file, self.failed_file):
+            if f is not None:
+                f.close()
+        self.stream_file = self.failed_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _append(f, record):
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+
+    def append(self, record):
+        self._append(self.stream_file, record)
+
+    def append_failure(self, record):
+        self._append(self.failed_file, record)
+
+    def read(self):
+        """Returns every complete record in the stream, skipping a truncated last line."""
+        if not os.path.exists(self.stream_path):
+            return []
+        records = []
+        with open(self.stream_path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping incomplete line in {self.stream_path}")
+        return records
+
+    def processed_images(self):
+        return {record['image_name'] for record in self.read()}
+
+    def checkpoint(self, processed, succeeded, failed, total):
+        """Atomically writes the run's progress."""
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'processed': processed, 'succeeded': succeeded, 'failed': failed,
+                       'total': total, 'updated_at': time.time()}, f, indent=4)
+        os.replace(tmp_path, self.checkpoint_path)
@@ -0,0 +1,53 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+
+
+def downscale_image(image_bytes, max_side, quality=90):
+    """
+    Resizes an image so its longest side is at most max_side and re-encodes
+    it as JPEG. Smaller images are only re-encoded.
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def _prepare_one(args):
+    source_path, target_path, max_side, quality = args
+    with open(source_path, 'rb') as f:
+        original = f.read()
+    try:
+        prepared = downscale_image(original, max_side, quality)
+    except Exception as e:
+        # Send undecodable images unchanged and let Gemini report on them
+        print(f"Could not downscale {source_path}: {e}")
+        return str(source_path), len(original), len(original)
+    # Keep the original when re-encoding would not make it smaller
+    if len(prepared) >= len(original) and str(source_path).lower().endswith(('.jpg', '.jpeg')):
+        prepared = original
+    with open(target_path, 'wb') as f:
+        f.write(prepared)
+    return target_path, len(original), len(prepared)
+
+
+def prepare_images(image_files, prepared_folder, max_side, quality=90, workers=None):
+    """
+    Downscales images into prepared_folder on a process pool, since decoding
+    and resizing is CPU bound. Returns {image_file: (prepared_path,
+    original_bytes, prepared_bytes)}.
+    """
+    os.makedirs(prepared_folder, exist_ok=True)
+    # Prepared files are JPEGs, numbered so equal names in subfolders do not clash
+    targets = [os.path.join(prepared_folder, f"{i:06d}_{os.path.splitext(os.path.basename(image_file))[0]}.jpg")
+               for i, image_file in enumerate(image_files)]
+    jobs = [(image_file, target, max_side, quality) for image_file, target in zip(image_files, targets)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_prepare_one, jobs, chunksize=16))
+
+    return dict(zip(image_files, results))
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`,
+    holding at most `capacity` tokens (one minute's worth by default).
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, clock=time.monotonic):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill()
+        # Requests larger than the bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate_per_second
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Limits Gemini calls on both requests per minute and tokens per minute.
+
+    Token usage is only known after a call, so `acquire` debits an estimate
+    and `reconcile` corrects the bucket with the actual usage.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.requests = TokenBucket(requests_per_minute, clock=clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def acquire(self, estimated_tokens=0):
+        """Blocks until one request and `estimated_tokens` tokens can be spent."""
+        while True:
+            with self.lock:
+                wait = self.requests.wait_time(1)
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(estimated_tokens))
+                if wait <= 0:
+                    self.requests.consume(1)
+                    if self.tokens is not None:
+                        self.tokens.consume(estimated_tokens)
+                    return
+            self.sleep(wait)
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        """Charges (or refunds) the difference between the estimate and the actual usage."""
+        if self.tokens is None:
+            return
+        with self.lock:
+            self.tokens.consume(actual_tokens - estimated_tokens)
@@ -0,0 +1,51 @@
+from unittest.mock import patch, MagicMock
+from caption_cache import CaptionCache, file_hash
+from caption_generating import split_cached
+
+
+def test_cache_hit_requires_same_prompt_and_model(tmp_path):
+    db_path = str(tmp_path / "cache.sqlite")
+    cache = CaptionCache(db_path, "gemini-1.5-flash", "prompt")
+    cache.put("hash1", "A caption", 258, 40, 298)
+    cache.close()
+
+    cache = CaptionCache(db_path, "gemini-1.5-flash", "prompt")
+    assert cache.get("hash1") == ("A caption", 258, 40, 298)
+    assert cache.get("hash2") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "tokens_saved": 298}
+
+    assert CaptionCache(db_path, "gemini-1.5-flash", "other prompt").get("hash1") is None
+    assert CaptionCache(db_path, "gemini-1.5-pro", "prompt").get("hash1") is None
+
+
+def test_split_cached_uses_image_content(tmp_path):
+    first = tmp_path / "first.jpg"
+    first.write_bytes(b"same bytes")
+    copy = tmp_path / "copy.jpg"
+    copy.write_bytes(b"same bytes")
+    other = tmp_path / "other.jpg"
+    other.write_bytes(b"other bytes")
+
+    cache = CaptionCache(str(tmp_path / "cache.sqlite"), "model", "prompt")
+    cache.put(file_hash(first), "A caption", 258, 40, 298)
+
+    cached, to_caption, image_hashes = split_cached([first, copy, other], cache)
+    assert [image_file for image_file, _ in cached] == [first, copy]
+    assert to_caption == [other]
+    assert image_hashes[first] == image_hashes[copy]
+    assert cache.stats()["tokens_saved"] == 596
+
+
+@patch("caption_cache.storage.Client")
+def test_export_and_import_bucket(mock_client, tmp_path):
+    mock_blob = MagicMock()
+    mock_client.return_value.bucket.return_value.blob.return_value = mock_blob
+    cache = CaptionCache(str(tmp_path / "cache.sqlite"), "model", "prompt")
+
+    cache.export_to_bucket("bucket", "caption_cache/cache.sqlite")
+    mock_client.return_value.bucket.assert_called_with("bucket")
+    mock_blob.upload_from_filename.assert_called_once_with(str(tmp_path / "cache.sqlite"))
+
+    mock_blob.exists.return_value = False
+    assert cache.import_from_bucket("bucket", "caption_cache/cache.sqlite") is False
+    mock_blob.download_to_filename.assert_not_called()
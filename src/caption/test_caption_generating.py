@@ -1,7 +1,22 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import threading
 import pytest
+import pandas as pd
 from io import BytesIO
 from pathlib import Path
-from caption_generating import download_image_from_local
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+from google.api_core.exceptions import ResourceExhausted
+from caption_generating import (BatchParseError, GeminiCaptioner, caption_images, caption_with_retry,
+                                download_image_from_local, generate_captions_with_gemini,
+                                measure_preprocessing_savings, parse_batch_captions, preprocess_text,
+                                save_intermediate_results)
+from rate_limiter import RateLimiter
+from test_rate_limiter import FakeClock
 
 def test_download_image_from_local_1(tmp_path):
     # Create a temporary image file
@@ -18,7 +33,6 @@ def test_download_image_from_local_2(tmp_path):
     with pytest.raises(FileNotFoundError):
         download_image_from_local("non_existent.jpg")
 
-from caption_generating import preprocess_text
 
 def test_preprocess_text_1():
     assert preprocess_text("Text with \\n newlines \\u1234") == "Text with newlines"
@@ -27,8 +41,6 @@ def test_preprocess_text_2():
     assert preprocess_text("  Extra   spaces  ") == "Extra spaces"
     assert preprocess_text("") == ""
 
-from unittest.mock import patch, MagicMock
-from caption_generating import generate_captions_with_gemini
 
 @patch("caption_generating.genai")  # Mock the Gemini API client
 def test_generate_captions_with_gemini(mock_genai, tmp_path):
@@ -96,11 +108,6 @@ def test_generate_captions_with_gemini_2(mock_genai, tmp_path):
     assert total_token == 30
 
 
-
-import pandas as pd
-import json
-from caption_generating import save_intermediate_results
-
 def test_save_intermediate_results_1(tmp_path):
     csv_data = [{"image_name": "test.jpg", "token_count": 5}]
     json_data = [{"image": "test.jpg", "caption": "Sample caption"}]
@@ -127,9 +134,6 @@ def test_save_intermediate_results_1(tmp_path):
     assert failed_file.exists()
     assert pd.read_csv(failed_file).shape[0] == 1
 
-import pandas as pd
-import json
-from caption_generating import save_intermediate_results
 
 def test_save_intermediate_results_2(tmp_path):
     csv_data = [
@@ -164,4 +168,328 @@ def test_save_intermediate_results_2(tmp_path):
     # Check failed CSV
     failed_file = tmp_path / "failed_output_batch_2.csv"
     assert failed_file.exists()
-    assert pd.read_csv(failed_file).shape[0] == 2
\ No newline at end of file
+    assert pd.read_csv(failed_file).shape[0] == 2
+
+
+# Upper bound for a cold import, the captioner runs as a short-lived pipeline container
+IMPORT_BUDGET_SECONDS = 10
+
+
+def test_import_is_offline_and_fast():
+    """Importing the module must not reach Secret Manager and should stay fast."""
+    env = dict(os.environ, GOOGLE_APPLICATION_CREDENTIALS="/nonexistent/secret.json")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", "import caption_generating"],
+                            cwd=Path(__file__).parent, env=env, capture_output=True)
+    elapsed = time.perf_counter() - start
+
+    assert result.returncode == 0, result.stderr.decode()
+    assert elapsed < IMPORT_BUDGET_SECONDS
+
+
+@patch("caption_generating.secretmanager.SecretManagerServiceClient")
+def test_gemini_api_key_is_fetched_once(mock_client):
+    from caption_generating import get_gemini_api_key
+
+    mock_client.return_value.access_secret_version.return_value.payload.data.decode.return_value = "key"
+    get_gemini_api_key.cache_clear()
+    try:
+        assert get_gemini_api_key() == "key"
+        assert get_gemini_api_key() == "key"
+        mock_client.assert_called_once()
+    finally:
+        get_gemini_api_key.cache_clear()
+
+
+# Offline stand-in for the `google.generativeai` module used by the captioner,
+# patched over `caption_generating.genai`. It answers `generate_content` after a
+# fixed latency with a deterministic caption and usage metadata, and can reject
+# calls with a quota error to exercise the retry path. Requests with several
+# images are answered with a JSON array holding one caption per image.
+class FakeGenerativeModel:
+    def __init__(self, fake, model_name):
+        self.fake = fake
+        self.model_name = model_name
+
+    def generate_content(self, contents, **kwargs):
+        return self.fake.generate(contents)
+
+    def count_tokens(self, contents, **kwargs):
+        return SimpleNamespace(total_tokens=self.fake.prompt_token_count(contents))
+
+
+class FakeGenAI:
+    def __init__(self, latency=0.0, quota_errors=0, prompt_tokens=258, candidate_tokens=40,
+                 tokens_per_kb=0, image_tokens=0, malformed_batches=0):
+        self.latency = latency
+        # Prompt tokens charged per image, so batching amortizes only the text prompt
+        self.image_tokens = image_tokens
+        # Number of multi-image requests answered with an unparseable response
+        self.malformed_batches = malformed_batches
+        # Extra prompt tokens per KiB of image data, to model size-dependent cost
+        self.tokens_per_kb = tokens_per_kb
+        self.quota_errors = quota_errors
+        self.prompt_tokens = prompt_tokens
+        self.candidate_tokens = candidate_tokens
+        self.lock = threading.Lock()
+        self.configure_calls = 0
+        self.models_created = 0
+        self.uploads = 0
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def configure(self, api_key=None, **kwargs):
+        with self.lock:
+            self.configure_calls += 1
+
+    def upload_file(self, path, mime_type=None, **kwargs):
+        size_bytes = len(path.getvalue()) if hasattr(path, 'getvalue') else os.path.getsize(path)
+        with self.lock:
+            self.uploads += 1
+        return SimpleNamespace(name=f"files/{self.uploads}", mime_type=mime_type, size_bytes=size_bytes)
+
+    def GenerativeModel(self, model_name, **kwargs):
+        with self.lock:
+            self.models_created += 1
+        return FakeGenerativeModel(self, model_name)
+
+    @staticmethod
+    def image_count(contents):
+        return sum(1 for part in contents if not isinstance(part, str))
+
+    def prompt_token_count(self, contents):
+        # Inline and uploaded images cost the same
+        image_bytes = sum(len(part['data']) if isinstance(part, dict) else part.size_bytes
+                          for part in contents if not isinstance(part, str))
+        return (self.prompt_tokens + image_bytes // 1024 * self.tokens_per_kb
+                + self.image_count(contents) * self.image_tokens)
+
+    def generate(self, contents):
+        with self.lock:
+            if self.quota_errors > 0:
+                self.quota_errors -= 1
+                raise ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+            self.calls += 1
+            call_number = self.calls
+            images = self.image_count(contents)
+            malformed = images > 1 and self.malformed_batches > 0
+            if malformed:
+                self.malformed_batches -= 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        prompt_tokens = self.prompt_token_count(contents)
+        candidate_tokens = self.candidate_tokens * max(images, 1)
+        usage = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=candidate_tokens,
+            total_token_count=prompt_tokens + candidate_tokens,
+        )
+        if malformed:
+            text = "Here are your captions: 1. a dress"
+        elif images > 1:
+            text = json.dumps([f"Caption {call_number}.{i}" for i in range(1, images + 1)])
+        else:
+            text = f"Caption {call_number}"
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+def make_images(tmp_path, count):
+    images = []
+    for i in range(count):
+        image = tmp_path / f"image_{i}.jpg"
+        image.write_bytes(b"\xFF\xD8\xFF")
+        images.append(image)
+    return images
+
+
+def test_caption_images_runs_concurrently(tmp_path):
+    fake = FakeGenAI(latency=0.1)
+    images = make_images(tmp_path, 16)
+
+    with patch("caption_generating.genai", fake):
+        start = time.perf_counter()
+        results = list(caption_images(images, max_workers=8, caption_fn=lambda path: generate_captions_with_gemini(path, "key")))
+        elapsed = time.perf_counter() - start
+
+    assert len(results) == 16
+    assert all(error is None for _, _, error in results)
+    assert fake.max_in_flight > 1
+    # Sequential captioning would take 1.6 seconds
+    assert elapsed < 0.8
+
+
+def test_caption_with_retry_recovers_from_quota_errors(tmp_path):
+    fake = FakeGenAI(quota_errors=2)
+    image = make_images(tmp_path, 1)[0]
+    sleeps = []
+
+    with patch("caption_generating.genai", fake):
+        caption, _, _, total_token = caption_with_retry(
+            image, lambda path: generate_captions_with_gemini(path, "key"),
+            limiter=RateLimiter(1000, 100000), sleep=sleeps.append)
+
+    assert caption == "Caption 1"
+    assert total_token == 298
+    assert len(sleeps) == 2
+
+
+def test_caption_with_retry_gives_up_after_max_retries(tmp_path):
+    fake = FakeGenAI(quota_errors=10)
+    image = make_images(tmp_path, 1)[0]
+
+    with patch("caption_generating.genai", fake):
+        with pytest.raises(ResourceExhausted):
+            caption_with_retry(image, lambda path: generate_captions_with_gemini(path, "key"),
+                               max_retries=2, sleep=lambda seconds: None)
+
+
+def test_caption_with_retry_refunds_estimate_of_failed_calls(tmp_path):
+    clock = FakeClock()
+    limiter = RateLimiter(1000, 10000, clock=clock, sleep=clock.sleep)
+
+    def failing(path):
+        raise ValueError("Empty response")
+
+    with pytest.raises(ValueError):
+        caption_with_retry(make_images(tmp_path, 1)[0], failing, limiter, estimated_tokens=600)
+
+    assert limiter.tokens.tokens == 10000
+
+
+def test_caption_with_retry_charges_billed_tokens_of_malformed_batches(tmp_path):
+    clock = FakeClock()
+    limiter = RateLimiter(1000, 10000, clock=clock, sleep=clock.sleep)
+
+    with patch("caption_generating.genai", FakeGenAI(malformed_batches=1)):
+        captioner = GeminiCaptioner("key")
+        with pytest.raises(BatchParseError) as error:
+            caption_with_retry(make_images(tmp_path, 2), captioner.caption_batch, limiter, estimated_tokens=600)
+
+    assert error.value.total_tokens > 0
+    assert limiter.tokens.tokens == 10000 - error.value.total_tokens
+
+
+def test_captioner_configures_once_and_sends_small_images_inline(tmp_path):
+    fake = FakeGenAI()
+    images = make_images(tmp_path, 5)
+
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key")
+        results = list(caption_images(images, captioner.caption, max_workers=4))
+
+    assert all(error is None for _, _, error in results)
+    assert fake.configure_calls == 1
+    assert fake.models_created == 1
+    assert fake.uploads == 0
+    assert captioner.timing_summary()["images"] == 5
+    assert captioner.timings["image_0.jpg"]["uploaded"] is False
+
+
+def test_captioner_uploads_images_above_inline_threshold(tmp_path):
+    fake = FakeGenAI()
+    small = tmp_path / "small.jpg"
+    small.write_bytes(b"\xFF\xD8\xFF")
+    large = tmp_path / "large.png"
+    large.write_bytes(b"\x89PNG" + b"\x00" * 2048)
+
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key", inline_max_bytes=1024)
+        captioner.caption(small)
+        captioner.caption(large)
+
+    assert fake.uploads == 1
+    assert captioner.timings["large.png"]["uploaded"] is True
+    assert captioner.timing_summary()["uploaded"] == 1
+
+
+def test_token_sample_uses_limiter_and_skips_failed_counts(tmp_path):
+    fake = FakeGenAI()
+    images = make_images(tmp_path, 3)
+    prepared = {image: (image, 100, 50) for image in images}
+    limiter = MagicMock()
+
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key", inline_max_bytes=1)
+        calls = []
+
+        def count_tokens(contents):
+            calls.append(contents)
+            if len(calls) == 1:
+                raise ValueError("count_tokens failed")
+            return MagicMock(total_tokens=258)
+        captioner.model.count_tokens = count_tokens
+        report = measure_preprocessing_savings(captioner, prepared, sample_size=3, limiter=limiter)
+
+    assert report['sampled_images'] == 2
+    assert report['bytes_before'] == 300 and report['bytes_after'] == 150
+    # Counted through the File API like the captioning requests themselves
+    assert fake.uploads == len(calls)
+    assert limiter.acquire.call_count == len(calls)
+
+
+def test_parse_batch_captions_validates_count_and_types():
+    assert parse_batch_captions('["Casual, linen", {"caption": "Formal, silk"}]', 2) == \
+        ["Casual, linen", "Formal, silk"]
+    for text in ('not json', '["only one"]', '{"a": 1}', '["one", 2]'):
+        with pytest.raises(BatchParseError):
+            parse_batch_captions(text, 2)
+
+
+def test_batched_captions_are_split_per_image_and_cost_less(tmp_path):
+    images = make_images(tmp_path, 8)
+
+    fake = FakeGenAI(image_tokens=258, prompt_tokens=60)
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key")
+        single = list(caption_images(images, captioner.caption, max_workers=4))
+
+    fake = FakeGenAI(image_tokens=258, prompt_tokens=60)
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key")
+        batched = list(caption_images(images, captioner.caption, max_workers=4,
+                                      batch_fn=captioner.caption_batch, batch_size=4))
+
+    assert fake.calls == 2
+    assert all(error is None for _, _, error in batched)
+    assert {result[0] for _, result, _ in batched} == {f"Caption {n}.{i}" for n in (1, 2) for i in range(1, 5)}
+    assert captioner.timings["image_0.jpg"]["batch_size"] == 4
+    single_cost = sum(result[3] for _, result, _ in single) / len(single)
+    batched_cost = sum(result[3] for _, result, _ in batched) / len(batched)
+    assert batched_cost < single_cost
+
+
+def test_batch_parse_failure_falls_back_to_single_images(tmp_path):
+    fake = FakeGenAI(malformed_batches=1)
+    images = make_images(tmp_path, 6)
+
+    with patch("caption_generating.genai", fake):
+        captioner = GeminiCaptioner("key")
+        results = list(caption_images(images, captioner.caption, max_workers=1,
+                                      batch_fn=captioner.caption_batch, batch_size=3))
+
+    assert len(results) == 6
+    assert all(error is None for _, _, error in results)
+    # One malformed batch, three single-image retries and one good batch
+    assert fake.calls == 5
+    assert sum(1 for _, result, _ in results if "." in result[0]) == 3
+
+
+def test_blocked_batch_falls_back_to_single_images(tmp_path):
+    images = make_images(tmp_path, 3)
+
+    def blocked_batch(image_files):
+        raise ValueError("The response was blocked, it has no text")
+
+    with patch("caption_generating.genai", FakeGenAI()):
+        captioner = GeminiCaptioner("key")
+        results = list(caption_images(images, captioner.caption, max_workers=1,
+                                      batch_fn=blocked_batch, batch_size=3))
+
+    assert all(error is None for _, _, error in results)
+    assert [result[0] for _, result, _ in results] == ["Caption 1", "Caption 2", "Caption 3"]
@@ -0,0 +1,41 @@
+import json
+from caption_stream import CaptionStream
+
+
+def test_stream_appends_and_reads_records(tmp_path):
+    with CaptionStream(tmp_path).open() as stream:
+        stream.append({"image_name": "a.jpg", "caption": "A"})
+        stream.append({"image_name": "b.jpg", "caption": "B"})
+        stream.append_failure({"image_name": "c.jpg", "error": "quota"})
+
+    stream = CaptionStream(tmp_path)
+    assert [record["caption"] for record in stream.read()] == ["A", "B"]
+    assert stream.processed_images() == {"a.jpg", "b.jpg"}
+    assert (tmp_path / "failed_images.jsonl").read_text().count("\n") == 1
+
+
+def test_resume_recovers_from_truncated_line(tmp_path):
+    stream_path = tmp_path / "captions.jsonl"
+    stream_path.write_text(json.dumps({"image_name": "a.jpg", "caption": "A"}) + '\n{"image_name": "b.j')
+
+    with CaptionStream(tmp_path).open(resume=True) as stream:
+        assert stream.processed_images() == {"a.jpg"}
+        stream.append({"image_name": "b.jpg", "caption": "B"})
+
+    assert CaptionStream(tmp_path).processed_images() == {"a.jpg", "b.jpg"}
+
+
+def test_open_without_resume_discards_previous_results(tmp_path):
+    with CaptionStream(tmp_path).open() as stream:
+        stream.append({"image_name": "a.jpg", "caption": "A"})
+    with CaptionStream(tmp_path).open() as stream:
+        assert stream.read() == []
+
+
+def test_checkpoint_is_written_atomically(tmp_path):
+    stream = CaptionStream(tmp_path)
+    stream.checkpoint(10, 9, 1, 20)
+    checkpoint = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert checkpoint["processed"] == 10
+    assert checkpoint["total"] == 20
+    assert not (tmp_path / "checkpoint.json.tmp").exists()
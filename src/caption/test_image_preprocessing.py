@@ -0,0 +1,34 @@
+from io import BytesIO
+from PIL import Image
+from image_preprocessing import downscale_image, prepare_images
+
+
+def save_image(path, size, fmt):
+    Image.effect_noise(size, 64).convert("RGB").save(path, format=fmt)
+
+
+def test_downscale_image_limits_longest_side():
+    buffer = BytesIO()
+    Image.new("RGB", (1600, 800), "red").save(buffer, format="PNG")
+    resized = Image.open(BytesIO(downscale_image(buffer.getvalue(), 512)))
+    assert resized.size == (512, 256)
+    assert resized.format == "JPEG"
+
+
+def test_prepare_images_in_process_pool(tmp_path):
+    large = tmp_path / "large.png"
+    small = tmp_path / "small.jpg"
+    broken = tmp_path / "broken.jpg"
+    save_image(large, (1200, 900), "PNG")
+    save_image(small, (100, 100), "JPEG")
+    broken.write_bytes(b"not an image")
+
+    prepared = prepare_images([large, small, broken], tmp_path / "prepared", 256, workers=2)
+
+    path, original_bytes, prepared_bytes = prepared[large]
+    assert Image.open(path).size == (256, 192)
+    assert prepared_bytes < original_bytes
+    # A small JPEG is never made larger by re-encoding
+    assert prepared[small][2] <= prepared[small][1]
+    # Undecodable images are passed through unchanged
+    assert prepared[broken] == (str(broken), 12, 12)
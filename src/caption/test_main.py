@@ -2,7 +2,12 @@ import os
 import shutil
 import pandas as pd
 import json
+import pytest
 from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+from PIL import Image
+from test_caption_generating import FakeGenAI
 # Replace `your_module_name` with the actual filename (without .py)
 from caption_generating import wrapper_function
 
@@ -73,5 +78,77 @@ def test_wrapper_function():
         cleanup_test_environment()
 
 
+@pytest.fixture
+def captioning(tmp_path, monkeypatch):
+    """
+    Images folder, Gemini key and caption cache under tmp_path, and a run()
+    that calls wrapper_function with a FakeGenAI patched in and returns it.
+    """
+    images_folder = tmp_path / "data"
+    images_folder.mkdir()
+    key_path = tmp_path / "gemini_key.json"
+    key_path.write_text(json.dumps({"api_key": "key"}))
+    monkeypatch.setenv("GEMINI_KEY_PATH", str(key_path))
+    monkeypatch.setattr("caption_generating.CAPTION_CACHE_DB", str(tmp_path / "cache.sqlite"))
+    output_dir = tmp_path / "output"
+
+    def run(fake=None, **kwargs):
+        fake = FakeGenAI() if fake is None else fake
+        kwargs = {"output_dir": output_dir, "max_side": 0, **kwargs}
+        with patch("caption_generating.genai", fake):
+            wrapper_function(images_folder=images_folder, **kwargs)
+        return fake
+
+    return SimpleNamespace(images_folder=images_folder, output_dir=output_dir, run=run)
+
+
+def write_images(images_folder, indices):
+    for i in indices:
+        (images_folder / f"image_{i}.jpg").write_bytes(b"\xFF\xD8\xFF" + bytes([i]))
+
+
+def test_wrapper_function_resumes_from_stream(captioning):
+    """A resumed run only captions images missing from the previous run's stream."""
+    write_images(captioning.images_folder, range(3))
+    captioning.run(use_cache=False)
+
+    write_images(captioning.images_folder, range(3, 5))
+    fake = captioning.run(use_cache=False, resume=True)
+
+    assert fake.calls == 2
+    with open(captioning.output_dir / "final_output.json") as json_file:
+        assert len(json.load(json_file)) == 5
+    assert len(pd.read_csv(captioning.output_dir / "final_output.csv")) == 5
+
+
+def test_wrapper_function_downscales_images(captioning):
+    """Large images are downscaled before captioning and the savings are reported."""
+    for i in range(3):
+        Image.effect_noise((1600, 1200), 64 + i).convert("RGB").save(captioning.images_folder / f"image_{i}.png")
+
+    captioning.run(FakeGenAI(tokens_per_kb=1), use_cache=False, max_side=256, token_sample_size=3)
+
+    with open(captioning.output_dir / "preprocessing_report.json") as report_file:
+        report = json.load(report_file)
+    assert report["images"] == 3
+    assert report["bytes_after"] < report["bytes_before"] / 10
+    assert report["sample_prompt_tokens_after"] < report["sample_prompt_tokens_before"]
+    assert report["estimated_prompt_tokens_saved"] > 0
+    # Results keep the original image names
+    assert set(pd.read_csv(captioning.output_dir / "final_output.csv")["image_name"]) == {
+        f"image_{i}.png" for i in range(3)}
+    assert not (captioning.output_dir / "prepared").exists()
+
+
+def test_wrapper_function_caches_batched_captions_separately(captioning, tmp_path):
+    """Captions from single-image and batched requests are not served for each other."""
+    write_images(captioning.images_folder, range(4))
+
+    calls = [captioning.run(output_dir=tmp_path / f"output_{run}", batch_size=batch_size).calls
+             for run, batch_size in enumerate((1, 2, 2))]
+
+    assert calls == [4, 2, 0]
+
+
 if __name__ == "__main__":
     test_wrapper_function()
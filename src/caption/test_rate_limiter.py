@@ -0,0 +1,70 @@
+import threading
+from rate_limiter import TokenBucket, RateLimiter
+
+
+class FakeClock:
+    """Manual clock whose sleep advances time instantly."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock)
+    bucket.consume(60)
+    assert bucket.wait_time(1) == 1.0
+    clock.now += 0.5
+    assert bucket.wait_time(1) == 0.5
+    clock.now += 0.5
+    assert bucket.wait_time(1) == 0.0
+
+
+def test_rate_limiter_enforces_requests_per_minute():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=2, clock=clock, sleep=clock.sleep)
+    for _ in range(4):
+        limiter.acquire()
+    # Burst of 2, then one request every 30 seconds
+    assert clock.now == 60.0
+
+
+def test_rate_limiter_enforces_tokens_per_minute():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600,
+                          clock=clock, sleep=clock.sleep)
+    limiter.acquire(300)
+    limiter.acquire(300)
+    assert clock.now == 0.0
+    limiter.acquire(300)
+    # 300 tokens refill at 10 tokens per second
+    assert clock.now == 30.0
+
+
+def test_reconcile_refunds_overestimated_tokens():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600,
+                          clock=clock, sleep=clock.sleep)
+    limiter.acquire(600)
+    limiter.reconcile(600, 100)
+    limiter.acquire(500)
+    assert clock.now == 0.0
+
+
+def test_rate_limiter_is_thread_safe():
+    limiter = RateLimiter(requests_per_minute=100000, clock=lambda: 0.0)
+    threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(100)])
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert limiter.requests.tokens == 100000 - 800
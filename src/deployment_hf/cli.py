@@ -4,14 +4,15 @@ Module to deploy a Hugging Face model (FashionCLIP) on HuggingFace.
 
 import os
 import argparse
-from google.cloud import storage
 from huggingface_hub import login, HfApi, delete_file, upload_folder, list_repo_files
 from google.cloud import secretmanager
+from artifact_sync import prepare
 import json
 
 # # uncomment for local testing
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "../../../secrets/secret.json"
 
+
 def get_secret(secret):
     client = secretmanager.SecretManagerServiceClient()
     print("-----\nFetching Key\n-----")
@@ -21,41 +22,6 @@ def get_secret(secret):
     return secret_value
 
 
-def prepare(model_path, gcp_project, gcs_bucket_name, local_artifact_path):
-    """
-    Downloads all files from a specific folder in a GCP bucket
-    and saves them locally, preserving the folder structure.
-    """
-    storage_client = storage.Client(project=gcp_project)
-    bucket = storage_client.bucket(gcs_bucket_name)
-
-    # List all blobs in the specified folder
-    blobs = bucket.list_blobs(prefix=model_path)
-
-    for blob in blobs:
-        # Remove the folder prefix to get the relative path
-        relative_path = blob.name[len(model_path) + 1:]
-
-        # Skip folder paths
-        if not relative_path:
-            continue
-
-        # Define the local file path
-        local_file_path = os.path.join(local_artifact_path, relative_path)
-
-        # Ensure the local directory exists
-        local_dir = os.path.dirname(local_file_path)
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-
-        # Download the file
-        print(f"Downloading {blob.name} to {local_file_path}...")
-        blob.download_to_filename(local_file_path)
-
-    print(
-        f"All files from {model_path} have been downloaded to {local_artifact_path}")
-
-
 def deploy(local_artifact_path, hf_token, hf_repo_name):
     result_json_path = os.path.join(local_artifact_path, "test_results.json")
     with open(result_json_path, "r") as f:
@@ -107,6 +73,9 @@ def deploy(local_artifact_path, hf_token, hf_repo_name):
 def main(args):
     print("Starting FashionCLIP deployment...")
     secret = get_secret(args.hf_token)
+    # A local source directory replaces the bucket folder
+    if args.source_dir:
+        args.model_path, args.gcs_bucket_name = args.source_dir, None
     if args.prepare:
         print("Preparing model...")
         prepare(args.model_path, args.gcp_project, args.gcs_bucket_name, args.local_artifact_path)
@@ -152,6 +121,12 @@ if __name__ == "__main__":
         default="fashionai_training",
         help="Name of the GCS bucket containing the model.",
     )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=None,
+        help="Local directory to sync the artifacts from instead of the GCS bucket.",
+    )
     parser.add_argument(
         "--local_artifact_path",
         type=str,
@@ -2,8 +2,10 @@ import pytest
 from unittest.mock import patch, MagicMock, call
 import os
 import json
+import shutil
 import argparse
 from cli import main, get_secret, prepare, deploy
+from artifact_sync import file_crc32c, file_md5
 
 
 # Mock the GCP Secret Manager get_secret function
@@ -27,7 +29,7 @@ def test_get_secret(mock_secret_manager_client):
 
 
 # Mock the GCP Storage prepare function
-@patch("cli.storage.Client")
+@patch("artifact_sync.storage.Client")
 def test_prepare(mock_storage_client):
     mock_bucket = MagicMock()
     mock_blob = MagicMock()
@@ -49,7 +51,7 @@ def test_prepare(mock_storage_client):
     # Assertions
     mock_storage_client.assert_called_once_with(project="fake_project")
     mock_client_instance.bucket.assert_called_once_with("fake_bucket")
-    mock_bucket.list_blobs.assert_called_once_with(prefix="finetuned-fashionclip")
+    mock_bucket.list_blobs.assert_called_once_with(prefix="finetuned-fashionclip/")
 
 
 @patch("cli.list_repo_files", return_value=["README.md"])
@@ -104,6 +106,7 @@ def test_main(mock_deploy, mock_prepare, mock_get_secret):
         gcp_project="fake_project",
         gcs_bucket_name="fake_bucket",
         local_artifact_path="./fake_artifacts",
+        source_dir=None,
         hf_token="fake_hf_secret",
         hf_repo_name="fake_repo",
     )
@@ -120,3 +123,99 @@ def test_main(mock_deploy, mock_prepare, mock_get_secret):
         "./fake_artifacts",
     )
     mock_deploy.assert_not_called()
+
+
+def test_prepare_from_local_directory_syncs_only_differences(tmp_path):
+    source = tmp_path / "model"
+    (source / "nested").mkdir(parents=True)
+    (source / "config.json").write_text('{"a": 1}')
+    (source / "nested" / "weights.bin").write_bytes(b"w" * 64)
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "old_weights.bin").write_bytes(b"stale")
+
+    prepare(str(source), "fake_project", None, str(artifacts))
+
+    assert sorted(str(path.relative_to(artifacts)) for path in artifacts.rglob("*") if path.is_file()) == \
+        ["config.json", os.path.join("nested", "weights.bin")]
+    assert (artifacts / "nested" / "weights.bin").read_bytes() == b"w" * 64
+
+    (source / "config.json").write_text('{"a": 2}')
+    with patch("artifact_sync.shutil.copyfile", wraps=shutil.copyfile) as copyfile:
+        prepare(str(source), "fake_project", None, str(artifacts))
+
+    copyfile.assert_called_once_with(str(source / "config.json"), str(artifacts / "config.json"))
+    assert (artifacts / "config.json").read_text() == '{"a": 2}'
+
+
+@patch("artifact_sync.storage.Client")
+def test_prepare_downloads_only_blobs_that_differ(mock_storage_client, tmp_path):
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "config.json").write_text('{"a": 1}')
+    (artifacts / "tokenizer.json").write_text("{}")
+    (artifacts / "weights.bin").write_bytes(b"old")
+
+    def make_blob(name, content, crc32c=True):
+        path = tmp_path / "checksum"
+        path.write_bytes(content)
+        blob = MagicMock()
+        blob.name = f"finetuned-fashionclip/{name}"
+        blob.size = len(content)
+        blob.crc32c = file_crc32c(str(path)) if crc32c else None
+        blob.md5_hash = file_md5(str(path))
+        return blob
+
+    config = make_blob("config.json", b'{"a": 1}')
+    tokenizer = make_blob("tokenizer.json", b"{}", crc32c=False)
+    weights = make_blob("weights.bin", b"new")
+    folder = MagicMock()
+    folder.name = "finetuned-fashionclip/"
+    mock_storage_client.return_value.bucket.return_value.list_blobs.return_value = [folder, config, tokenizer,
+                                                                                    weights]
+
+    prepare("finetuned-fashionclip", "fake_project", "fake_bucket", str(artifacts), workers=2)
+
+    config.download_to_filename.assert_not_called()
+    tokenizer.download_to_filename.assert_not_called()
+    weights.download_to_filename.assert_called_once_with(str(artifacts / "weights.bin"))
+
+
+@patch("artifact_sync.storage.Client")
+def test_prepare_keeps_artifacts_when_the_folder_is_empty(mock_storage_client, tmp_path):
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "weights.bin").write_bytes(b"w")
+    mock_storage_client.return_value.bucket.return_value.list_blobs.return_value = []
+
+    with pytest.raises(FileNotFoundError):
+        prepare("finetuned-fashionclip", "fake_project", "fake_bucket", str(artifacts))
+    with pytest.raises(FileNotFoundError):
+        prepare(str(tmp_path / "missing"), "fake_project", None, str(artifacts))
+
+    assert (artifacts / "weights.bin").read_bytes() == b"w"
+
+
+def test_prepare_only_checksums_sources_whose_size_matches(tmp_path):
+    source = tmp_path / "model"
+    source.mkdir()
+    (source / "weights.bin").write_bytes(b"w" * 64)
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "weights.bin").write_bytes(b"old")
+
+    with patch("artifact_sync.file_crc32c", wraps=file_crc32c) as crc32c:
+        prepare(str(source), "fake_project", None, str(artifacts))
+    crc32c.assert_not_called()
+
+    with patch("artifact_sync.file_crc32c", wraps=file_crc32c) as crc32c:
+        prepare(str(source), "fake_project", None, str(artifacts))
+    assert crc32c.call_count == 2
+
+
+def test_trainer_copy_of_artifact_sync_is_identical():
+    trainer_copy = os.path.join(os.path.dirname(__file__), "..", "finetune", "package", "trainer", "artifact_sync.py")
+    if not os.path.exists(trainer_copy):
+        pytest.skip("the trainer package is not next to this service")
+    with open(trainer_copy, "rb") as f, open(os.path.join(os.path.dirname(__file__), "artifact_sync.py"), "rb") as g:
+        assert f.read() == g.read()
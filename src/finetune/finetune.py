@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import torch
 import wandb
 import argparse
@@ -40,6 +41,8 @@ def parse_args():
                         default=5e-6, help="Learning rate for optimizer")
     parser.add_argument('--epochs', type=int, default=3,
                         help="Number of epochs to train for")
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="DataLoader worker processes")
     parser.add_argument('--project', type=str,
                         default="fashion-clip-finetuning_milestone2", help="Wandb project name")
     return parser.parse_args()
@@ -56,56 +59,76 @@ sweep_config = {
 }
 
 
-def sweep_train():
-    args = parse_args()
+# Custom Dataset for FashionCLIP, with captions tokenized once up front.
+# Defined at module level so DataLoader workers can pickle it.
+class FashionDataset(Dataset):
+    def __init__(self, json_file, image_dir, tokenizer, transform=None):
+        with open(json_file, 'r') as f:
+            self.data = json.load(f)
+        self.image_dir = image_dir
+        self.transform = transform
+        self.tokens = tokenizer([item['caption'] for item in self.data], padding="max_length",
+                                truncation=True, max_length=77, return_tensors="pt")
 
-    # Initialize wandb for tracking experiments
-    wandb.init(config=args)  # Now sweep config will override the defaults
-    config = wandb.config
+    def __len__(self):
+        return len(self.data)
 
-    # Custom Dataset for FashionCLIP
-    class FashionDataset(Dataset):
-        def __init__(self, json_file, image_dir, transform=None):
-            with open(json_file, 'r') as f:
-                self.data = json.load(f)
-            self.image_dir = image_dir
-            self.transform = transform
+    def __getitem__(self, idx):
+        item = self.data[idx]
+        image_path = os.path.join(self.image_dir, item['image'])
+        image = Image.open(image_path).convert('RGB')
 
-        def __len__(self):
-            return len(self.data)
+        if self.transform:
+            image = self.transform(image)
 
-        def __getitem__(self, idx):
-            item = self.data[idx]
-            image_path = os.path.join(self.image_dir, item['image'])
-            image = Image.open(image_path).convert('RGB')
+        return image, self.tokens["input_ids"][idx], self.tokens["attention_mask"][idx]
 
-            if self.transform:
-                image = self.transform(image)
 
-            text = item['caption']
-            return image, text
+def collate(batch):
+    # Drop padding columns no caption in the batch uses
+    images, input_ids, attention_mask = (torch.stack(column) for column in zip(*batch))
+    length = int(attention_mask.sum(dim=1).max())
+    return images, input_ids[:, :length], attention_mask[:, :length]
 
-    # Define image transformations
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-    ])
 
-    # Load dataset and create DataLoader
-    train_dataset = FashionDataset(
-        json_file=args.json_file, image_dir=args.image_dir, transform=transform)
-    train_loader = DataLoader(
-        train_dataset, batch_size=config.batch_size, shuffle=True)
+def elapsed(start):
+    # CUDA runs asynchronously, so wait for queued work before reading the clock
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def sweep_train():
+    args = parse_args()
+
+    # Initialize wandb for tracking experiments
+    wandb.init(config=args)  # Now sweep config will override the defaults
+    config = wandb.config
 
     # Load pre-trained FashionCLIP model and processor
     model = CLIPModel.from_pretrained("patrickjohncyh/fashion-clip")
     processor = CLIPProcessor.from_pretrained("patrickjohncyh/fashion-clip")
 
+    # Define image transformations; normalizing here runs it in the loader workers
+    transform = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=processor.image_processor.image_mean,
+                             std=processor.image_processor.image_std),
+    ])
+
     # Move model to GPU if available
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
     model.to(device)
 
+    # Load dataset and create DataLoader
+    train_dataset = FashionDataset(
+        json_file=args.json_file, image_dir=args.image_dir, tokenizer=processor.tokenizer, transform=transform)
+    train_loader = DataLoader(
+        train_dataset, batch_size=config.batch_size, shuffle=True, num_workers=args.num_workers,
+        pin_memory=device.type == "cuda", persistent_workers=args.num_workers > 0, collate_fn=collate)
+
     # Define optimizer for fine-tuning
     optimizer = AdamW(model.parameters(), lr=config.learning_rate)
 
@@ -117,29 +140,34 @@ def sweep_train():
         # Initialize the progress bar for the current epoch
         progress_bar = tqdm(enumerate(train_loader), total=len(
             train_loader), desc=f"Epoch {epoch+1}/{config.epochs}")
+        timings = {"data": 0.0, "forward": 0.0, "backward": 0.0}
+        step_start = time.perf_counter()
 
-        for batch_idx, (images, texts) in progress_bar:
-            images = images.to(device)
-            inputs = processor(text=texts, images=images, return_tensors="pt", padding=True,
-                               truncation=True, max_length=77, do_rescale=False).to(device)
+        for batch_idx, (pixel_values, input_ids, attention_mask) in progress_bar:
+            timings["data"] += elapsed(step_start)
 
-            # Forward pass
-            outputs = model(**inputs)
+            # Forward pass on ready tensors
+            start = time.perf_counter()
+            outputs = model(pixel_values=pixel_values.to(device, non_blocking=True),
+                            input_ids=input_ids.to(device, non_blocking=True),
+                            attention_mask=attention_mask.to(device, non_blocking=True))
             logits_per_image = outputs.logits_per_image
             logits_per_text = outputs.logits_per_text
 
             # Compute loss
-            loss_image = torch.nn.functional.cross_entropy(
-                logits_per_image, torch.arange(len(images), device=device))
-            loss_text = torch.nn.functional.cross_entropy(
-                logits_per_text, torch.arange(len(texts), device=device))
+            labels = torch.arange(len(logits_per_image), device=device)
+            loss_image = torch.nn.functional.cross_entropy(logits_per_image, labels)
+            loss_text = torch.nn.functional.cross_entropy(logits_per_text, labels)
             loss = (loss_image + loss_text) / 2
-            total_loss += loss.item()
+            timings["forward"] += elapsed(start)
 
             # Backpropagation
+            start = time.perf_counter()
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
+            timings["backward"] += elapsed(start)
+            total_loss += loss.item()
 
             # Update progress bar description with loss
             progress_bar.set_postfix(loss=loss.item())
@@ -148,9 +176,13 @@ def sweep_train():
             if batch_idx % 10 == 0:
                 wandb.log(
                     {"epoch": epoch, "batch_idx": batch_idx, "loss": loss.item()})
+            step_start = time.perf_counter()
 
         average_loss = total_loss / len(train_loader)
-        wandb.log({"epoch": epoch, "avg_loss": average_loss})
+        # Mean milliseconds per step spent waiting for data, in forward and in backward
+        step_profile = {f"{phase}_ms": 1000 * seconds / len(train_loader) for phase, seconds in timings.items()}
+        print(f"Epoch {epoch+1} step profile: {step_profile}")
+        wandb.log({"epoch": epoch, "avg_loss": average_loss, **step_profile})
 
     # Save the fine-tuned FashionCLIP model and processor with hyperparameters in the filename
     model_save_name = f"fine_tuned_fashionclip_bs{config.batch_size}_lr{config.learning_rate}_ep{config.epochs}"
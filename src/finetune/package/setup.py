@@ -11,6 +11,7 @@ REQUIRED_PACKAGES = [
     "fashion-clip",
     "google-cloud-secret-manager",
     "huggingface_hub",
+    "safetensors",
     "google-cloud-aiplatform"
 
 ]
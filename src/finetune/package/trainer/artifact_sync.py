@@ -0,0 +1,132 @@
+"""
+Module to sync the model artifacts from a GCS bucket folder, or a local
+directory, into a local folder before they are deployed.
+
+Shared by the deployment_hf CLI and trainer.deploy, which are built from
+separate folders: src/finetune/package/trainer/artifact_sync.py must stay an
+identical copy of src/deployment_hf/artifact_sync.py.
+"""
+
+import os
+import base64
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import google_crc32c
+from google.cloud import storage
+
+# Concurrent downloads when syncing the artifacts
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "8"))
+
+
+def file_crc32c(path, block_size=2 ** 20):
+    """Base64 CRC32C of a file, in the form GCS reports for blobs."""
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode()
+
+
+def file_md5(path, block_size=2 ** 20):
+    """Base64 MD5 of a file, in the form GCS reports for blobs."""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+
+def is_up_to_date(local_file_path, size, crc32c=None, md5_hash=None):
+    """
+    Whether a local file matches a remote one: same size, then same CRC32C,
+    or MD5 when the remote has no CRC32C. Checksums are only computed when
+    the sizes match; crc32c may be a callable so the remote side's checksum
+    is also only computed then.
+    """
+    if not os.path.isfile(local_file_path) or os.path.getsize(local_file_path) != size:
+        return False
+    if callable(crc32c):
+        crc32c = crc32c()
+    if crc32c:
+        return file_crc32c(local_file_path) == crc32c
+    if md5_hash:
+        return file_md5(local_file_path) == md5_hash
+    return False
+
+
+def relative_files(directory):
+    """Paths relative to directory, with / separators, of every file under it."""
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), directory).replace(os.sep, "/"))
+    return files
+
+
+def delete_stale(local_artifact_path, sources):
+    """
+    Deletes the files under local_artifact_path that are not in sources, so
+    stale weights are never deployed. Returns the deleted relative paths.
+    prepare refuses to get here with no sources, which would clear the folder.
+    """
+    stale = [relative_path for relative_path in relative_files(local_artifact_path) if relative_path not in sources]
+    for relative_path in stale:
+        os.remove(os.path.join(local_artifact_path, relative_path))
+        print(f"Deleted stale {relative_path}")
+    return stale
+
+
+def prepare(model_path, gcp_project, gcs_bucket_name, local_artifact_path, workers=SYNC_WORKERS):
+    """
+    Syncs local_artifact_path with a specific folder in a GCP bucket,
+    preserving the folder structure. Only files whose size and checksum
+    differ from the local copy are downloaded, in parallel, and local files
+    that are no longer in the folder are deleted. With gcs_bucket_name None,
+    model_path is a local directory to sync from instead.
+    """
+    if gcs_bucket_name is None:
+        sources = {relative_path: os.path.join(model_path, relative_path)
+                   for relative_path in relative_files(model_path)}
+        changed = [relative_path for relative_path, source_path in sources.items()
+                   if not is_up_to_date(os.path.join(local_artifact_path, relative_path),
+                                        os.path.getsize(source_path),
+                                        crc32c=lambda source_path=source_path: file_crc32c(source_path))]
+    else:
+        storage_client = storage.Client(project=gcp_project)
+        bucket = storage_client.bucket(gcs_bucket_name)
+
+        # List all blobs in the specified folder, keyed by their path relative to it.
+        # The trailing / keeps sibling folders sharing the name as a prefix out
+        prefix = model_path.rstrip("/") + "/"
+        sources = {}
+        for blob in bucket.list_blobs(prefix=prefix):
+            relative_path = blob.name[len(prefix):]
+            # Skip folder paths
+            if relative_path and not relative_path.endswith("/"):
+                sources[relative_path] = blob
+        changed = [relative_path for relative_path, blob in sources.items()
+                   if not is_up_to_date(os.path.join(local_artifact_path, relative_path),
+                                        blob.size, blob.crc32c, blob.md5_hash)]
+
+    # An empty listing is a wrong path or bucket, not a request to delete every artifact
+    if not sources:
+        raise FileNotFoundError(f"No artifacts found under {model_path}")
+
+    def download(relative_path):
+        local_file_path = os.path.join(local_artifact_path, relative_path)
+        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+        print(f"Downloading {relative_path} to {local_file_path}...")
+        if gcs_bucket_name is None:
+            shutil.copyfile(sources[relative_path], local_file_path)
+        else:
+            sources[relative_path].download_to_filename(local_file_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failed download
+        list(executor.map(download, changed))
+
+    stale = delete_stale(local_artifact_path, sources)
+
+    print(f"Synced {model_path} to {local_artifact_path}: {len(changed)} downloaded, "
+          f"{len(sources) - len(changed)} unchanged, {len(stale)} deleted")
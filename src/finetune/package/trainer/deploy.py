@@ -4,9 +4,9 @@ Module to deploy a Hugging Face model (FashionCLIP) on HuggingFace.
 
 import os
 import argparse
-from google.cloud import storage
 from huggingface_hub import login, HfApi, delete_file, upload_folder, list_repo_files
 from google.cloud import secretmanager
+from trainer.artifact_sync import prepare
 
 
 # # uncomment for local testing
@@ -22,41 +22,6 @@ def get_secret(secret):
     return secret_value
 
 
-def prepare(model_path, gcp_project, gcs_bucket_name, local_artifact_path):
-    """
-    Downloads all files from a specific folder in a GCP bucket
-    and saves them locally, preserving the folder structure.
-    """
-    storage_client = storage.Client(project=gcp_project)
-    bucket = storage_client.bucket(gcs_bucket_name)
-
-    # List all blobs in the specified folder
-    blobs = bucket.list_blobs(prefix=model_path)
-
-    for blob in blobs:
-        # Remove the folder prefix to get the relative path
-        relative_path = blob.name[len(model_path) + 1:]
-
-        # Skip folder paths
-        if not relative_path:
-            continue
-
-        # Define the local file path
-        local_file_path = os.path.join(local_artifact_path, relative_path)
-
-        # Ensure the local directory exists
-        local_dir = os.path.dirname(local_file_path)
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-
-        # Download the file
-        print(f"Downloading {blob.name} to {local_file_path}...")
-        blob.download_to_filename(local_file_path)
-
-    print(
-        f"All files from {model_path} have been downloaded to {local_artifact_path}")
-
-
 def deploy(local_artifact_path, hf_token, hf_repo_name):
     login(token=hf_token)
 
@@ -96,6 +61,9 @@ def deploy(local_artifact_path, hf_token, hf_repo_name):
 def main(args):
     print("Starting FashionCLIP deployment...")
     secret = get_secret(args.hf_token)
+    # A local source directory replaces the bucket folder
+    if args.source_dir:
+        args.model_path, args.gcs_bucket_name = args.source_dir, None
     if args.prepare:
         print("Preparing model...")
         prepare(args.model_path, args.gcp_project, args.gcs_bucket_name, args.local_artifact_path)
@@ -141,6 +109,12 @@ if __name__ == "__main__":
         default="vertexai_train",
         help="Name of the GCS bucket containing the model.",
     )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=None,
+        help="Local directory to sync the artifacts from instead of the GCS bucket.",
+    )
     parser.add_argument(
         "--local_artifact_path",
         type=str,
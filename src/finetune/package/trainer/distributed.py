@@ -0,0 +1,102 @@
+"""
+Multi-process data-parallel training over torch.distributed.
+
+Each process trains on its own shard of the data (DistributedSampler) and
+gradients are averaged with one all-reduce before every optimizer step.
+The all-reduce works on the trainable parameters directly rather than
+through DistributedDataParallel, so it also covers the cached-feature
+forward pass, which only runs parts of the model.
+
+Processes are started either by torchrun (RANK/WORLD_SIZE in the
+environment) or by run_distributed, which spawns N local processes on one
+machine. The gloo backend runs on CPU, so every core of a large VM can be
+used and the mode can be tested on a single Linux box.
+"""
+
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend="gloo"):
+    """
+    Joins the process group described by the RANK/WORLD_SIZE environment,
+    if any. Returns (rank, world_size); (0, 1) when running alone.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend=backend, rank=int(os.environ["RANK"]), world_size=world_size)
+        # Share the cores between the processes instead of oversubscribing them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    return get_rank(), get_world_size()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_parameters(model):
+    """Copies rank 0's weights to every process, e.g. after random LoRA initialization."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src=0)
+
+
+def all_reduce_gradients(params):
+    """Averages the gradients of params across processes with a single flattened all-reduce."""
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = [param.grad for param in params if param.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _spawned_worker(rank, fn, world_size, port, args):
+    os.environ.update({"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(world_size),
+                       "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port)})
+    fn(*args)
+
+
+def run_distributed(fn, world_size, *args):
+    """Runs fn(*args) in world_size local processes that form one process group."""
+    mp.spawn(_spawned_worker, args=(fn, world_size, free_port(), args), nprocs=world_size, join=True)
@@ -0,0 +1,214 @@
+"""
+Retrieval evaluation for FashionCLIP checkpoints.
+
+For every category in DIR_DICT the captions and images are encoded once
+(and cached on disk), then ranked against each other in both directions:
+text->image and image->text Recall@1/5/10, MRR and median rank. The JSON
+report also records encode throughput and search latency, so finetuned
+checkpoints can be compared on speed and quality before deploying.
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from transformers import CLIPModel, CLIPProcessor
+
+from trainer.feature_cache import weights_fingerprint
+from trainer.task import DIR_DICT, ImageDataset, encode_images, encode_texts, prepare_category_data
+
+RECALL_KS = (1, 5, 10)
+
+
+def match_ranks(similarity):
+    """
+    1-based rank of the matching item for every query, where query i matches
+    gallery item i and similarity has shape (queries, gallery).
+    """
+    target_scores = similarity.diagonal().unsqueeze(1)
+    return (similarity > target_scores).sum(dim=1) + 1
+
+
+def rank_metrics(ranks, ks=RECALL_KS):
+    """Recall@K, MRR and median rank from the ranks of the matching items."""
+    ranks = ranks.float()
+    metrics = {f"recall@{k}": (ranks <= k).float().mean().item() for k in ks}
+    metrics["mrr"] = (1.0 / ranks).mean().item()
+    metrics["median_rank"] = ranks.median().item()
+    metrics["queries"] = len(ranks)
+    return metrics
+
+
+def retrieval_metrics(similarity, ks=RECALL_KS):
+    """Metrics of paired queries against their gallery."""
+    return rank_metrics(match_ranks(similarity), ks)
+
+
+def search_latency(query_embeddings, gallery_embeddings, k=max(RECALL_KS), max_queries=100):
+    """Milliseconds to score and rank the gallery for one query, timed over up to max_queries queries."""
+    timings = []
+    k = min(k, len(gallery_embeddings))
+    with torch.no_grad():
+        for query in query_embeddings[:max_queries]:
+            start = time.perf_counter()
+            (gallery_embeddings @ query).topk(k)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings = torch.tensor(timings)
+    return {
+        "mean_ms": timings.mean().item(),
+        "p50_ms": timings.quantile(0.5).item(),
+        "p95_ms": timings.quantile(0.95).item(),
+    }
+
+
+def evaluate_embeddings(text_embeddings, image_embeddings):
+    """Both retrieval directions for paired, L2-normalised caption and image embeddings."""
+    similarity = text_embeddings @ image_embeddings.T
+    return {
+        "text_to_image": retrieval_metrics(similarity),
+        "image_to_text": retrieval_metrics(similarity.T),
+        "search_latency": search_latency(text_embeddings, image_embeddings),
+    }
+
+
+def compute_embeddings(model, processor, json_file, image_dir, device, n_samples=None, batch_size=32):
+    """Encodes the first n_samples caption/image pairs, timing each encoder."""
+    transform = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+    ])
+    dataset = ImageDataset(total_test_cases=n_samples, json_file=json_file, image_dir=image_dir,
+                           transform=transform, n_samples=n_samples)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+    start = time.perf_counter()
+    image_embeddings, image_paths = encode_images(model, processor, loader, device)
+    image_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text_embeddings = encode_texts(model, processor, [item['caption'] for item in dataset.data], device,
+                                   batch_size)
+    text_seconds = time.perf_counter() - start
+
+    return {
+        "text_embeddings": text_embeddings.cpu(),
+        "image_embeddings": image_embeddings.cpu(),
+        "image_names": [os.path.basename(path) for path in image_paths],
+        "throughput": {
+            "images_per_second": len(image_paths) / image_seconds if image_seconds else None,
+            "texts_per_second": len(dataset.data) / text_seconds if text_seconds else None,
+        },
+    }
+
+
+def cached_embeddings(cache_dir, model_name, category, n_samples, compute, weights=None, json_file=None):
+    """
+    Loads the embeddings of a category for a model from cache_dir, calling
+    compute() and saving its result on a miss. Entries are keyed by the
+    weights fingerprint and the caption file's mtime as well, so retrained
+    weights or recaptioned data are encoded again; without a fingerprint
+    nothing is cached.
+    """
+    if weights is None:
+        print(f"No weights file found for {model_name}, not caching its embeddings")
+        return compute(), False
+    json_mtime = os.path.getmtime(json_file) if json_file else None
+    source_key = hashlib.sha256(f"{weights}/{json_mtime}".encode()).hexdigest()[:16]
+    model_key = model_name.strip("/").replace("/", "__")
+    cache_path = os.path.join(cache_dir, model_key, f"{category}_{n_samples or 'all'}_{source_key}.pt")
+    if os.path.exists(cache_path):
+        print(f"Using cached embeddings from {cache_path}")
+        return torch.load(cache_path), True
+    embeddings = compute()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    torch.save(embeddings, cache_path)
+    return embeddings, False
+
+
+def evaluate_categories(model, processor, model_name, categories, device, cache_dir, n_samples=None,
+                        batch_size=32, data_source=None):
+    """
+    Evaluates every category and an overall entry pooling the per-category
+    ranks. data_source(category, n_samples) returns the local (json_file,
+    image_dir).
+    """
+    data_source = data_source or prepare_category_data
+    report = {"model_name": model_name, "n_samples": n_samples, "categories": {}}
+    all_ranks = {"text_to_image": [], "image_to_text": []}
+    weights = weights_fingerprint(model_name)
+
+    for category in categories:
+        json_file, image_dir = data_source(category, n_samples)
+        embeddings, from_cache = cached_embeddings(
+            cache_dir, model_name, category, n_samples,
+            lambda: compute_embeddings(model, processor, json_file, image_dir, device, n_samples, batch_size),
+            weights, json_file)
+
+        text_embeddings = embeddings["text_embeddings"]
+        image_embeddings = embeddings["image_embeddings"]
+        result = evaluate_embeddings(text_embeddings, image_embeddings)
+        result["throughput"] = embeddings["throughput"]
+        result["embeddings_cached"] = from_cache
+        report["categories"][category] = result
+
+        similarity = text_embeddings @ image_embeddings.T
+        all_ranks["text_to_image"].append(match_ranks(similarity))
+        all_ranks["image_to_text"].append(match_ranks(similarity.T))
+        print(f"{category}: {json.dumps(result['text_to_image'])}")
+
+    # Ranks stay within each category; the overall entry averages over every query
+    report["overall"] = {}
+    for direction, ranks in all_ranks.items():
+        if ranks:
+            report["overall"][direction] = rank_metrics(torch.cat(ranks))
+    return report
+
+
+def write_report(report, output_file):
+    folder = os.path.dirname(output_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Evaluation report saved to {output_file}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="weiyueli7/fclip_men_accessories",
+                        help="Hugging Face name or local path of the checkpoint to evaluate.")
+    parser.add_argument("--categories", type=str, nargs="+", default=list(DIR_DICT),
+                        help="Categories of DIR_DICT to evaluate.")
+    parser.add_argument("--n_samples", type=int, default=None,
+                        help="Caption/image pairs per category, all of them by default.")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--data_root", type=str, default=None,
+                        help="Local copy of the data buckets to read instead of GCS.")
+    parser.add_argument("--cache_dir", type=str, default="embedding_cache")
+    parser.add_argument("--output_file", type=str, default="evaluation/retrieval_report.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    processor = CLIPProcessor.from_pretrained(args.model_name)
+    processor.image_processor.do_rescale = False
+    model = CLIPModel.from_pretrained(args.model_name).to(device)
+    model.eval()
+
+    def data_source(category, n_samples):
+        return prepare_category_data(category, n_samples, args.data_root)
+
+    report = evaluate_categories(model, processor, args.model_name, args.categories, device,
+                                 args.cache_dir, args.n_samples, args.batch_size, data_source)
+    write_report(report, args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Cached frozen-tower features for FashionCLIP finetuning.
+
+When a tower is frozen its pooled output is the same in every epoch, so it
+is computed once and stored memory-mapped:
+
+    image_features.npy  float32 (N, vision hidden), when the vision tower is frozen
+    text_features.npy   float32 (N, text hidden), when the text tower is frozen too
+    input_ids.npy       int64 (N, max_length), for training the text tower
+    attention_mask.npy  int64 (N, max_length)
+    meta.json           model, its weights, training mode and source, to detect stale caches
+
+Later epochs only run the trainable parts: the projections, and the text
+tower unless it is cached as well.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+from huggingface_hub import try_to_load_from_cache
+from torch.utils.data import Dataset
+
+from trainer.tensor_cache import is_cache_valid
+
+# Which towers are frozen, and therefore cacheable, in each training mode
+FROZEN_TOWERS = {
+    "frozen_vision": ("vision",),
+    "projection": ("vision", "text"),
+}
+# Weights files of a checkpoint, in the order from_pretrained looks for them
+WEIGHTS_FILES = ("model.safetensors", "pytorch_model.bin")
+
+
+def weights_fingerprint(model_name):
+    """
+    Size and modification time of a checkpoint's weights file, in a local
+    directory or the Hugging Face cache, or None when it cannot be found.
+    """
+    for weights_file in WEIGHTS_FILES:
+        if os.path.isdir(model_name):
+            path = os.path.join(model_name, weights_file)
+        else:
+            path = try_to_load_from_cache(model_name, weights_file)
+        if isinstance(path, str) and os.path.exists(path):
+            stat = os.stat(path)
+            return f"{weights_file}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+def feature_cache_meta(model_name, json_file, n_samples, count):
+    return {
+        "model_name": model_name,
+        # A retrained checkpoint under the same name changes the frozen towers' features
+        "weights": weights_fingerprint(model_name),
+        "json_file": os.path.abspath(json_file),
+        "json_mtime": os.path.getmtime(json_file),
+        "n_samples": n_samples,
+        "count": count,
+    }
+
+
+def build_feature_cache(model, dataloader, cache_dir, device, towers, meta):
+    """
+    Runs the frozen towers once over dataloader, which must not shuffle, and
+    writes their pooled features into cache_dir unless an up-to-date cache
+    is already there. Returns cache_dir.
+    """
+    meta = dict(meta, towers=list(towers))
+    if is_cache_valid(cache_dir, meta):
+        print(f"Feature cache at {cache_dir} is up to date")
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    count = len(dataloader.dataset)
+    max_length = dataloader.dataset[0][1].shape[0]
+    print(f"Caching {' and '.join(towers)} features of {count} samples into {cache_dir}...")
+
+    arrays = {
+        "input_ids": np.lib.format.open_memmap(os.path.join(cache_dir, "input_ids.npy"), mode="w+",
+                                               dtype=np.int64, shape=(count, max_length)),
+        "attention_mask": np.lib.format.open_memmap(os.path.join(cache_dir, "attention_mask.npy"), mode="w+",
+                                                    dtype=np.int64, shape=(count, max_length)),
+        "image_features": np.lib.format.open_memmap(os.path.join(cache_dir, "image_features.npy"), mode="w+",
+                                                    dtype=np.float32,
+                                                    shape=(count, model.config.vision_config.hidden_size)),
+    }
+    if "text" in towers:
+        arrays["text_features"] = np.lib.format.open_memmap(
+            os.path.join(cache_dir, "text_features.npy"), mode="w+", dtype=np.float32,
+            shape=(count, model.config.text_config.hidden_size))
+
+    model.eval()
+    offset = 0
+    with torch.no_grad():
+        for pixel_values, input_ids, attention_mask in dataloader:
+            end = offset + len(pixel_values)
+            # Keep the full padded width; batches are trimmed again when training
+            padded_ids = torch.nn.functional.pad(input_ids, (0, max_length - input_ids.shape[1]))
+            padded_mask = torch.nn.functional.pad(attention_mask, (0, max_length - attention_mask.shape[1]))
+            arrays["input_ids"][offset:end] = padded_ids.numpy()
+            arrays["attention_mask"][offset:end] = padded_mask.numpy()
+            image_features = model.vision_model(pixel_values=pixel_values.to(device)).pooler_output
+            arrays["image_features"][offset:end] = image_features.float().cpu().numpy()
+            if "text" in towers:
+                text_features = model.text_model(input_ids=input_ids.to(device),
+                                                 attention_mask=attention_mask.to(device)).pooler_output
+                arrays["text_features"][offset:end] = text_features.float().cpu().numpy()
+            offset = end
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    # meta.json is written last, so an interrupted build is rebuilt next time
+    meta["count"] = count
+    with open(os.path.join(cache_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+    return cache_dir
+
+
+class FeatureDataset(Dataset):
+    """Serves dicts of cached features and token ids from a feature cache, memory-mapped."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.names = ["image_features", "input_ids", "attention_mask"]
+        if "text" in self.meta["towers"]:
+            self.names.append("text_features")
+        self.arrays = None
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __getitem__(self, idx):
+        if self.arrays is None:
+            # Copy-on-write maps give writable arrays without touching the files
+            self.arrays = {name: np.load(os.path.join(self.cache_dir, f"{name}.npy"), mmap_mode="c")
+                           for name in self.names}
+        return {name: torch.from_numpy(array[idx]) for name, array in self.arrays.items()}
+
+
+def collate_features(batch):
+    """Stacks feature samples and drops padding columns no caption in the batch uses."""
+    batch = {name: torch.stack([item[name] for item in batch]) for name in batch[0]}
+    length = int(batch["attention_mask"].sum(dim=1).max())
+    batch["input_ids"] = batch["input_ids"][:, :length]
+    batch["attention_mask"] = batch["attention_mask"][:, :length]
+    return batch
+
+
+def cached_feature_embeddings(model, batch, device):
+    """
+    Projected (image_embeds, text_embeds) from cached frozen-tower features,
+    running only the projections and any tower that is still trained.
+    """
+    image_embeds = model.visual_projection(batch["image_features"].to(device, non_blocking=True))
+    if "text_features" in batch:
+        text_features = batch["text_features"].to(device, non_blocking=True)
+    else:
+        text_features = model.text_model(input_ids=batch["input_ids"].to(device, non_blocking=True),
+                                         attention_mask=batch["attention_mask"].to(device, non_blocking=True)
+                                         ).pooler_output
+    return image_embeds, model.text_projection(text_features)
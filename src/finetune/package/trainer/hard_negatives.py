@@ -0,0 +1,142 @@
+"""
+Hard-negative mining for FashionCLIP finetuning.
+
+Random batches mostly contrast unrelated items, such as a sneaker against a
+handbag, which the model already tells apart. Here the training set is
+embedded with the current weights, every item's nearest neighbours are
+looked up, and batches are assembled from small clusters of similar items,
+so each caption has to be told apart from look-alike images.
+
+The neighbour index is rebuilt from fresh embeddings every few hundred
+steps, as the embedding space moves during training. Small training sets use
+an exact similarity search; larger ones use an Annoy index.
+"""
+
+import random
+import torch
+from torch.utils.data import Sampler
+
+MINING_SPACES = ("image", "text", "joint")
+# Above this many items the exact N x N similarity search gets expensive
+EXACT_SEARCH_LIMIT = 20000
+ANNOY_TREES = 50
+
+
+def mining_embeddings(image_embeds, text_embeds, space="joint"):
+    """The L2-normalised embeddings neighbours are searched in; joint averages the image and text similarities."""
+    if space not in MINING_SPACES:
+        raise ValueError(f"Unknown mining space {space!r}, expected one of {MINING_SPACES}")
+    if space == "image":
+        return image_embeds
+    if space == "text":
+        return text_embeds
+    return torch.cat([image_embeds, text_embeds], dim=1) / 2 ** 0.5
+
+
+def exact_neighbours(embeddings, k, chunk_size=1024):
+    """The k most similar other items of every item, by cosine similarity, as lists of indices."""
+    k = min(k, len(embeddings) - 1)
+    neighbours = []
+    for start in range(0, len(embeddings), chunk_size):
+        similarity = embeddings[start:start + chunk_size] @ embeddings.T
+        rows = torch.arange(len(similarity))
+        similarity[rows, rows + start] = float("-inf")
+        neighbours.extend(similarity.topk(k, dim=1).indices.tolist())
+    return neighbours
+
+
+def annoy_neighbours(embeddings, k, n_trees=ANNOY_TREES):
+    """Approximate exact_neighbours from an Annoy index, for training sets too large to compare pairwise."""
+    # Imported here since only large training sets need it
+    from annoy import AnnoyIndex
+
+    index = AnnoyIndex(embeddings.shape[1], "angular")
+    for idx, vector in enumerate(embeddings.tolist()):
+        index.add_item(idx, vector)
+    index.build(n_trees)
+    return [[neighbour for neighbour in index.get_nns_by_item(idx, k + 1) if neighbour != idx][:k]
+            for idx in range(len(embeddings))]
+
+
+def build_neighbour_index(embeddings, k, exact_limit=EXACT_SEARCH_LIMIT):
+    """Neighbour lists of every item, searched exactly for small sets and with Annoy above exact_limit items."""
+    embeddings = embeddings.float().cpu()
+    if len(embeddings) <= exact_limit:
+        return exact_neighbours(embeddings, k)
+    return annoy_neighbours(embeddings, k)
+
+
+class HardNegativeBatchSampler(Sampler):
+    """
+    Batches of batch_size indices built from clusters of cluster_size
+    neighbouring items: a random unused seed item plus its nearest unused
+    neighbours. Every item is used at most once per epoch. Until update()
+    provides a neighbour index, batches are random.
+
+    Batches are formed as they are drawn, so an update() mid-epoch shapes
+    the remaining batches. Processes build the same sequence of batches and
+    take every num_replicas-th one.
+    """
+
+    def __init__(self, dataset_size, batch_size, cluster_size=4, num_replicas=1, rank=0, seed=0):
+        self.dataset_size = dataset_size
+        self.batch_size = batch_size
+        self.cluster_size = cluster_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        # Spare neighbours stand in for those already used by earlier batches
+        self.neighbours_per_item = 4 * cluster_size
+        self.neighbours = None
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def update(self, neighbours):
+        """Uses neighbours, as from build_neighbour_index, for the batches drawn from now on."""
+        self.neighbours = neighbours
+
+    def set_epoch(self, epoch, skip=0):
+        """Starts epoch, leaving out its first skip samples (whole batches) of this process."""
+        self.epoch = epoch
+        self.skip_batches = skip // self.batch_size
+
+    def batches_per_epoch(self):
+        return self.dataset_size // self.batch_size // self.num_replicas
+
+    def __len__(self):
+        return max(self.batches_per_epoch() - self.skip_batches, 0)
+
+    def _batches(self):
+        rng = random.Random(f"{self.seed}/{self.epoch}")
+        order = list(range(self.dataset_size))
+        rng.shuffle(order)
+        used = [False] * self.dataset_size
+        position = 0
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                while position < len(order) and used[order[position]]:
+                    position += 1
+                if position == len(order):
+                    # Drop the last partial batch
+                    return
+                seed = order[position]
+                used[seed] = True
+                batch.append(seed)
+                cluster = 1
+                for neighbour in (self.neighbours[seed] if self.neighbours is not None else ()):
+                    if cluster == self.cluster_size or len(batch) == self.batch_size:
+                        break
+                    if not used[neighbour]:
+                        used[neighbour] = True
+                        batch.append(neighbour)
+                        cluster += 1
+            yield batch
+
+    def __iter__(self):
+        total = self.batches_per_epoch() * self.num_replicas
+        for batch_idx, batch in enumerate(self._batches()):
+            if batch_idx == total:
+                return
+            if batch_idx % self.num_replicas == self.rank and batch_idx // self.num_replicas >= self.skip_batches:
+                yield batch
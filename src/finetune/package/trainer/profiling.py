@@ -0,0 +1,175 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+class StepProfile:
+    """
+    Splits training step time into data loading, forward, backward and the
+    optimizer step. CUDA work is asynchronous, so the device is synchronized
+    at every phase boundary when timing on a GPU. Phases are also labelled
+    in torch.profiler traces.
+    """
+
+    PHASES = ("data", "forward", "backward", "optimizer")
+
+    def __init__(self, device=None):
+        self.sync = device is not None and torch.device(device).type == "cuda"
+        self.totals = {phase: 0.0 for phase in self.PHASES}
+        self.current = {phase: 0.0 for phase in self.PHASES}
+        self.steps = 0
+        self.samples = 0
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def iterate(self, loader):
+        """Yields the batches of loader, timing how long each one took to arrive."""
+        iterator = iter(loader)
+        while True:
+            start = self._now()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._add("data", self._now() - start)
+            self.steps += 1
+            yield batch
+
+    def _add(self, name, seconds):
+        self.totals[name] += seconds
+        self.current[name] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = self._now()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self._add(name, self._now() - start)
+
+    def end_step(self, samples):
+        """Closes the current step of samples samples. Returns its timings and throughput."""
+        seconds = sum(self.current.values())
+        record = {f"{phase}_ms": 1000 * value for phase, value in self.current.items()}
+        record.update(step_ms=1000 * seconds, samples=samples,
+                      samples_per_sec=samples / seconds if seconds else 0.0)
+        self.samples += samples
+        self.current = {phase: 0.0 for phase in self.PHASES}
+        return record
+
+    def summary(self):
+        """Mean milliseconds per step for each phase and its share of the step."""
+        total = sum(self.totals.values())
+        summary = {"steps": self.steps, "samples": self.samples,
+                   "samples_per_sec": self.samples / total if total else 0.0}
+        for phase, seconds in self.totals.items():
+            summary[f"{phase}_ms"] = 1000 * seconds / self.steps if self.steps else 0.0
+            summary[f"{phase}_fraction"] = seconds / total if total else 0.0
+        return summary
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """Peak allocated CUDA memory on a GPU, or the process's peak resident memory on CPU."""
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """The process's peak resident memory."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TrainingTelemetry:
+    """
+    Collects the per-step records of StepProfile.end_step with the loss and
+    peak RSS. Every record is appended to log_path as a JSON line and sent to
+    wandb_run, if given; every log_every steps a line is printed.
+
+    With trace_dir, torch.profiler records trace_steps steps after skipping
+    the first trace_wait (plus one warmup step) and writes a trace that
+    TensorBoard or chrome://tracing can open.
+
+    Steps are numbered from start_step + 1, so a resumed run continues the
+    step count, the log and the W&B history of the run it resumes.
+    """
+
+    def __init__(self, log_path=None, log_every=10, wandb_run=None, trace_dir=None, trace_wait=5, trace_steps=5,
+                 start_step=0):
+        self.log_path = log_path
+        self.log_every = log_every
+        self.wandb_run = wandb_run
+        self.step = start_step
+        if log_path:
+            os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+            if start_step:
+                # A resumed run appends to the log of the run it resumes
+                self._trim_log(start_step)
+            else:
+                # Start a fresh log for this run
+                open(log_path, 'w').close()
+        self.profiler = None
+        if trace_dir:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=trace_wait, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                profile_memory=True)
+            self.profiler.start()
+
+    def _trim_log(self, start_step):
+        """
+        Drops the records after start_step, which the resumed run redoes, and
+        any line cut short when the previous run stopped.
+        """
+        if not os.path.exists(self.log_path):
+            return
+        kept = []
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    if json.loads(line)["step"] <= start_step:
+                        kept.append(line)
+                except (ValueError, KeyError):
+                    continue
+        with open(self.log_path, 'w') as f:
+            f.writelines(kept)
+
+    def log_step(self, record, **values):
+        """Records one training step; values such as loss or epoch are added to record."""
+        self.step += 1
+        record = dict(record, step=self.step, peak_rss_mb=peak_rss_mb(), **values)
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        if self.wandb_run is not None:
+            self.wandb_run.log(record, step=self.step)
+        if self.log_every and self.step % self.log_every == 0:
+            phases = ", ".join(f"{phase} {record[f'{phase}_ms']:.1f}ms" for phase in StepProfile.PHASES)
+            print(f"Step {self.step}: {phases}, {record['samples_per_sec']:.1f} samples/s, "
+                  f"peak RSS {record['peak_rss_mb']:.0f}MB")
+        if self.profiler is not None:
+            self.profiler.step()
+        return record
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
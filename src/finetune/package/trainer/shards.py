@@ -0,0 +1,246 @@
+"""
+Sharded streaming data for multi-category FashionCLIP training.
+
+Categories are packed into tar shards of (image bytes, caption) pairs, so
+training reads a few large files sequentially instead of opening one small
+image file per sample:
+
+    {category}-{shard:05d}.tar  {key}.jpg, the original image bytes, and
+                                {key}.json, {"caption": ..., "category": ...}
+    meta.json                   the shards with their category and sample
+                                count, and what they were built from
+
+ShardedStreamDataset streams the shards of every category, draws the
+category of each sample with equal weight (balanced) or in proportion to
+its size, mixes the samples in a shuffle buffer and yields ready batches.
+Each DataLoader worker of each process reads its own whole shards.
+Everything is seeded by (seed, epoch, rank, worker), so set_epoch(epoch,
+skip) replays an epoch exactly, for the same number of processes and
+workers, and a resumed run can skip the batches it already trained on.
+"""
+
+import io
+import os
+import json
+import random
+import itertools
+import tarfile
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+from trainer.tensor_cache import MAX_LENGTH, is_cache_valid, trim_padding
+
+SAMPLES_PER_SHARD = 1000
+SHUFFLE_BUFFER = 1000
+
+
+def shard_meta(category_files, n_samples, samples_per_shard):
+    return {
+        "categories": {category: {"json_file": os.path.abspath(json_file),
+                                  "json_mtime": os.path.getmtime(json_file)}
+                       for category, (json_file, _) in category_files.items()},
+        "n_samples": n_samples,
+        "samples_per_shard": samples_per_shard,
+    }
+
+
+def write_shards(category_files, shard_dir, n_samples=None, samples_per_shard=SAMPLES_PER_SHARD):
+    """
+    Packs the first n_samples caption/image pairs of every category into tar
+    shards in shard_dir, unless up-to-date shards are already there.
+    category_files maps each category to its local (json_path, image_dir).
+    Returns shard_dir.
+    """
+    meta = shard_meta(category_files, n_samples, samples_per_shard)
+    if is_cache_valid(shard_dir, meta):
+        print(f"Shards at {shard_dir} are up to date")
+        return shard_dir
+
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for category, (json_file, image_dir) in category_files.items():
+        with open(json_file, 'r') as f:
+            data = json.load(f)[:n_samples]
+        available = [item for item in data if os.path.exists(os.path.join(image_dir, item['image']))]
+        if len(available) < len(data):
+            print(f"{len(data) - len(available)} images referenced in {json_file} are missing, skipping them")
+
+        for shard_idx, start in enumerate(range(0, len(available), samples_per_shard)):
+            items = available[start:start + samples_per_shard]
+            name = f"{category}-{shard_idx:05d}.tar"
+            tmp_path = os.path.join(shard_dir, name + ".tmp")
+            with tarfile.open(tmp_path, "w") as tar:
+                for offset, item in enumerate(items):
+                    key = f"{start + offset:08d}"
+                    extension = os.path.splitext(item['image'])[1] or ".jpg"
+                    tar.add(os.path.join(image_dir, item['image']), arcname=key + extension)
+                    caption = json.dumps({"caption": item['caption'], "category": category}).encode()
+                    info = tarfile.TarInfo(key + ".json")
+                    info.size = len(caption)
+                    tar.addfile(info, io.BytesIO(caption))
+            os.replace(tmp_path, os.path.join(shard_dir, name))
+            shards.append({"path": name, "category": category, "count": len(items)})
+        print(f"Packed {len(available)} {category} samples into {shard_dir}")
+
+    # meta.json is written last, so an interrupted build is rebuilt next time
+    meta["shards"] = shards
+    with open(os.path.join(shard_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+    return shard_dir
+
+
+def read_shard(path):
+    """Yields the (image bytes, caption) pairs of a shard, reading it front to back."""
+    key, sample = None, {}
+    with tarfile.open(path, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, extension = os.path.splitext(member.name)
+            if member_key != key:
+                key, sample = member_key, {}
+            content = tar.extractfile(member).read()
+            if extension == ".json":
+                sample["caption"] = json.loads(content)["caption"]
+            else:
+                sample["image"] = content
+            if len(sample) == 2:
+                yield sample["image"], sample["caption"]
+
+
+def mix_streams(streams, weights, rng):
+    """Interleaves streams, drawing each item's stream by weight until all are exhausted."""
+    streams, weights = list(streams), list(weights)
+    while streams:
+        idx = rng.choices(range(len(streams)), weights)[0]
+        try:
+            yield next(streams[idx])
+        except StopIteration:
+            del streams[idx], weights[idx]
+
+
+def shuffle_buffer(samples, size, rng):
+    """Approximately shuffles a stream by swapping each sample through a buffer of size samples."""
+    if size < 2:
+        yield from samples
+        return
+    buffer = []
+    for sample in samples:
+        if len(buffer) < size:
+            buffer.append(sample)
+            continue
+        idx = rng.randrange(size)
+        yield buffer[idx]
+        buffer[idx] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class ShardedStreamDataset(IterableDataset):
+    """
+    Batches of (image, input_ids, attention_mask) streamed from the shards
+    of write_shards. Use it with DataLoader(batch_size=None).
+
+    Shards are split between the DataLoader workers of every process, each
+    streaming and batching its own shards; the workers of a process take
+    turns, so its batches stay in a fixed order. A category with fewer
+    shards than workers is shared by striding over its samples. Each
+    category is repeated as needed, so every process yields the same number
+    of batches per epoch and a balanced epoch still covers as many samples
+    as the shards hold. Batches depend on the number of processes and
+    workers, so resume with the same ones.
+    """
+
+    def __init__(self, shard_dir, batch_size, transform=None, tokenizer=None, categories=None, balanced=True,
+                 shuffle_buffer=SHUFFLE_BUFFER, seed=0, num_replicas=1, rank=0, collate_fn=trim_padding,
+                 max_length=MAX_LENGTH):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.categories = categories or list(meta["categories"])
+        self.shards = {category: [shard for shard in meta["shards"] if shard["category"] == category]
+                       for category in self.categories}
+        self.counts = {category: sum(shard["count"] for shard in shards)
+                       for category, shards in self.shards.items()}
+        self.batch_size = batch_size
+        self.transform = transform
+        self.tokenizer = tokenizer
+        self.balanced = balanced
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.collate_fn = collate_fn
+        self.max_length = max_length
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch, skip=0):
+        """Starts epoch, leaving out its first skip samples (whole batches) of this process."""
+        self.epoch = epoch
+        self.skip_batches = skip // self.batch_size
+
+    def batches_per_epoch(self):
+        return sum(self.counts.values()) // self.num_replicas // self.batch_size
+
+    def __len__(self):
+        return max(self.batches_per_epoch() - self.skip_batches, 0)
+
+    @staticmethod
+    def _assign_shards(shards, reader, readers):
+        """The shards reader reads out of readers, and the stride and offset of the samples it keeps."""
+        if len(shards) >= readers:
+            return shards[reader::readers], 1, 0
+        if not shards:
+            return [], 1, 0
+        # Too few shards to split, so readers share one and keep every n-th of its samples
+        sharing = [other for other in range(readers) if other % len(shards) == reader % len(shards)]
+        return [shards[reader % len(shards)]], len(sharing), sharing.index(reader)
+
+    def _category_stream(self, shards, reader, readers):
+        """Endless samples of one category for a reader, or none if it has no data."""
+        own, stride, offset = self._assign_shards(shards, reader, readers)
+        while True:
+            produced = False
+            for idx, sample in enumerate(sample for shard in own
+                                         for sample in read_shard(os.path.join(self.shard_dir, shard["path"]))):
+                if idx % stride == offset:
+                    produced = True
+                    yield sample
+            if not produced:
+                return
+
+    def _decode(self, image_bytes, caption):
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        if self.transform:
+            image = self.transform(image)
+        tokens = self.tokenizer(caption, padding="max_length", truncation=True, max_length=self.max_length,
+                                return_tensors="pt")
+        return image, tokens["input_ids"][0], tokens["attention_mask"][0]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # Batch b of the epoch comes from stream b % num_workers. The DataLoader takes
+        # turns starting at worker 0, so on resume worker 0 runs the stream of the
+        # first batch left.
+        stream_id = (worker_id + self.skip_batches) % num_workers
+        reader = self.rank * num_workers + stream_id
+        # Shard order is shared by all readers so each reads a disjoint part of it
+        shard_rng = random.Random(f"{self.seed}/{self.epoch}")
+        rng = random.Random(f"{self.seed}/{self.epoch}/{self.rank}/{stream_id}")
+        streams, weights = [], []
+        for category in self.categories:
+            shards = list(self.shards[category])
+            shard_rng.shuffle(shards)
+            streams.append(self._category_stream(shards, reader, self.num_replicas * num_workers))
+            weights.append(1 if self.balanced else self.counts[category])
+        samples = shuffle_buffer(mix_streams(streams, weights, rng), self.shuffle_buffer, rng)
+
+        for batch_idx in range(stream_id, self.batches_per_epoch(), num_workers):
+            batch = list(itertools.islice(samples, self.batch_size))
+            if len(batch) < self.batch_size:
+                # This reader's share of the categories holds no samples
+                return
+            if batch_idx >= self.skip_batches:
+                yield self.collate_fn([self._decode(*sample) for sample in batch])
@@ -1,8 +1,12 @@
 import os
 import json
+import shutil
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
-from torch.utils.data import Dataset, DataLoader
+from google.cloud.storage import transfer_manager
+from torch.utils.data import Dataset, DataLoader, IterableDataset
 from torchvision import transforms
 from PIL import Image
 from transformers import CLIPModel, CLIPProcessor
@@ -10,8 +14,28 @@ import torch
 import wandb
 from google.cloud import secretmanager
 from tqdm import tqdm
+from trainer.artifact_sync import file_crc32c, is_up_to_date
+from trainer.checkpointing import Checkpointer, ResumableSampler, latest_checkpoint, load_checkpoint
+from trainer.distributed import (all_reduce_gradients, barrier, broadcast_parameters, cleanup_distributed,
+                                 get_rank, get_world_size, init_distributed, is_main_process, run_distributed)
+from trainer.feature_cache import (FROZEN_TOWERS, FeatureDataset, build_feature_cache,
+                                   cached_feature_embeddings, collate_features, feature_cache_meta)
+from trainer.hard_negatives import (MINING_SPACES, HardNegativeBatchSampler, build_neighbour_index,
+                                    mining_embeddings)
+from trainer.profiling import StepProfile, TrainingTelemetry, peak_memory_mb, peak_rss_mb, reset_peak_memory
+from trainer.shards import SAMPLES_PER_SHARD, SHUFFLE_BUFFER, ShardedStreamDataset, write_shards
+from trainer.tensor_cache import CachedFashionDataset, build_tensor_cache, trim_padding
+from trainer.training_modes import TRAINING_MODES, configure_training_mode, count_parameters, merge_lora
 # from inference import FashionDataset, test_model
 
+# Concurrent blob downloads when preparing a category
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "16"))
+# Concurrent uploads of the trained model, and of the chunks of each large file
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+# Files from this size on, such as model weights, are uploaded in parallel chunks
+LARGE_FILE_SIZE = 64 * 2 ** 20
+UPLOAD_CHUNK_SIZE = 32 * 2 ** 20
+
 ## uncomment for local testing
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "../../../../../secrets/secret.json"
 
@@ -27,8 +51,27 @@ def get_secret(secret):
 
 
 
+def needed_images(data):
+    """File names of the images referenced by the caption JSON."""
+    return {os.path.basename(item['image']) for item in data}
+
+
+def load_caption_data(json_path, n_samples=None):
+    # Load JSON and keep the first n items
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    return data[:n_samples] if n_samples else data
+
+
 # Function to download images and JSON file from GCS
-def download_from_gcs(gcs_json_path, gcs_image_dir, local_json_path, local_image_dir, n_samples=None):
+def download_from_gcs(gcs_json_path, gcs_image_dir, local_json_path, local_image_dir, n_samples=None,
+                      workers=DOWNLOAD_WORKERS):
+    """
+    Downloads the caption JSON and the images it references. The bucket
+    listing is matched against a set of the needed file names, and missing
+    images are fetched concurrently with the storage transfer manager.
+    Returns the number of images downloaded.
+    """
     client = storage.Client()
 
     # Download JSON file if it doesn't already exist locally
@@ -42,54 +85,143 @@ def download_from_gcs(gcs_json_path, gcs_image_dir, local_json_path, local_image
     else:
         print(f"JSON file already exists at {local_json_path}, skipping download.")
 
-    # Load JSON and filter the first n items
-    with open(local_json_path, 'r') as f:
-        if n_samples:
-            data = json.load(f)[:n_samples]
-        else:
-            data = json.load(f)
+    needed = needed_images(load_caption_data(local_json_path, n_samples))
 
     # Prepare for image downloads
     bucket_name, image_blob_prefix = gcs_image_dir.replace(
         "gs://", "").split("/", 1)
-    blobs = client.list_blobs(bucket_name, prefix=image_blob_prefix)
     os.makedirs(local_image_dir, exist_ok=True)
-
-    # Download images if they do not already exist locally
-    print("Downloading images...")
-    for blob in blobs:
-        for item in data:
-            if blob.name.endswith(item['image']):
-                local_path = os.path.join(
-                    local_image_dir, os.path.basename(blob.name))
-                # print(f"local_path: {local_path}")
-                if not os.path.exists(local_path):
-                    blob.download_to_filename(local_path)
-                    # print(f"Downloaded {blob.name} to {local_path}")
-                else:
-                    # print(f"Image {local_path} already exists, skipping download.")
-                    pass
-
+    existing = set(os.listdir(local_image_dir))
+
+    # Pair every needed blob that is not already local with its target file
+    blob_file_pairs = []
+    found = set()
+    for blob in client.list_blobs(bucket_name, prefix=image_blob_prefix):
+        name = os.path.basename(blob.name)
+        if name in needed and name not in found:
+            found.add(name)
+            if name not in existing:
+                blob_file_pairs.append((blob, os.path.join(local_image_dir, name)))
+
+    missing = needed - found
+    if missing:
+        print(f"{len(missing)} images referenced in {local_json_path} are not in {gcs_image_dir}")
+
+    print(f"Downloading {len(blob_file_pairs)} images ({len(found) - len(blob_file_pairs)} already local)...")
+    results = transfer_manager.download_many(
+        blob_file_pairs, max_workers=workers, worker_type=transfer_manager.THREAD)
+    failed = [(blob.name, result) for (blob, _), result in zip(blob_file_pairs, results)
+              if isinstance(result, Exception)]
+    for blob_name, error in failed:
+        print(f"Failed to download {blob_name}: {error}")
+    return len(blob_file_pairs) - len(failed)
+
+
+def category_paths(category, data_root=None):
+    """Local (json_path, image_dir) of a category, mirroring the bucket layout under data_root or the cwd."""
+    local_json_path = DIR_DICT[category]["json_path"].replace("gs://", "")
+    local_image_dir = DIR_DICT[category]["image_dir"].replace("gs://", "")
+    if data_root:
+        return os.path.join(data_root, local_json_path), os.path.join(data_root, local_image_dir)
+    return local_json_path, local_image_dir
+
+
+def prepare_category_data(category, n_samples=None, data_root=None, workers=DOWNLOAD_WORKERS):
+    """
+    Returns the local (json_path, image_dir) of a category. Data is read from
+    data_root, a local copy of the buckets in the same layout, when given, and
+    downloaded from GCS otherwise.
+    """
+    json_path = DIR_DICT[category]["json_path"]
+    image_dir = DIR_DICT[category]["image_dir"]
+    local_json_path, local_image_dir = category_paths(category, data_root)
+
+    if data_root:
+        missing = needed_images(load_caption_data(local_json_path, n_samples)) - set(os.listdir(local_image_dir))
+        if missing:
+            print(f"{len(missing)} images referenced in {local_json_path} are missing from {local_image_dir}")
+        return local_json_path, local_image_dir
+
+    os.makedirs(os.path.dirname(local_json_path), exist_ok=True)
+    download_from_gcs(json_path, image_dir, local_json_path, local_image_dir, n_samples, workers)
+    return local_json_path, local_image_dir
+
+
+def local_files(local_path):
+    """(path, path relative to local_path with / separators) of every file under local_path."""
+    files = []
+    for root, _, names in os.walk(local_path):
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            files.append((file_path, os.path.relpath(file_path, local_path).replace(os.sep, "/")))
+    return files
+
+
+def copy_to_directory(files, target_dir, workers=UPLOAD_WORKERS):
+    """Filesystem counterpart of upload_to_gcs. Returns the number of files copied."""
+    def copy(file):
+        file_path, relative_path = file
+        target_path = os.path.join(target_dir, relative_path)
+        if is_up_to_date(target_path, os.path.getsize(file_path), crc32c=lambda: file_crc32c(file_path)):
+            return False
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # Copy under a temporary name so an interrupted copy never looks complete
+        shutil.copyfile(file_path, target_path + ".tmp")
+        os.replace(target_path + ".tmp", target_path)
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        copied = sum(executor.map(copy, files))
+    print(f"Copied {copied} files to {target_dir} ({len(files) - copied} already up to date)")
+    return copied
 
 
 # Function to upload model weights to GCS
-def upload_to_gcs(local_path, gcs_path, bucket_name="vertexai_train"):
+def upload_to_gcs(local_path, gcs_path, bucket_name="vertexai_train", workers=UPLOAD_WORKERS):
+    """
+    Uploads the files under local_path to gcs_path, or copies them there when
+    gcs_path is a local directory rather than a gs:// path. Files whose size
+    and CRC32C already match the remote copy are skipped, so re-running an
+    interrupted upload only sends what is missing. Small files are uploaded
+    concurrently and large ones in concurrent chunks. Returns the number of
+    files transferred.
+    """
+    files = local_files(local_path)
+    if not gcs_path.startswith("gs://"):
+        return copy_to_directory(files, gcs_path, workers)
+
     client = storage.Client()
     # bucket_name, gcs_folder = gcs_path.replace("gs://", "").split("/", 1)
     bucket = client.bucket(bucket_name)
     gcs_path = gcs_path[len(f"gs://{bucket_name}/"):]
-    print(f"Uploading model to {gcs_path}...")
-
-    for root, _, files in os.walk(local_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            print(f"local_file_path: {local_file_path}")
-            remote_path = os.path.relpath(local_file_path, local_path)
-            remote_path = os.path.join(gcs_path, remote_path)
-            print(f"remote_path: {remote_path}")
-            blob = bucket.blob(remote_path)
-            blob.upload_from_filename(local_file_path)
-            print(f"Uploaded {local_file_path} to {gcs_path}/{remote_path}")
+    remote = {blob.name: blob for blob in client.list_blobs(bucket_name, prefix=gcs_path)}
+
+    pending = []
+    for file_path, relative_path in files:
+        remote_path = f"{gcs_path.rstrip('/')}/{relative_path}" if gcs_path else relative_path
+        blob = remote.get(remote_path)
+        if blob is not None and blob.size == os.path.getsize(file_path) and blob.crc32c == file_crc32c(file_path):
+            continue
+        pending.append((file_path, bucket.blob(remote_path)))
+    print(f"Uploading {len(pending)} files to {gcs_path} ({len(files) - len(pending)} already up to date)...")
+
+    small = [(file_path, blob) for file_path, blob in pending if os.path.getsize(file_path) < LARGE_FILE_SIZE]
+    large = [(file_path, blob) for file_path, blob in pending if os.path.getsize(file_path) >= LARGE_FILE_SIZE]
+    results = transfer_manager.upload_many(small, max_workers=workers, worker_type=transfer_manager.THREAD)
+    failed = [(file_path, result) for (file_path, _), result in zip(small, results) if isinstance(result, Exception)]
+    for file_path, blob in large:
+        try:
+            transfer_manager.upload_chunks_concurrently(file_path, blob, chunk_size=UPLOAD_CHUNK_SIZE,
+                                                        max_workers=workers, worker_type=transfer_manager.THREAD)
+        except Exception as error:
+            failed.append((file_path, error))
+
+    for file_path, error in failed:
+        print(f"Failed to upload {file_path}: {error}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(pending)} files failed to upload to {gcs_path}")
+    print(f"Uploaded {len(pending)} files to {gcs_path}")
+    return len(pending)
 
 DIR_DICT = {
     "men_accessories": {
@@ -141,13 +273,22 @@ import numpy as np
 
 # Define dataset class
 class FashionDataset(Dataset):
-    def __init__(self, json_file, image_dir, transform=None):
+    """
+    The first n_samples caption/image pairs of a category, all of them when
+    n_samples is None. With a tokenizer, captions are tokenized once here
+    and items are (image, input_ids, attention_mask) instead of (image, caption).
+    """
+
+    def __init__(self, json_file, image_dir, transform=None, tokenizer=None, max_length=77, n_samples=100):
         self.json_file = json_file
         with open(json_file, 'r') as f:
-            # Use only the first 100 data points
-            self.data = json.load(f)[:100]
+            self.data = json.load(f)[:n_samples]
         self.image_dir = image_dir
         self.transform = transform
+        self.tokens = None
+        if tokenizer is not None:
+            self.tokens = tokenizer([item['caption'] for item in self.data], padding="max_length",
+                                    truncation=True, max_length=max_length, return_tensors="pt")
 
     def __len__(self):
         return len(self.data)
@@ -159,15 +300,18 @@ class FashionDataset(Dataset):
         image = Image.open(image_path).convert('RGB')
         if self.transform:
             image = self.transform(image)
+        if self.tokens is not None:
+            return image, self.tokens["input_ids"][idx], self.tokens["attention_mask"][idx]
         text = item['caption']
         return image, text
     
 
 class ImageDataset(Dataset):
-    def __init__(self, total_test_cases, json_file, image_dir, transform=None):
+    def __init__(self, total_test_cases, json_file, image_dir, transform=None, n_samples=100):
         self.json_file = json_file  # Store the JSON file path
         with open(json_file, 'r') as f:
-            self.data = json.load(f)[:100]#[:total_test_cases]  # First 100 data points
+            # First n_samples data points, all of them when n_samples is None
+            self.data = json.load(f)[:n_samples]
         self.image_dir = image_dir
         self.transform = transform
 
@@ -185,104 +329,280 @@ class ImageDataset(Dataset):
         return image, image_path
 
 
-def test_model(model, processor, dataset, local_model_dir, device, total_test_cases=10):
+def embedding_output(output):
+    # Newer transformers return a model output instead of the projected tensor
+    return output if isinstance(output, torch.Tensor) else output.pooler_output
+
+
+def encode_images(model, processor, image_loader, device):
+    """
+    Encodes every image in image_loader once. Returns the L2-normalised
+    image embeddings and the matching image paths.
+    """
+    all_embeddings = []
+    all_image_paths = []
+    with torch.no_grad():
+        for images, image_paths in image_loader:
+            inputs = processor(images=images.float(), return_tensors="pt").to(device)
+            embeddings = embedding_output(model.get_image_features(**inputs))
+            all_embeddings.append(torch.nn.functional.normalize(embeddings, dim=-1))
+            all_image_paths.extend(image_paths)
+    return torch.cat(all_embeddings), all_image_paths
+
+
+def encode_texts(model, processor, texts, device, batch_size=64):
+    """Encodes texts in batches. Returns their L2-normalised embeddings."""
+    all_embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            inputs = processor(text=list(texts[start:start + batch_size]), return_tensors="pt",
+                               padding=True, truncation=True, max_length=77).to(device)
+            embeddings = embedding_output(model.get_text_features(**inputs))
+            all_embeddings.append(torch.nn.functional.normalize(embeddings, dim=-1))
+    return torch.cat(all_embeddings)
+
+
+def test_model(model, processor, dataset, local_model_dir, device, total_test_cases=10, gallery_size=100):
+    """
+    Checks whether each of the first total_test_cases captions retrieves its
+    own image among the top 5 of the gallery. The gallery and the captions
+    are each encoded once, and ranked with a single similarity matrix.
+    gallery_size=None uses every image of the category.
+    """
     print("\n\nModel evaluation started...\n\n")
     model.eval()
-    correct_matches = 0
     test_data = dataset.data[:total_test_cases]
 
     transform = transforms.Compose([
         transforms.Resize((224, 224)),
         transforms.ToTensor(),
-        # transforms.Normalize(mean=[0.5], std=[0.5])
     ])
 
-    # transform = None
-
-
     # Use the original JSON file path for all images dataset
-    all_images_dataset = ImageDataset(total_test_cases=total_test_cases, json_file=dataset.json_file, image_dir=dataset.image_dir, transform=transform)
+    all_images_dataset = ImageDataset(total_test_cases=total_test_cases, json_file=dataset.json_file,
+                                      image_dir=dataset.image_dir, transform=transform, n_samples=gallery_size)
     all_images_loader = DataLoader(all_images_dataset, batch_size=32, shuffle=False)
 
-    for idx, test_item in enumerate(test_data):
-        caption = test_item['caption']
-        true_image_path = os.path.join(dataset.image_dir, test_item['image'])
-        
-        # Search for the best matching image
-        best_image_path, _, top5_image_paths = search_similar_images(caption, all_images_loader, model, processor, device)
+    image_embeddings, all_image_paths = encode_images(model, processor, all_images_loader, device)
+    text_embeddings = encode_texts(model, processor, [item['caption'] for item in test_data], device)
 
-        print(f"True image: {true_image_path}")
+    # Rows are captions, columns are gallery images
+    similarity = text_embeddings @ image_embeddings.T
+    top5_image_idxs = similarity.topk(min(5, len(all_image_paths)), dim=1).indices.tolist()
 
-        for i, img_path in enumerate(top5_image_paths):
-            if os.path.basename(img_path) == os.path.basename(true_image_path):
-                print(f"Matched path: {img_path}")
-                print(f"caption: {caption}")
-                correct_matches += 1
-            
-        # Check if the best match is correct
-        # if os.path.basename(best_image_path) == os.path.basename(true_image_path):
-        #     correct_matches += 1
-        #     print("\n\n\nMatch found!\n\n\n")
+    correct_matches = 0
+    for test_item, image_idxs in zip(test_data, top5_image_idxs):
+        true_image_name = os.path.basename(test_item['image'])
+        if any(os.path.basename(all_image_paths[i]) == true_image_name for i in image_idxs):
+            correct_matches += 1
 
     # Calculate accuracy
-    accuracy = correct_matches / total_test_cases
+    accuracy = correct_matches / len(test_data) if test_data else 0.0
 
     # Save accuracy to a JSON file
     result_file = os.path.join(local_model_dir, "test_results.json")
     with open(result_file, 'w') as f:
         json.dump({"accuracy": accuracy}, f)
     print(f"Testing completed. Accuracy: {accuracy}. Results saved to {result_file}")
+    return accuracy
 
 
+def search_similar_images(text, image_loader, model, processor, device, image_embeddings=None, image_paths=None):
+    """
+    Ranks the images of image_loader against one text. Pass precomputed
+    image_embeddings and image_paths from encode_images to skip re-encoding
+    the gallery for every query.
+    """
+    if image_embeddings is None:
+        image_embeddings, image_paths = encode_images(model, processor, image_loader, device)
+    text_embedding = encode_texts(model, processor, [text], device)
 
-def search_similar_images(text, image_loader, model, processor, device):
-    all_probs = []
-    all_image_paths = []
-    
-    for images, image_paths in image_loader:
-        images = images.float().to(device)
-        inputs = processor(text=[text], 
-                           images=images, 
-                           return_tensors="pt", 
-                           padding=True, 
-                           ).to(device)
-
-        # Forward pass: get the similarity logits
-        with torch.no_grad():
-            outputs = model(**inputs)
-            logits_per_image = outputs.logits_per_image  # Image-to-text similarity
-
-        # Convert logits to probabilities (softmax over image logits)
-        probs = logits_per_image.softmax(dim=0)  # Apply softmax over the last dimension
-
-        # Store results for this batch
-        all_probs.append(probs)
-        all_image_paths.extend(image_paths)
-    
-    # Concatenate probabilities across all batches
-    all_probs = torch.cat(all_probs, dim=0)
-    
-    # Find the most relevant image (best match)
-    best_image_idx = all_probs.argmax(dim=0).item()  # Get the index of the best match
+    # Probabilities over the whole gallery
+    all_probs = (model.logit_scale.exp() * image_embeddings @ text_embedding.T).softmax(dim=0)
 
-    # get indicies of top 5 matches
-    top5_image_idxs = all_probs.argsort(descending=True, dim=0)[:5]
-    # print(f"top5_image_idxs: {top5_image_idxs}")
-    
-    best_image_path = all_image_paths[best_image_idx]
+    best_image_idx = all_probs.argmax(dim=0).item()
+    top5_image_idxs = all_probs[:, 0].argsort(descending=True)[:5]
 
-    # get top 5 image paths
-    top5_image_paths = [all_image_paths[i] for i in top5_image_idxs]
+    best_image_path = image_paths[best_image_idx]
+    top5_image_paths = [image_paths[i] for i in top5_image_idxs]
     return best_image_path, all_probs, top5_image_paths
 
 
 
+def clip_transform(processor, image_size=224):
+    """
+    Resizes and normalizes images to CLIP pixel_values as tensor ops, so the
+    work runs in DataLoader workers. The processor's shortest-edge resize and
+    center crop are no-ops on an image_size square.
+    """
+    return transforms.Compose([
+        transforms.Resize((image_size, image_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=processor.image_processor.image_mean, std=processor.image_processor.image_std),
+    ])
+
+
+def training_inputs(batch, device):
+    """Moves a (pixel_values, input_ids, attention_mask) batch to the model's device."""
+    pixel_values, input_ids, attention_mask = batch
+    return {
+        "pixel_values": pixel_values.to(device, non_blocking=True),
+        "input_ids": input_ids.to(device, non_blocking=True),
+        "attention_mask": attention_mask.to(device, non_blocking=True),
+    }
+
+
+def make_loader(dataset, batch_size, collate_fn, num_workers, device, shuffle=True, batch_sampler=None):
+    """
+    DataLoader over dataset, shuffled with a resumable sampler and sharded
+    across processes when distributed, or drawing batch_sampler's batches.
+    """
+    if isinstance(dataset, IterableDataset):
+        # Streaming datasets shuffle, shard and batch themselves; workers are
+        # restarted every epoch so they pick up set_epoch
+        return DataLoader(dataset, batch_size=None, num_workers=num_workers, pin_memory=device.type == "cuda")
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                          pin_memory=device.type == "cuda", persistent_workers=num_workers > 0, collate_fn=collate_fn)
+    # A seeded sampler fixes each epoch's order, so a resumed run can skip what was already trained on
+    sampler = ResumableSampler(dataset, num_replicas=get_world_size(), rank=get_rank()) if shuffle else None
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                      num_workers=num_workers, pin_memory=device.type == "cuda",
+                      persistent_workers=num_workers > 0, collate_fn=collate_fn)
+
+
+def contrastive_embeddings(model, batch, device):
+    """L2-normalised (image_embeds, text_embeds) for a dataset batch or a cached feature batch."""
+    if isinstance(batch, dict):
+        image_embeds, text_embeds = cached_feature_embeddings(model, batch, device)
+    else:
+        inputs = training_inputs(batch, device)
+        image_embeds = embedding_output(model.get_image_features(pixel_values=inputs["pixel_values"]))
+        text_embeds = embedding_output(model.get_text_features(input_ids=inputs["input_ids"],
+                                                               attention_mask=inputs["attention_mask"]))
+    return (torch.nn.functional.normalize(image_embeds, dim=-1),
+            torch.nn.functional.normalize(text_embeds, dim=-1))
+
+
+def contrastive_loss(image_embeds, text_embeds, logit_scale):
+    """CLIP's symmetric loss, where the i-th image and caption of the batch belong together."""
+    logits_per_text = logit_scale.exp() * text_embeds.float() @ image_embeds.float().T
+    labels = torch.arange(len(logits_per_text), device=logits_per_text.device)
+    loss_image = torch.nn.functional.cross_entropy(logits_per_text.T, labels)
+    loss_text = torch.nn.functional.cross_entropy(logits_per_text, labels)
+    return (loss_image + loss_text) / 2
+
+
+def refresh_hard_negatives(model, loader, batch_sampler, device, space="joint"):
+    """
+    Embeds the training set in loader, which must not shuffle, with the
+    current weights and hands batch_sampler a new neighbour index.
+    """
+    was_training = model.training
+    model.eval()
+    image_embeddings, text_embeddings = [], []
+    with torch.no_grad():
+        for batch in loader:
+            image_embeds, text_embeds = contrastive_embeddings(model, batch, device)
+            image_embeddings.append(image_embeds.float().cpu())
+            text_embeddings.append(text_embeds.float().cpu())
+    model.train(was_training)
+    embeddings = mining_embeddings(torch.cat(image_embeddings), torch.cat(text_embeddings), space)
+    batch_sampler.update(build_neighbour_index(embeddings, batch_sampler.neighbours_per_item))
+
+
+def split_batch(batch, chunk_size):
+    """Splits a dataset or feature batch into chunks of at most chunk_size samples."""
+    if isinstance(batch, dict):
+        count = len(batch["input_ids"])
+        return [{name: value[start:start + chunk_size] for name, value in batch.items()}
+                for start in range(0, count, chunk_size)]
+    return [tuple(value[start:start + chunk_size] for value in batch)
+            for start in range(0, len(batch[0]), chunk_size)]
+
+
+def grad_cache_backward(model, batch, device, chunk_size, autocast):
+    """
+    Back-propagates the contrastive loss of a large batch chunk by chunk, so
+    memory depends on chunk_size rather than the batch size (gradient cache):
+
+    1. embed every chunk without building a graph,
+    2. compute the full-batch loss on those embeddings and back-propagate it
+       to the embeddings only,
+    3. re-embed each chunk with a graph and back-propagate its slice of the
+       embedding gradients into the model.
+
+    Returns the loss. Gradients accumulate into the model's .grad fields.
+    """
+    chunks = split_batch(batch, chunk_size)
+    with torch.no_grad(), autocast():
+        embeddings = [contrastive_embeddings(model, chunk, device) for chunk in chunks]
+    image_embeds = torch.cat([image for image, _ in embeddings]).float().requires_grad_()
+    text_embeds = torch.cat([text for _, text in embeddings]).float().requires_grad_()
+
+    loss = contrastive_loss(image_embeds, text_embeds, model.logit_scale)
+    loss.backward()
+
+    sizes = [len(image) for image, _ in embeddings]
+    for chunk, image_grad, text_grad in zip(chunks, image_embeds.grad.split(sizes), text_embeds.grad.split(sizes)):
+        with autocast():
+            chunk_image, chunk_text = contrastive_embeddings(model, chunk, device)
+        # Frozen paths produce embeddings without a graph, which have nothing to back-propagate
+        pairs = [(output, grad.to(output.dtype)) for output, grad in
+                 ((chunk_image, image_grad), (chunk_text, text_grad)) if output.requires_grad]
+        if pairs:
+            torch.autograd.backward([output for output, _ in pairs], [grad for _, grad in pairs])
+    return loss.detach()
+
+
+def train_epoch(model, dataloader, optimizer, device, desc=None, chunk_size=None, bf16=False, on_step=None,
+                telemetry=None):
+    """
+    One pass of the contrastive loss over dataloader. Returns (average loss,
+    step profile). With chunk_size, batches larger than it use the gradient
+    cache; bf16 runs the model under bfloat16 autocast. on_step(batch_idx)
+    is called after every optimizer step, and every step's timings go to
+    telemetry, a TrainingTelemetry, if given.
+    """
+    device = torch.device(device)
+    autocast = functools.partial(torch.autocast, device_type=device.type, dtype=torch.bfloat16, enabled=bf16)
+    model.train()
+    total_loss = 0
+    profile = StepProfile(device)
+    progress_bar = tqdm(enumerate(profile.iterate(dataloader)), total=len(dataloader), desc=desc)
+    for batch_idx, batch in progress_bar:
+        optimizer.zero_grad()
+        if chunk_size and len(split_batch(batch, chunk_size)) > 1:
+            with profile.phase("backward"):
+                loss = grad_cache_backward(model, batch, device, chunk_size, autocast)
+        else:
+            with profile.phase("forward"):
+                with autocast():
+                    image_embeds, text_embeds = contrastive_embeddings(model, batch, device)
+                loss = contrastive_loss(image_embeds, text_embeds, model.logit_scale)
+            with profile.phase("backward"):
+                loss.backward()
+        with profile.phase("backward"):
+            # Average gradients across processes when training distributed
+            all_reduce_gradients([param for group in optimizer.param_groups for param in group["params"]])
+        with profile.phase("optimizer"):
+            optimizer.step()
+        step_record = profile.end_step(len(batch["input_ids"]) if isinstance(batch, dict) else len(batch[0]))
+        if on_step is not None:
+            on_step(batch_idx)
+        total_loss += loss.item()
+        progress_bar.set_postfix(loss=loss.item())
+        if telemetry is not None:
+            telemetry.log_step(step_record, loss=loss.item())
+    return total_loss / max(len(dataloader), 1), profile.summary()
+
+
 # Parse arguments
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--category", type=str, default="men_accessories", help="Category of the dataset.")
     parser.add_argument("--output_dir", type=str, default="finetuned-fashionclip",
-                        help="GCS path to save the fine-tuned model.")
+                        help="GCS path (gs://...) or local directory to save the fine-tuned model.")
     parser.add_argument("--batch_size", type=int, default=32,
                         help="Training batch size.")
     parser.add_argument("--epochs", type=int, default=1,
@@ -298,30 +618,81 @@ def parse_args():
     parser.add_argument("--bucket_name", type=str, default="vertexai_train")
     parser.add_argument("--n_samples", type=int, default=None)
     parser.add_argument("--total_test_cases", type=int, default=10)
+    parser.add_argument("--data_root", type=str, default=None,
+                        help="Local copy of the data buckets to read instead of GCS.")
+    parser.add_argument("--download_workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--upload_workers", type=int, default=UPLOAD_WORKERS)
+    parser.add_argument("--shard_dir", type=str, default=None,
+                        help="Pack --categories into tar shards here and stream training batches from them.")
+    parser.add_argument("--categories", type=str, nargs="+", default=None,
+                        help="Categories of DIR_DICT to train on with --shard_dir, all of them by default.")
+    parser.add_argument("--samples_per_shard", type=int, default=SAMPLES_PER_SHARD)
+    parser.add_argument("--shuffle_buffer", type=int, default=SHUFFLE_BUFFER,
+                        help="Samples held in the streaming shuffle buffer.")
+    parser.add_argument("--sampling", type=str, default="balanced", choices=("balanced", "proportional"),
+                        help="Draw every category equally often, or in proportion to its size.")
+    parser.add_argument("--tensor_cache_dir", type=str, default=None,
+                        help="Preprocess images and captions once into this directory and train from it.")
+    parser.add_argument("--num_workers", type=int, default=4,
+                        help="DataLoader worker processes.")
+    parser.add_argument("--training_mode", type=str, default="full", choices=TRAINING_MODES,
+                        help="Which parameters to train.")
+    parser.add_argument("--lora_rank", type=int, default=8)
+    parser.add_argument("--grad_cache_chunk", type=int, default=0,
+                        help="Back-propagate batches in chunks of this size so --batch_size can exceed memory (0 disables).")
+    parser.add_argument("--bf16", action="store_true",
+                        help="Run the model under bfloat16 autocast.")
+    parser.add_argument("--hard_negative_refresh", type=int, default=0,
+                        help="Build batches from clusters of similar items, re-mining them every this many steps "
+                             "(0 disables).")
+    parser.add_argument("--cluster_size", type=int, default=4,
+                        help="Similar items per cluster in a hard-negative batch.")
+    parser.add_argument("--mining_space", type=str, default="joint", choices=MINING_SPACES,
+                        help="Embeddings whose neighbours form the clusters.")
+    parser.add_argument("--wandb", action="store_true",
+                        help="Log telemetry to Weights & Biases, with the key from --wandb_key.")
+    parser.add_argument("--telemetry_log", type=str, default=None,
+                        help="JSON-lines file of per-step timings, local_run_logs/step_telemetry.jsonl by default.")
+    parser.add_argument("--log_every", type=int, default=10,
+                        help="Steps between telemetry lines on the console.")
+    parser.add_argument("--trace_dir", type=str, default=None,
+                        help="Write a torch.profiler trace of a window of training steps here.")
+    parser.add_argument("--trace_wait", type=int, default=5,
+                        help="Steps to skip before tracing, followed by one warmup step.")
+    parser.add_argument("--trace_steps", type=int, default=5,
+                        help="Steps to trace.")
+    parser.add_argument("--checkpoint_dir", type=str, default=None,
+                        help="Where to write resumable checkpoints, e.g. a /gcs/<bucket>/ path on Vertex AI.")
+    parser.add_argument("--checkpoint_every", type=int, default=500,
+                        help="Optimizer steps between checkpoints; one is also written after every epoch.")
+    parser.add_argument("--resume_from", type=str, default=None,
+                        help="Checkpoint file to resume from, or 'latest' for the newest in --checkpoint_dir.")
+    parser.add_argument("--num_processes", type=int, default=1,
+                        help="Local data-parallel training processes (gloo backend).")
+    parser.add_argument("--feature_cache_dir", type=str, default=None,
+                        help="Cache frozen-tower features here and train against them (frozen_vision and projection modes).")
+    parser.add_argument("--lora_alpha", type=float, default=16)
+    parser.add_argument("--gallery_size", type=int, default=100,
+                        help="Number of images searched during evaluation, 0 for the whole category.")
     return parser.parse_args()
 
 
-def main():
-    args = parse_args()
-
+def train(args):
+    rank, world_size = init_distributed()
+    if world_size > 1:
+        print(f"Process {rank} of {world_size} started")
 
-
-    json_path = DIR_DICT[args.category]["json_path"]
-    image_dir = DIR_DICT[args.category]["image_dir"]
-
-    # Local paths for data
-    local_json_path = json_path.replace("gs://", "")
-    local_image_dir = image_dir.replace("gs://", "")
     local_model_dir = "local_fine_tuned_model"
-
-    # Create dedicated subfolder for the model in the output directory
-    os.makedirs("/".join(local_json_path.split("/")[:-1]), exist_ok=True)
-    os.makedirs(local_image_dir, exist_ok=True)
     os.makedirs(local_model_dir, exist_ok=True)
+    # Reports and logs of the run stay next to the model, out of what is uploaded and deployed
+    local_log_dir = "local_run_logs"
+    os.makedirs(local_log_dir, exist_ok=True)
 
-    # Download data from GCS
-    download_from_gcs(json_path, image_dir,
-                      local_json_path, local_image_dir, args.n_samples)
+    # Download data from GCS, or read it from a local copy; rank 0 fetches for everyone
+    if is_main_process():
+        prepare_category_data(args.category, args.n_samples, args.data_root, args.download_workers)
+    barrier()
+    local_json_path, local_image_dir = category_paths(args.category, args.data_root)
 
     # Dataset and DataLoader
     transform = transforms.Compose([
@@ -331,67 +702,208 @@ def main():
 
 
 
-    # wandb.login(key=get_secret(args.wandb_key))
-    # wandb.init(project=f"fashionclip_{args.category}", config=args)
-
-    dataset = FashionDataset(json_file=local_json_path,
-                             image_dir=local_image_dir, transform=transform)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
+    # W&B is opt-in, so training runs without its credentials
+    wandb_run = None
+    if args.wandb and is_main_process():
+        wandb.login(key=get_secret(args.wandb_key))
+        wandb_run = wandb.init(project=f"fashionclip_{args.category}", config=vars(args))
 
     # Model and processor
     processor = CLIPProcessor.from_pretrained(args.model_name)
     processor.image_processor.do_rescale = False
     model = CLIPModel.from_pretrained(args.model_name)
     print(f"model loaded from {args.model_name}")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}")
+    else:
+        device = torch.device("cpu")
     model.to(device)
 
-    # Optimizer
-    optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate)
+    dataset = FashionDataset(json_file=local_json_path,
+                             image_dir=local_image_dir, transform=transform)
 
-    # Training loop
-    for epoch in range(args.epochs):
-        model.train()
-        total_loss = 0
-        progress_bar = tqdm(enumerate(dataloader), total=len(
-            dataloader), desc=f"Epoch {epoch+1}/{args.epochs}")
-        for batch_idx, (images, texts) in progress_bar:
-            images = images.to(device)
-            inputs = processor(
-                text=texts,
-                images=images,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=77
-            ).to(device)
-            outputs = model(**inputs)
-            logits_per_image = outputs.logits_per_image
-            logits_per_text = outputs.logits_per_text
-            loss_image = torch.nn.functional.cross_entropy(
-                logits_per_image, torch.arange(len(images), device=device))
-            loss_text = torch.nn.functional.cross_entropy(
-                logits_per_text, torch.arange(len(texts), device=device))
-            loss = (loss_image + loss_text) / 2
-            total_loss += loss.item()
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            progress_bar.set_postfix(loss=loss.item())
-        #     wandb.log(
-        #         {"epoch": epoch, "batch_idx": batch_idx, "loss": loss.item()})
-        # wandb.log({"epoch": epoch, "average_loss": total_loss / len(dataloader)})
+    # Captions are tokenized once and images normalized in the workers,
+    # so the training step only moves ready tensors to the device
+    image_mean, image_std = processor.image_processor.image_mean, processor.image_processor.image_std
+    if args.shard_dir:
+        # Pack every category into shards once, then stream them sequentially
+        categories = args.categories or list(DIR_DICT)
+        if is_main_process():
+            category_files = {category: prepare_category_data(category, args.n_samples, args.data_root,
+                                                              args.download_workers)
+                              for category in categories}
+            write_shards(category_files, args.shard_dir, args.n_samples, args.samples_per_shard)
+        barrier()
+        train_dataset = ShardedStreamDataset(args.shard_dir, args.batch_size, clip_transform(processor),
+                                             processor.tokenizer, categories=categories,
+                                             balanced=args.sampling == "balanced", shuffle_buffer=args.shuffle_buffer,
+                                             num_replicas=world_size, rank=rank)
+        # Fail before training rather than stream an empty epoch
+        empty = [category for category, count in train_dataset.counts.items() if not count]
+        if empty:
+            print(f"No samples in {args.shard_dir} for {', '.join(empty)}")
+        if not train_dataset.batches_per_epoch():
+            raise ValueError(f"Shards in {args.shard_dir} hold {sum(train_dataset.counts.values())} samples of "
+                             f"{', '.join(categories)}, fewer than one batch of {args.batch_size} per process")
+    elif args.tensor_cache_dir:
+        # Decode and tokenize once, then train from the memory-mapped cache
+        if is_main_process():
+            build_tensor_cache(local_json_path, local_image_dir, args.tensor_cache_dir, processor.tokenizer,
+                               n_samples=len(dataset))
+        barrier()
+        train_dataset = CachedFashionDataset(args.tensor_cache_dir, image_mean, image_std)
+    else:
+        train_dataset = FashionDataset(json_file=local_json_path, image_dir=local_image_dir,
+                                       transform=clip_transform(processor), tokenizer=processor.tokenizer)
+    dataloader = make_loader(train_dataset, args.batch_size, trim_padding, args.num_workers, device)
 
-    # Save and upload the model
-    model.save_pretrained(local_model_dir)
-    processor.save_pretrained(local_model_dir)
+    # Freeze or adapt the model for the training mode, then optimize only what is trainable
+    trainable_params = configure_training_mode(model, args.training_mode, args.lora_rank, args.lora_alpha)
+    model.to(device)
+    # Every process starts from rank 0's weights, including randomly initialized adapters
+    broadcast_parameters(model)
+    trainable, total = count_parameters(model)
+    print(f"Training mode {args.training_mode}: {trainable:,} of {total:,} parameters trainable")
+
+    if args.feature_cache_dir and args.shard_dir:
+        print("Streaming from --shard_dir, ignoring --feature_cache_dir")
+    elif args.feature_cache_dir and args.training_mode in FROZEN_TOWERS:
+        # Run the frozen towers once; epochs then train against their cached features
+        if is_main_process():
+            ordered_loader = make_loader(train_dataset, args.batch_size, trim_padding, args.num_workers, device,
+                                         shuffle=False)
+            feature_meta = feature_cache_meta(args.model_name, local_json_path, args.n_samples, len(train_dataset))
+            build_feature_cache(model, ordered_loader, args.feature_cache_dir, device,
+                                FROZEN_TOWERS[args.training_mode], feature_meta)
+        barrier()
+        dataloader = make_loader(FeatureDataset(args.feature_cache_dir), args.batch_size, collate_features,
+                                 args.num_workers, device)
+    elif args.feature_cache_dir:
+        print(f"Training mode {args.training_mode} has no frozen tower, ignoring --feature_cache_dir")
+
+    # Draw batches of look-alike items instead of random ones
+    mining_sampler = mining_loader = None
+    if args.hard_negative_refresh and isinstance(dataloader.dataset, IterableDataset):
+        print("Hard-negative mining needs an indexable dataset, ignoring --hard_negative_refresh")
+    elif args.hard_negative_refresh:
+        mining_dataset, collate_fn = dataloader.dataset, dataloader.collate_fn
+        mining_sampler = HardNegativeBatchSampler(len(mining_dataset), args.batch_size, args.cluster_size,
+                                                  num_replicas=world_size, rank=rank)
+        mining_loader = make_loader(mining_dataset, args.batch_size, collate_fn, args.num_workers, device,
+                                    shuffle=False)
+        dataloader = make_loader(mining_dataset, args.batch_size, collate_fn, args.num_workers, device,
+                                 batch_sampler=mining_sampler)
+
+    # Optimizer
+    optimizer = torch.optim.AdamW(trainable_params, lr=args.learning_rate)
+
+    # Continue an interrupted job from its checkpoint; every process loads the same file
+    start_epoch, skip_batches, global_step = 0, 0, 0
+    resume_path = args.resume_from
+    if resume_path == "latest":
+        resume_path = latest_checkpoint(args.checkpoint_dir) if args.checkpoint_dir else None
+    if resume_path:
+        trainer_state = load_checkpoint(resume_path, model, optimizer)
+        start_epoch, skip_batches = trainer_state["epoch"], trainer_state["step_in_epoch"]
+        global_step = trainer_state["global_step"]
+    checkpointer = Checkpointer(args.checkpoint_dir) if args.checkpoint_dir and is_main_process() else None
+
+    # Every process mines the same index from the same weights, so they agree on the batches
+    if mining_sampler is not None:
+        refresh_hard_negatives(model, mining_loader, mining_sampler, device, args.mining_space)
+
+    # Per-step timings, throughput and memory from rank 0, with an optional torch.profiler trace
+    telemetry = None
+    if is_main_process():
+        telemetry = TrainingTelemetry(args.telemetry_log or os.path.join(local_log_dir, "step_telemetry.jsonl"),
+                                      args.log_every, wandb_run, args.trace_dir, args.trace_wait, args.trace_steps,
+                                      start_step=global_step)
 
+    # Training loop
+    reset_peak_memory(device)
+    step_profile = None
+    for epoch in range(start_epoch, args.epochs):
+        skip = skip_batches if epoch == start_epoch else 0
+        # Reshuffle every epoch, leaving out batches a resumed run already trained on
+        if isinstance(dataloader.dataset, ShardedStreamDataset):
+            dataloader.dataset.set_epoch(epoch, skip * args.batch_size)
+        elif isinstance(dataloader.batch_sampler, HardNegativeBatchSampler):
+            dataloader.batch_sampler.set_epoch(epoch, skip * args.batch_size)
+        elif isinstance(dataloader.sampler, ResumableSampler):
+            dataloader.sampler.set_epoch(epoch, skip * args.batch_size)
+
+        def on_step(batch_idx):
+            nonlocal global_step
+            global_step += 1
+            if mining_sampler is not None and global_step % args.hard_negative_refresh == 0:
+                refresh_hard_negatives(model, mining_loader, mining_sampler, device, args.mining_space)
+            if checkpointer and args.checkpoint_every and global_step % args.checkpoint_every == 0:
+                checkpointer.save(model, optimizer, {"epoch": epoch, "step_in_epoch": skip + batch_idx + 1,
+                                                     "global_step": global_step})
+
+        average_loss, step_profile = train_epoch(model, dataloader, optimizer, device,
+                                                 desc=f"Epoch {epoch+1}/{args.epochs}",
+                                                 chunk_size=args.grad_cache_chunk or None, bf16=args.bf16,
+                                                 on_step=on_step, telemetry=telemetry)
+        if is_main_process():
+            print(f"Epoch {epoch+1} step profile: {json.dumps(step_profile)}")
+        if wandb_run is not None:
+            wandb_run.log({"epoch": epoch, "average_loss": average_loss}, step=telemetry.step)
+        if checkpointer:
+            checkpointer.save(model, optimizer, {"epoch": epoch + 1, "step_in_epoch": 0, "global_step": global_step})
+    if checkpointer:
+        checkpointer.close()
+    if telemetry:
+        telemetry.close()
+
+    # Weights are identical on every process; rank 0 reports, saves, evaluates and uploads
+    if is_main_process():
+        training_report = {
+            "training_mode": args.training_mode,
+            "world_size": world_size,
+            "batch_size": args.batch_size,
+            "grad_cache_chunk": args.grad_cache_chunk,
+            "bf16": args.bf16,
+            "hard_negative_refresh": args.hard_negative_refresh,
+            "trainable_params": trainable,
+            "total_params": total,
+            "step_profile": step_profile,
+            "peak_memory_mb": peak_memory_mb(device),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        print(f"Training report: {json.dumps(training_report)}")
+        with open(os.path.join(local_log_dir, "training_report.json"), 'w') as f:
+            json.dump(training_report, f, indent=4)
+
+        # Fold LoRA adapters into the base weights so the saved model is a plain CLIPModel
+        if args.training_mode == "lora":
+            print(f"Merged {merge_lora(model)} LoRA adapters")
+
+        # Save and upload the model
+        model.save_pretrained(local_model_dir)
+        processor.save_pretrained(local_model_dir)
+
+        # add testing code here
+        accuracy = test_model(model, processor, dataset, local_model_dir, device, args.total_test_cases,
+                              args.gallery_size or None)
+
+        upload_to_gcs(local_model_dir, args.output_dir, args.bucket_name, args.upload_workers)
+        print("Training completed and model uploaded successfully.")
+        if wandb_run is not None:
+            wandb_run.summary.update({"accuracy": accuracy, **training_report})
+            wandb_run.finish()
+
+    barrier()
+    cleanup_distributed()
 
-    # add testing code here
-    test_model(model, processor, dataset, local_model_dir, device, args.total_test_cases)
 
-    upload_to_gcs(local_model_dir, args.output_dir, args.bucket_name)
-    print("Training completed and model uploaded successfully.")
+def main():
+    args = parse_args()
+    # Spawn local processes unless a launcher such as torchrun already did
+    if args.num_processes > 1 and "WORLD_SIZE" not in os.environ:
+        run_distributed(train, args.num_processes, args)
+    else:
+        train(args)
 
 
 if __name__ == "__main__":
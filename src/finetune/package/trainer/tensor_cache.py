@@ -0,0 +1,137 @@
+"""
+Preprocessed training tensors for FashionCLIP finetuning.
+
+Decoding and resizing JPEGs with PIL every epoch dominates training time,
+so a category is preprocessed once into a cache directory:
+
+    images.npy          uint8 (N, 3, size, size), read memory-mapped
+    input_ids.npy       int64 (N, max_length), captions tokenized once
+    attention_mask.npy  int64 (N, max_length)
+    meta.json           what the cache was built from, to detect stale caches
+
+CachedFashionDataset serves samples straight from the memory maps, so
+DataLoader workers share the page cache instead of copying images.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from torch.utils.data import Dataset
+
+IMAGE_SIZE = 224
+MAX_LENGTH = 77
+
+
+def load_image_array(args):
+    """Decodes one image and resizes it to size x size, as uint8 CHW."""
+    image_path, size = args
+    with Image.open(image_path) as image:
+        image = image.convert('RGB').resize((size, size), Image.BILINEAR)
+        return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def cache_meta(json_file, n_samples, tokenizer, image_size, max_length):
+    return {
+        "json_file": os.path.abspath(json_file),
+        "json_mtime": os.path.getmtime(json_file),
+        "n_samples": n_samples,
+        "tokenizer": getattr(tokenizer, "name_or_path", type(tokenizer).__name__),
+        "image_size": image_size,
+        "max_length": max_length,
+    }
+
+
+def is_cache_valid(cache_dir, meta):
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        cached = json.load(f)
+    return all(cached.get(key) == value for key, value in meta.items())
+
+
+def build_tensor_cache(json_file, image_dir, cache_dir, tokenizer, n_samples=None,
+                       image_size=IMAGE_SIZE, max_length=MAX_LENGTH, workers=None):
+    """
+    Writes the images and tokenized captions of json_file into cache_dir,
+    unless an up-to-date cache is already there. Returns cache_dir.
+    """
+    meta = cache_meta(json_file, n_samples, tokenizer, image_size, max_length)
+    if is_cache_valid(cache_dir, meta):
+        print(f"Tensor cache at {cache_dir} is up to date")
+        return cache_dir
+
+    with open(json_file, 'r') as f:
+        data = json.load(f)[:n_samples]
+    os.makedirs(cache_dir, exist_ok=True)
+    print(f"Preprocessing {len(data)} images into {cache_dir}...")
+
+    # Tokenize every caption once, padded to a fixed width
+    tokens = tokenizer([item['caption'] for item in data], padding="max_length", truncation=True,
+                       max_length=max_length, return_tensors="np")
+    np.save(os.path.join(cache_dir, "input_ids.npy"), tokens["input_ids"].astype(np.int64))
+    np.save(os.path.join(cache_dir, "attention_mask.npy"), tokens["attention_mask"].astype(np.int64))
+
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, "images.npy"), mode="w+",
+                                       dtype=np.uint8, shape=(len(data), 3, image_size, image_size))
+    jobs = [(os.path.join(image_dir, item['image']), image_size) for item in data]
+    # Decoding is CPU bound, so spread it over processes
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for idx, array in enumerate(executor.map(load_image_array, jobs, chunksize=32)):
+            images[idx] = array
+    images.flush()
+    del images
+
+    # meta.json is written last, so an interrupted build is rebuilt next time
+    meta["count"] = len(data)
+    with open(os.path.join(cache_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+    return cache_dir
+
+
+class CachedFashionDataset(Dataset):
+    """
+    Serves (image, input_ids, attention_mask) from a tensor cache. Images
+    are uint8 CHW tensors viewing the memory map; the maps are opened lazily
+    so every DataLoader worker gets its own handle. With image_mean and
+    image_std, images are normalized to CLIP pixel_values in the worker.
+    """
+
+    def __init__(self, cache_dir, image_mean=None, image_std=None):
+        self.cache_dir = cache_dir
+        self.image_mean = torch.tensor(image_mean).view(3, 1, 1) if image_mean is not None else None
+        self.image_std = torch.tensor(image_std).view(3, 1, 1) if image_std is not None else None
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.images = None
+        self.input_ids = None
+        self.attention_mask = None
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _open(self):
+        # Copy-on-write maps give writable arrays without touching the files
+        self.images = np.load(os.path.join(self.cache_dir, "images.npy"), mmap_mode="c")
+        self.input_ids = np.load(os.path.join(self.cache_dir, "input_ids.npy"), mmap_mode="c")
+        self.attention_mask = np.load(os.path.join(self.cache_dir, "attention_mask.npy"), mmap_mode="c")
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self._open()
+        image = torch.from_numpy(self.images[idx])
+        if self.image_mean is not None:
+            image = (image.float() / 255 - self.image_mean) / self.image_std
+        return (image,
+                torch.from_numpy(self.input_ids[idx]),
+                torch.from_numpy(self.attention_mask[idx]))
+
+
+def trim_padding(batch):
+    """Collates (image, input_ids, attention_mask) samples and drops padding no caption in the batch uses."""
+    images, input_ids, attention_mask = (torch.stack(column) for column in zip(*batch))
+    length = int(attention_mask.sum(dim=1).max())
+    return images, input_ids[:, :length], attention_mask[:, :length]
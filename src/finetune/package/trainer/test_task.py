@@ -0,0 +1,835 @@
+import functools
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from transformers import CLIPConfig, CLIPImageProcessor, CLIPModel, CLIPProcessor, CLIPTokenizer
+
+from trainer import task
+from trainer.checkpointing import Checkpointer, ResumableSampler, latest_checkpoint, load_checkpoint
+from trainer.distributed import broadcast_parameters, cleanup_distributed, init_distributed, run_distributed
+from trainer.evaluation import evaluate_categories, match_ranks, retrieval_metrics
+from trainer.feature_cache import FeatureDataset, build_feature_cache, collate_features, feature_cache_meta
+from trainer.hard_negatives import HardNegativeBatchSampler, exact_neighbours, mining_embeddings
+from trainer.profiling import StepProfile, TrainingTelemetry
+from trainer.shards import ShardedStreamDataset, mix_streams, read_shard, write_shards
+from trainer.task import (DIR_DICT, FashionDataset, ImageDataset, category_paths, clip_transform,
+                          contrastive_embeddings, contrastive_loss, download_from_gcs, encode_images, encode_texts,
+                          file_crc32c, grad_cache_backward, make_loader, prepare_category_data,
+                          refresh_hard_negatives, search_similar_images, train_epoch, training_inputs,
+                          upload_to_gcs)
+from trainer.tensor_cache import CachedFashionDataset, build_tensor_cache, trim_padding
+from trainer.training_modes import LoRALinear, configure_training_mode, count_parameters, merge_lora
+
+
+def make_processor(tmp_path, image_size=30):
+    """A tiny CLIP tokenizer and image processor that need no download."""
+    tokens = ["<|startoftext|>", "<|endoftext|>", "!"] + [chr(c) for c in range(ord("a"), ord("z") + 1)] + \
+        [chr(c) + "</w>" for c in range(ord("a"), ord("z") + 1)]
+    vocab_file = tmp_path / "vocab.json"
+    vocab_file.write_text(json.dumps({token: i for i, token in enumerate(tokens)}))
+    merges_file = tmp_path / "merges.txt"
+    merges_file.write_text("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(str(vocab_file), str(merges_file), pad_token="!")
+    image_processor = CLIPImageProcessor(size={"shortest_edge": image_size},
+                                         crop_size={"height": image_size, "width": image_size}, do_rescale=False)
+    return CLIPProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+
+def make_model(image_size=30, patch_size=6):
+    torch.manual_seed(0)
+    config = CLIPConfig(
+        text_config=dict(hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+                         vocab_size=60, max_position_embeddings=77, bos_token_id=0, eos_token_id=1, pad_token_id=2),
+        vision_config=dict(hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+                           image_size=image_size, patch_size=patch_size),
+        projection_dim=16)
+    return CLIPModel(config).eval()
+
+
+def make_category(tmp_path, count):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    data = []
+    for i in range(count):
+        name = f"image_{i}.jpg"
+        Image.new("RGB", (40, 40), color=(i * 40 % 256, i * 90 % 256, i * 20 % 256)).save(image_dir / name)
+        data.append({"image": name, "caption": f"style {chr(ord('a') + i % 26)} casual cotton"})
+    json_file = tmp_path / "category.json"
+    json_file.write_text(json.dumps(data))
+    return str(json_file), str(image_dir)
+
+
+def make_data_root(tmp_path, categories, count):
+    """A local copy of the buckets holding count images of each category, as read with --data_root."""
+    data_root = tmp_path / "data"
+    for category in categories:
+        (tmp_path / category).mkdir()
+        json_file, image_dir = make_category(tmp_path / category, count)
+        local_json_path, local_image_dir = category_paths(category, str(data_root))
+        os.renames(json_file, local_json_path)
+        os.renames(image_dir, local_image_dir)
+    return str(data_root)
+
+
+transform = transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor()])
+
+
+@pytest.fixture
+def processor(tmp_path):
+    return make_processor(tmp_path)
+
+
+@pytest.fixture
+def model():
+    return make_model()
+
+
+@pytest.fixture
+def category(tmp_path):
+    """Builds a category of count images in tmp_path, returning its (json_file, image_dir)."""
+    return functools.partial(make_category, tmp_path)
+
+
+def test_encode_images_and_texts_are_normalised(model, processor, category):
+    json_file, image_dir = category(5)
+    loader = DataLoader(ImageDataset(5, json_file, image_dir, transform), batch_size=2)
+
+    image_embeddings, image_paths = encode_images(model, processor, loader, "cpu")
+    text_embeddings = encode_texts(model, processor, ["casual", "formal silk", "red"], "cpu", batch_size=2)
+
+    assert image_embeddings.shape == (5, 16)
+    assert text_embeddings.shape == (3, 16)
+    assert len(image_paths) == 5
+    assert torch.allclose(image_embeddings.norm(dim=-1), torch.ones(5), atol=1e-5)
+
+
+def test_model_encodes_the_gallery_once(tmp_path, model, processor, category):
+    json_file, image_dir = category(12)
+    dataset = FashionDataset(json_file, image_dir, transform)
+
+    calls = {"image": 0, "text": 0}
+    get_image_features, get_text_features = model.get_image_features, model.get_text_features
+
+    def count_image(**kwargs):
+        calls["image"] += 1
+        return get_image_features(**kwargs)
+
+    def count_text(**kwargs):
+        calls["text"] += 1
+        return get_text_features(**kwargs)
+
+    model.get_image_features, model.get_text_features = count_image, count_text
+    accuracy = task.test_model(model, processor, dataset, str(tmp_path), "cpu", total_test_cases=10, gallery_size=None)
+
+    # One pass over the 12 images (batch size 32) and one over the 10 captions
+    assert calls == {"image": 1, "text": 1}
+    assert 0.0 <= accuracy <= 1.0
+    with open(os.path.join(tmp_path, "test_results.json")) as f:
+        assert json.load(f)["accuracy"] == accuracy
+
+
+def test_search_similar_images_matches_precomputed_gallery(model, processor, category):
+    json_file, image_dir = category(7)
+    loader = DataLoader(ImageDataset(7, json_file, image_dir, transform), batch_size=3)
+
+    best, probs, top5 = search_similar_images("casual cotton", loader, model, processor, "cpu")
+    image_embeddings, image_paths = encode_images(model, processor, loader, "cpu")
+    best_pre, probs_pre, top5_pre = search_similar_images("casual cotton", loader, model, processor, "cpu",
+                                                          image_embeddings, image_paths)
+
+    assert best == best_pre and top5 == top5_pre
+    assert probs.sum().item() == pytest.approx(1.0, abs=1e-5)
+
+
+def test_retrieval_metrics_from_ranks():
+    # Query 0 ranks its item first, query 1 second, query 2 third
+    similarity = torch.tensor([[0.9, 0.1, 0.0],
+                               [0.8, 0.5, 0.1],
+                               [0.7, 0.6, 0.2]])
+
+    assert match_ranks(similarity).tolist() == [1, 2, 3]
+    metrics = retrieval_metrics(similarity, ks=(1, 2))
+    assert metrics["recall@1"] == pytest.approx(1 / 3)
+    assert metrics["recall@2"] == pytest.approx(2 / 3)
+    assert metrics["mrr"] == pytest.approx((1 + 1 / 2 + 1 / 3) / 3)
+    assert metrics["median_rank"] == 2
+
+
+def test_evaluate_categories_reports_and_reuses_cached_embeddings(tmp_path, model, processor, category):
+    json_file, image_dir = category(6)
+    cache_dir = str(tmp_path / "cache")
+    model_dir = str(tmp_path / "model")
+    model.save_pretrained(model_dir)
+
+    def data_source(category, n_samples):
+        return json_file, image_dir
+
+    first = evaluate_categories(model, processor, model_dir, ["men_shoes", "women_shoes"], "cpu",
+                                cache_dir, data_source=data_source)
+    second = evaluate_categories(model, processor, model_dir, ["men_shoes"], "cpu",
+                                 cache_dir, data_source=data_source)
+    # Retrained weights or recaptioned data are encoded again
+    os.utime(os.path.join(model_dir, "model.safetensors"), ns=(1, 1))
+    retrained = evaluate_categories(model, processor, model_dir, ["men_shoes"], "cpu",
+                                    cache_dir, data_source=data_source)
+    os.utime(json_file, ns=(1, 1))
+    recaptioned = evaluate_categories(model, processor, model_dir, ["men_shoes"], "cpu",
+                                      cache_dir, data_source=data_source)
+
+    shoes = first["categories"]["men_shoes"]
+    assert set(shoes["text_to_image"]) == {"recall@1", "recall@5", "recall@10", "mrr", "median_rank", "queries"}
+    assert shoes["text_to_image"]["recall@10"] == 1.0
+    assert shoes["throughput"]["images_per_second"] > 0
+    assert shoes["search_latency"]["p50_ms"] >= 0
+    assert first["overall"]["image_to_text"]["queries"] == 12
+    assert shoes["embeddings_cached"] is False
+    assert second["categories"]["men_shoes"]["embeddings_cached"] is True
+    assert second["categories"]["men_shoes"]["text_to_image"] == shoes["text_to_image"]
+    assert retrained["categories"]["men_shoes"]["embeddings_cached"] is False
+    assert recaptioned["categories"]["men_shoes"]["embeddings_cached"] is False
+    json.dumps(first)
+
+
+def test_download_from_gcs_fetches_only_missing_needed_images(tmp_path):
+    json_file = tmp_path / "shoes.json"
+    json_file.write_text(json.dumps([{"image": f"image_{i}.jpg", "caption": "c"} for i in range(4)]))
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    (image_dir / "image_0.jpg").write_bytes(b"already here")
+
+    blobs = [SimpleNamespace(name=f"scrapped_data/shoes/image_{i}.jpg") for i in range(10)]
+    client = MagicMock()
+    client.list_blobs.return_value = blobs
+
+    with patch("trainer.task.storage.Client", return_value=client), \
+            patch("trainer.task.transfer_manager.download_many", return_value=[None, None]) as download_many:
+        downloaded = download_from_gcs("gs://bucket/shoes.json", "gs://bucket/scrapped_data/shoes",
+                                       str(json_file), str(image_dir), n_samples=3, workers=4)
+
+    pairs = download_many.call_args.args[0]
+    assert [blob.name for blob, _ in pairs] == ["scrapped_data/shoes/image_1.jpg", "scrapped_data/shoes/image_2.jpg"]
+    assert pairs[0][1] == os.path.join(str(image_dir), "image_1.jpg")
+    assert download_many.call_args.kwargs["max_workers"] == 4
+    assert downloaded == 2
+    client.list_blobs.assert_called_once_with("bucket", prefix="scrapped_data/shoes")
+
+
+def test_prepare_category_data_reads_a_local_data_root(tmp_path):
+    json_path = tmp_path / DIR_DICT["men_shoes"]["json_path"].replace("gs://", "")
+    image_dir = tmp_path / DIR_DICT["men_shoes"]["image_dir"].replace("gs://", "")
+    json_path.parent.mkdir(parents=True)
+    image_dir.mkdir(parents=True)
+    json_path.write_text(json.dumps([{"image": "image_0.jpg", "caption": "c"}]))
+
+    with patch("trainer.task.storage.Client") as client:
+        paths = prepare_category_data("men_shoes", data_root=str(tmp_path))
+
+    assert paths == (str(json_path), str(image_dir))
+    client.assert_not_called()
+
+
+def test_tensor_cache_round_trip_and_reuse(tmp_path, processor, category):
+    json_file, image_dir = category(5)
+    cache_dir = str(tmp_path / "tensor_cache")
+
+    build_tensor_cache(json_file, image_dir, cache_dir, processor.tokenizer, image_size=32, workers=2)
+    built_at = os.path.getmtime(os.path.join(cache_dir, "images.npy"))
+    build_tensor_cache(json_file, image_dir, cache_dir, processor.tokenizer, image_size=32, workers=2)
+    assert os.path.getmtime(os.path.join(cache_dir, "images.npy")) == built_at
+
+    dataset = CachedFashionDataset(cache_dir)
+    image, input_ids, attention_mask = dataset[1]
+    assert len(dataset) == 5
+    assert image.dtype == torch.uint8 and image.shape == (3, 32, 32)
+    assert input_ids.shape == attention_mask.shape == (77,)
+    # The first image is solid black, the second is not
+    assert dataset[0][0].max() == 0 and image.max() > 0
+
+    loader = DataLoader(dataset, batch_size=4, num_workers=2, collate_fn=trim_padding)
+    images, input_ids, attention_mask = next(iter(loader))
+    assert images.shape == (4, 3, 32, 32)
+    assert input_ids.shape[1] == attention_mask.sum(dim=1).max() < 77
+
+
+def test_tensor_cache_batches_feed_the_model(tmp_path, model, processor, category):
+    json_file, image_dir = category(4)
+    cache_dir = str(tmp_path / "tensor_cache")
+    build_tensor_cache(json_file, image_dir, cache_dir, processor.tokenizer, image_size=30)
+
+    dataset = CachedFashionDataset(cache_dir, processor.image_processor.image_mean, processor.image_processor.image_std)
+    batch = trim_padding([dataset[i] for i in range(4)])
+    inputs = training_inputs(batch, torch.device("cpu"))
+    outputs = model(**inputs)
+
+    assert outputs.logits_per_image.shape == (4, 4)
+
+
+def test_tokenized_dataset_matches_processor_output(processor, category):
+    json_file, image_dir = category(3)
+    dataset = FashionDataset(json_file, image_dir, transform=clip_transform(processor, image_size=30),
+                             tokenizer=processor.tokenizer)
+
+    pixel_values, input_ids, attention_mask = trim_padding([dataset[i] for i in range(3)])
+    images = [Image.open(os.path.join(image_dir, item["image"])).convert("RGB").resize((30, 30))
+              for item in dataset.data]
+    expected = processor(text=[item["caption"] for item in dataset.data],
+                         images=torch.stack([transforms.ToTensor()(image) for image in images]),
+                         return_tensors="pt", padding=True)
+
+    assert torch.equal(input_ids, expected["input_ids"])
+    assert torch.equal(attention_mask, expected["attention_mask"])
+    assert torch.allclose(pixel_values, expected["pixel_values"], atol=0.05)
+
+
+def test_step_profile_splits_step_time():
+    profile = StepProfile("cpu")
+    for _ in profile.iterate(range(3)):
+        with profile.phase("forward"):
+            time.sleep(0.01)
+        with profile.phase("backward"):
+            time.sleep(0.02)
+
+    summary = profile.summary()
+    assert summary["steps"] == 3
+    assert summary["backward_ms"] > summary["forward_ms"] >= 10
+    assert sum(summary[f"{phase}_fraction"] for phase in StepProfile.PHASES) == pytest.approx(1.0)
+
+
+def cached_loader(tmp_path, processor, count=4):
+    json_file, image_dir = make_category(tmp_path, count)
+    cache_dir = str(tmp_path / "tensor_cache")
+    build_tensor_cache(json_file, image_dir, cache_dir, processor.tokenizer, image_size=30)
+    dataset = CachedFashionDataset(cache_dir, processor.image_processor.image_mean, processor.image_processor.image_std)
+    return DataLoader(dataset, batch_size=count, collate_fn=trim_padding)
+
+
+@pytest.mark.parametrize("mode", ["full", "frozen_vision", "projection", "lora"])
+def test_training_modes_only_update_trainable_parameters(tmp_path, mode, processor, model):
+    loader = cached_loader(tmp_path, processor)
+    _, total_before = count_parameters(model)
+
+    params = configure_training_mode(model, mode, lora_rank=4)
+    trainable, total = count_parameters(model)
+    frozen = {name: param.detach().clone() for name, param in model.named_parameters() if not param.requires_grad}
+    train_epoch(model, loader, torch.optim.AdamW(params, lr=1e-2), "cpu")
+
+    assert trainable == sum(param.numel() for param in params)
+    if mode == "full":
+        assert trainable == total == total_before
+    else:
+        assert 0 < trainable < total_before
+    if mode == "lora":
+        # 2 towers x 2 layers x 4 attention projections
+        assert sum(isinstance(module, LoRALinear) for module in model.modules()) == 16
+    for name, param in model.named_parameters():
+        if name in frozen:
+            assert torch.equal(param, frozen[name]), name
+
+
+def test_merged_lora_model_matches_adapted_model(tmp_path, processor, model):
+    batch = next(iter(cached_loader(tmp_path, processor)))
+    configure_training_mode(model, "lora", lora_rank=4)
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            torch.nn.init.normal_(module.lora_b, std=0.1)
+
+    with torch.no_grad():
+        adapted = model(**training_inputs(batch, "cpu")).logits_per_image
+        assert merge_lora(model) == 16
+        merged = model(**training_inputs(batch, "cpu")).logits_per_image
+
+    assert not any(isinstance(module, LoRALinear) for module in model.modules())
+    assert torch.allclose(adapted, merged, atol=1e-4)
+    model.save_pretrained(tmp_path / "merged")
+    reloaded = CLIPModel.from_pretrained(tmp_path / "merged").eval()
+    with torch.no_grad():
+        assert torch.allclose(reloaded(**training_inputs(batch, "cpu")).logits_per_image, merged, atol=1e-4)
+
+
+@pytest.mark.parametrize("mode,towers", [("frozen_vision", ("vision",)), ("projection", ("vision", "text"))])
+def test_feature_cache_reproduces_model_logits(tmp_path, mode, towers, processor, model):
+    loader = cached_loader(tmp_path, processor)
+    params = configure_training_mode(model, mode)
+    cache_dir = str(tmp_path / "features")
+
+    build_feature_cache(model, loader, cache_dir, "cpu", towers, {"model_name": "tiny"})
+    built_at = os.path.getmtime(os.path.join(cache_dir, "image_features.npy"))
+    build_feature_cache(model, loader, cache_dir, "cpu", towers, {"model_name": "tiny"})
+    assert os.path.getmtime(os.path.join(cache_dir, "image_features.npy")) == built_at
+
+    feature_loader = DataLoader(FeatureDataset(cache_dir), batch_size=4, collate_fn=collate_features)
+    feature_batch = next(iter(feature_loader))
+    assert ("text_features" in feature_batch) == ("text" in towers)
+    with torch.no_grad():
+        expected = model(**training_inputs(next(iter(loader)), "cpu")).logits_per_image
+        image_embeds, text_embeds = contrastive_embeddings(model, feature_batch, "cpu")
+    logits_per_image = model.logit_scale.exp() * image_embeds @ text_embeds.T
+    assert torch.allclose(logits_per_image, expected, atol=1e-4)
+
+    projection = model.visual_projection.weight.detach().clone()
+    train_epoch(model, feature_loader, torch.optim.AdamW(params, lr=1e-2), "cpu")
+    assert not torch.equal(model.visual_projection.weight, projection)
+
+
+def test_feature_cache_is_rebuilt_when_its_data_changes(tmp_path, processor, model):
+    loader = cached_loader(tmp_path, processor)
+    json_file = str(tmp_path / "category.json")
+    cache_dir = str(tmp_path / "features")
+    feature_path = os.path.join(cache_dir, "image_features.npy")
+
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta("tiny", json_file, None, 4))
+    built_at = os.stat(feature_path).st_mtime_ns
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta("tiny", json_file, 3, 4))
+    resampled_at = os.stat(feature_path).st_mtime_ns
+    os.utime(json_file, ns=(1, 1))
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta("tiny", json_file, 3, 4))
+
+    assert built_at != resampled_at != os.stat(feature_path).st_mtime_ns
+
+
+def test_feature_cache_is_rebuilt_when_the_weights_change(tmp_path, processor, model):
+    loader = cached_loader(tmp_path, processor)
+    json_file = str(tmp_path / "category.json")
+    cache_dir = str(tmp_path / "features")
+    feature_path = os.path.join(cache_dir, "image_features.npy")
+    model_dir = str(tmp_path / "checkpoint")
+    model.save_pretrained(model_dir)
+
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta(model_dir, json_file, 3, 4))
+    built_at = os.stat(feature_path).st_mtime_ns
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta(model_dir, json_file, 3, 4))
+    assert os.stat(feature_path).st_mtime_ns == built_at
+
+    model.save_pretrained(model_dir)
+    os.utime(os.path.join(model_dir, "model.safetensors"), ns=(1, 1))
+    build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), feature_cache_meta(model_dir, json_file, 3, 4))
+    assert os.stat(feature_path).st_mtime_ns != built_at
+
+
+def _distributed_worker(cache_dir, output_dir, image_mean, image_std):
+    rank, world_size = init_distributed()
+    model = make_model()
+    # Different adapter initializations per rank, which the broadcast must overwrite
+    torch.manual_seed(rank)
+    params = configure_training_mode(model, "lora", lora_rank=4)
+    broadcast_parameters(model)
+
+    loader = make_loader(CachedFashionDataset(cache_dir, image_mean, image_std), 2, trim_padding, 0,
+                         torch.device("cpu"))
+    loader.sampler.set_epoch(0)
+    indices = list(loader.sampler)
+    train_epoch(model, loader, torch.optim.AdamW(params, lr=1e-2), "cpu")
+    torch.save({"indices": indices, "world_size": world_size, "state": model.state_dict()},
+               os.path.join(output_dir, f"rank{rank}.pt"))
+    cleanup_distributed()
+
+
+def test_distributed_training_shards_data_and_keeps_replicas_in_sync(tmp_path, processor, category):
+    json_file, image_dir = category(8)
+    cache_dir = str(tmp_path / "tensor_cache")
+    build_tensor_cache(json_file, image_dir, cache_dir, processor.tokenizer, image_size=30)
+
+    run_distributed(_distributed_worker, 2, cache_dir, str(tmp_path),
+                    processor.image_processor.image_mean, processor.image_processor.image_std)
+
+    ranks = [torch.load(tmp_path / f"rank{rank}.pt") for rank in range(2)]
+    assert all(result["world_size"] == 2 for result in ranks)
+    assert set(ranks[0]["indices"]).isdisjoint(ranks[1]["indices"])
+    assert sorted(ranks[0]["indices"] + ranks[1]["indices"]) == list(range(8))
+    for name, tensor in ranks[0]["state"].items():
+        assert torch.equal(tensor, ranks[1]["state"][name]), name
+
+
+@pytest.mark.parametrize("feature_batch", [False, True])
+def test_grad_cache_matches_full_batch_gradients(tmp_path, feature_batch, processor, model):
+    loader = cached_loader(tmp_path, processor, count=6)
+    configure_training_mode(model, "frozen_vision")
+    batch = next(iter(loader))
+    if feature_batch:
+        cache_dir = str(tmp_path / "features")
+        build_feature_cache(model, loader, cache_dir, "cpu", ("vision",), {"model_name": "tiny"})
+        batch = collate_features([FeatureDataset(cache_dir)[i] for i in range(6)])
+    no_autocast = functools.partial(torch.autocast, device_type="cpu", enabled=False)
+
+    loss = contrastive_loss(*contrastive_embeddings(model, batch, "cpu"), model.logit_scale)
+    loss.backward()
+    expected = {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+    model.zero_grad()
+
+    cached_loss = grad_cache_backward(model, batch, "cpu", 2, no_autocast)
+
+    assert cached_loss.item() == pytest.approx(loss.item(), rel=1e-5)
+    assert set(expected) == {name for name, param in model.named_parameters() if param.grad is not None}
+    for name, param in model.named_parameters():
+        if name in expected:
+            assert torch.allclose(param.grad, expected[name], atol=1e-5), name
+
+
+def test_train_epoch_with_grad_cache_and_bf16(tmp_path, processor, model):
+    loader = cached_loader(tmp_path, processor, count=6)
+    params = configure_training_mode(model, "full")
+
+    loss, profile = train_epoch(model, loader, torch.optim.AdamW(params, lr=1e-3), "cpu", chunk_size=2, bf16=True)
+
+    assert math.isfinite(loss)
+    assert profile["steps"] == 1
+
+
+def resumable_loader(tmp_path, processor, count=6, batch_size=2):
+    loader = cached_loader(tmp_path, processor, count=count)
+    return DataLoader(loader.dataset, batch_size=batch_size, sampler=ResumableSampler(loader.dataset),
+                      collate_fn=trim_padding)
+
+
+def test_resumable_sampler_skips_consumed_samples():
+    sampler = ResumableSampler(list(range(10)), seed=3)
+    sampler.set_epoch(1)
+    order = list(sampler)
+
+    sampler.set_epoch(1, skip=4)
+
+    assert sorted(order) == list(range(10))
+    assert list(sampler) == order[4:]
+    assert len(sampler) == 6
+
+
+def test_checkpoint_round_trip_restores_training_state(tmp_path, processor, model):
+    loader = cached_loader(tmp_path, processor)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    train_epoch(model, loader, optimizer, "cpu")
+    checkpointer = Checkpointer(str(tmp_path / "checkpoints"), keep_last=2)
+    for step in range(1, 4):
+        checkpointer.save(model, optimizer, {"epoch": 0, "step_in_epoch": step, "global_step": step})
+    checkpointer.close()
+    expected_random = torch.rand(3)
+
+    restored = make_model()
+    restored_optimizer = torch.optim.AdamW(restored.parameters(), lr=1e-3)
+    path = latest_checkpoint(str(tmp_path / "checkpoints"))
+    trainer_state = load_checkpoint(path, restored, restored_optimizer)
+
+    assert sorted(os.listdir(tmp_path / "checkpoints")) == ["checkpoint-00000002.safetensors",
+                                                            "checkpoint-00000003.safetensors"]
+    assert trainer_state == {"epoch": 0, "step_in_epoch": 3, "global_step": 3}
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, restored.state_dict()[name]), name
+    expected_state = optimizer.state_dict()
+    restored_state = restored_optimizer.state_dict()
+    # JSON metadata turns tuples such as betas into lists
+    assert json.loads(json.dumps(expected_state["param_groups"])) == \
+        json.loads(json.dumps(restored_state["param_groups"]))
+    for param_id, param_state in expected_state["state"].items():
+        for key, value in param_state.items():
+            assert torch.equal(value, restored_state["state"][param_id][key]), (param_id, key)
+    assert torch.equal(torch.rand(3), expected_random)
+
+
+def test_resumed_training_matches_uninterrupted_run(tmp_path, processor, model):
+    loader = resumable_loader(tmp_path, processor)
+    checkpointer = Checkpointer(str(tmp_path / "checkpoints"))
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    loader.sampler.set_epoch(0)
+
+    def on_step(batch_idx):
+        if batch_idx == 0:
+            checkpointer.save(model, optimizer, {"epoch": 0, "step_in_epoch": 1, "global_step": 1})
+
+    train_epoch(model, loader, optimizer, "cpu", on_step=on_step)
+    checkpointer.close()
+
+    resumed = make_model()
+    resumed_optimizer = torch.optim.AdamW(resumed.parameters(), lr=1e-3)
+    trainer_state = load_checkpoint(latest_checkpoint(str(tmp_path / "checkpoints")), resumed, resumed_optimizer)
+    loader.sampler.set_epoch(trainer_state["epoch"], trainer_state["step_in_epoch"] * loader.batch_size)
+    _, profile = train_epoch(resumed, loader, resumed_optimizer, "cpu")
+
+    assert profile["steps"] == 2
+    for name, tensor in model.state_dict().items():
+        assert torch.allclose(tensor, resumed.state_dict()[name], atol=1e-6), name
+
+
+def make_shards(tmp_path, counts, samples_per_shard=4):
+    category_files = {}
+    for category, count in counts.items():
+        (tmp_path / category).mkdir()
+        category_files[category] = make_category(tmp_path / category, count)
+    shard_dir = str(tmp_path / "shards")
+    write_shards(category_files, shard_dir, samples_per_shard=samples_per_shard)
+    return shard_dir
+
+
+def test_write_shards_packs_every_category_and_reuses_shards(tmp_path, capsys):
+    shard_dir = make_shards(tmp_path, {"shoes": 6, "bags": 3})
+
+    with open(os.path.join(shard_dir, "meta.json")) as f:
+        meta = json.load(f)
+    assert [(shard["path"], shard["count"]) for shard in meta["shards"]] == \
+        [("shoes-00000.tar", 4), ("shoes-00001.tar", 2), ("bags-00000.tar", 3)]
+    samples = list(read_shard(os.path.join(shard_dir, "shoes-00001.tar")))
+    assert [caption for _, caption in samples] == ["style e casual cotton", "style f casual cotton"]
+    assert Image.open(io.BytesIO(samples[0][0])).size == (40, 40)
+
+    write_shards({category: (str(tmp_path / category / "category.json"), str(tmp_path / category / "images"))
+                  for category in ("shoes", "bags")}, shard_dir, samples_per_shard=4)
+    assert "up to date" in capsys.readouterr().out
+
+
+def test_mix_streams_draws_by_weight():
+    streams = [itertools.repeat("shoes"), itertools.repeat("bags")]
+
+    balanced = list(itertools.islice(mix_streams(streams, [1, 1], random.Random(0)), 1000))
+    proportional = list(itertools.islice(mix_streams(streams, [3, 1], random.Random(0)), 1000))
+
+    assert 450 < balanced.count("bags") < 550
+    assert 200 < proportional.count("bags") < 300
+    assert list(mix_streams([iter("ab"), iter("c")], [1, 1], random.Random(0))).count("a") == 1
+
+
+def stream_batches(dataset, num_workers=0):
+    loader = task.make_loader(dataset, dataset.batch_size, None, num_workers, torch.device("cpu"))
+    return [input_ids for _, input_ids, _ in loader]
+
+
+def test_sharded_stream_is_balanced_and_resumes_deterministically(tmp_path, processor):
+    shard_dir = make_shards(tmp_path, {"shoes": 12, "bags": 4})
+    dataset = ShardedStreamDataset(shard_dir, 2, transform=clip_transform(processor, 30),
+                                   tokenizer=processor.tokenizer, shuffle_buffer=4)
+
+    dataset.set_epoch(1)
+    batches = stream_batches(dataset, num_workers=2)
+    # Three batches in, so the second worker's stream comes first
+    dataset.set_epoch(1, skip=6)
+    resumed = stream_batches(dataset, num_workers=2)
+
+    assert len(batches) == 8
+    assert len(resumed) == 5
+    for expected, batch in zip(batches[3:], resumed):
+        assert torch.equal(expected, batch)
+    dataset.set_epoch(2)
+    assert not all(torch.equal(a, b) for a, b in zip(batches, stream_batches(dataset)))
+
+
+def test_sharded_stream_splits_shards_between_processes(tmp_path, processor):
+    shard_dir = make_shards(tmp_path, {"shoes": 8}, samples_per_shard=2)
+    ranks = [ShardedStreamDataset(shard_dir, 2, transform=clip_transform(processor, 30),
+                                  tokenizer=processor.tokenizer, shuffle_buffer=0, num_replicas=2, rank=rank)
+             for rank in range(2)]
+
+    batches = [stream_batches(dataset) for dataset in ranks]
+
+    assert [len(rank_batches) for rank_batches in batches] == [2, 2]
+    captions = [{tuple(ids.tolist()) for input_ids in rank_batches for ids in input_ids} for rank_batches in batches]
+    assert captions[0].isdisjoint(captions[1])
+    assert len(captions[0] | captions[1]) == 8
+
+
+def test_sharded_stream_workers_read_their_own_shards(tmp_path, processor):
+    shard_dir = make_shards(tmp_path, {"shoes": 16, "bags": 2}, samples_per_shard=2)
+    dataset = ShardedStreamDataset(shard_dir, 2, transform=clip_transform(processor, 30),
+                                   tokenizer=processor.tokenizer, shuffle_buffer=0)
+
+    shards_read, batches = [], []
+    for worker_id in range(2):
+        with patch("trainer.shards.get_worker_info", return_value=SimpleNamespace(id=worker_id, num_workers=2)), \
+                patch("trainer.shards.read_shard", side_effect=read_shard) as reader:
+            batches.append(list(dataset))
+        shards_read.append({os.path.basename(call.args[0]) for call in reader.call_args_list})
+
+    assert [len(worker_batches) for worker_batches in batches] == [5, 4]
+    # Shoes shards are split between the workers, the single bags shard is shared
+    assert shards_read[0] & shards_read[1] == {"bags-00000.tar"}
+
+
+def test_train_rejects_shards_without_a_batch(tmp_path, monkeypatch):
+    data_root = make_data_root(tmp_path, ["men_shoes"], 2)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["task.py", "--category", "men_shoes", "--data_root", data_root,
+                                      "--shard_dir", "shards", "--categories", "men_shoes", "--batch_size", "4"])
+
+    with patch("trainer.task.CLIPProcessor.from_pretrained", return_value=make_processor(tmp_path, 224)), \
+            patch("trainer.task.CLIPModel.from_pretrained", return_value=make_model(224, 32)), \
+            pytest.raises(ValueError, match="fewer than one batch of 4"):
+        task.main()
+
+
+def test_exact_neighbours_rank_other_items_by_similarity():
+    embeddings = torch.nn.functional.normalize(torch.tensor([[1.0, 0.0], [0.9, 0.1], [0.0, 1.0], [0.1, 0.9]]), dim=1)
+
+    assert exact_neighbours(embeddings, 2, chunk_size=3) == [[1, 3], [0, 3], [3, 1], [2, 1]]
+    joint = mining_embeddings(embeddings, embeddings.flip(1), "joint")
+    assert torch.allclose(joint.norm(dim=1), torch.ones(4))
+
+
+def test_hard_negative_batches_are_clusters_of_neighbours():
+    # Items 4k..4k+3 are each other's neighbours
+    neighbours = [[4 * (i // 4) + j for j in range(4) if 4 * (i // 4) + j != i] for i in range(16)]
+    sampler = HardNegativeBatchSampler(16, batch_size=4, cluster_size=4)
+    random_batches = list(sampler)
+    sampler.update(neighbours)
+
+    batches = list(sampler)
+
+    assert len(batches) == len(random_batches) == 4
+    assert sorted(i for batch in batches for i in batch) == list(range(16))
+    assert all(len({i // 4 for i in batch}) == 1 for batch in batches)
+    sampler.set_epoch(0, skip=8)
+    assert list(sampler) == batches[2:]
+    ranks = [HardNegativeBatchSampler(16, 4, 4, num_replicas=2, rank=rank) for rank in range(2)]
+    for rank_sampler in ranks:
+        rank_sampler.update(neighbours)
+    assert [list(rank_sampler) for rank_sampler in ranks] == [batches[0::2], batches[1::2]]
+
+
+def test_training_on_mined_hard_negatives(tmp_path, processor, model):
+    loader = cached_loader(tmp_path, processor, count=8)
+    params = configure_training_mode(model, "full")
+    sampler = HardNegativeBatchSampler(len(loader.dataset), batch_size=4, cluster_size=2)
+    mining_loader = task.make_loader(loader.dataset, 4, trim_padding, 0, torch.device("cpu"), shuffle=False)
+    train_loader = task.make_loader(loader.dataset, 4, trim_padding, 0, torch.device("cpu"), batch_sampler=sampler)
+
+    refresh_hard_negatives(model, mining_loader, sampler, "cpu", "image")
+    loss, profile = train_epoch(model, train_loader, torch.optim.AdamW(params, lr=1e-3), "cpu")
+
+    assert len(sampler.neighbours) == 8
+    assert all(len(row) == 7 for row in sampler.neighbours)
+    assert math.isfinite(loss)
+    assert profile["steps"] == 2
+    assert model.training
+
+
+def test_training_telemetry_logs_steps_and_traces(tmp_path, capsys, processor, model):
+    loader = cached_loader(tmp_path, processor, count=6)
+    loader = DataLoader(loader.dataset, batch_size=2, collate_fn=trim_padding)
+    params = configure_training_mode(model, "full")
+    log_path = str(tmp_path / "telemetry" / "steps.jsonl")
+    telemetry = TrainingTelemetry(log_path, log_every=3, trace_dir=str(tmp_path / "trace"), trace_wait=0,
+                                  trace_steps=1)
+
+    _, profile = train_epoch(model, loader, torch.optim.AdamW(params, lr=1e-3), "cpu", telemetry=telemetry)
+    telemetry.close()
+
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record["step"] for record in records] == [1, 2, 3]
+    assert all(record["samples"] == 2 and record["samples_per_sec"] > 0 and record["peak_rss_mb"] > 0
+               for record in records)
+    assert records[0]["step_ms"] == pytest.approx(sum(records[0][f"{phase}_ms"] for phase in StepProfile.PHASES))
+    assert profile["samples"] == 6
+    assert "Step 3:" in capsys.readouterr().out
+    assert any(name.endswith(".json") for name in os.listdir(tmp_path / "trace"))
+
+
+def test_resumed_telemetry_keeps_the_log_up_to_the_checkpoint(tmp_path):
+    log_path = str(tmp_path / "steps.jsonl")
+    with open(log_path, "w") as f:
+        f.write("".join(json.dumps({"step": step}) + "\n" for step in (1, 2, 3)) + '{"step": 4')
+
+    TrainingTelemetry(log_path, log_every=0, start_step=2).log_step({"samples": 2})
+    with open(log_path) as f:
+        assert [json.loads(line)["step"] for line in f] == [1, 2, 3]
+
+    TrainingTelemetry(log_path, log_every=0)
+    assert os.path.getsize(log_path) == 0
+
+
+def make_model_dir(tmp_path):
+    model_dir = tmp_path / "model"
+    (model_dir / "nested").mkdir(parents=True)
+    (model_dir / "config.json").write_text('{"a": 1}')
+    (model_dir / "model.safetensors").write_bytes(b"w" * 100)
+    (model_dir / "nested" / "tokenizer.json").write_text("{}")
+    return str(model_dir)
+
+
+def test_upload_to_a_directory_skips_unchanged_files(tmp_path):
+    model_dir = make_model_dir(tmp_path)
+    target = str(tmp_path / "exported")
+
+    assert upload_to_gcs(model_dir, target) == 3
+    assert (tmp_path / "exported" / "nested" / "tokenizer.json").read_text() == "{}"
+    assert upload_to_gcs(model_dir, target) == 0
+    (tmp_path / "model" / "config.json").write_text('{"a": 2}')
+    assert upload_to_gcs(model_dir, target) == 1
+    assert (tmp_path / "exported" / "config.json").read_text() == '{"a": 2}'
+
+
+def test_upload_to_gcs_skips_matching_blobs_and_chunks_large_files(tmp_path):
+    model_dir = make_model_dir(tmp_path)
+    config_path = os.path.join(model_dir, "config.json")
+    remote = [SimpleNamespace(name="models/run/config.json", size=os.path.getsize(config_path),
+                              crc32c=file_crc32c(config_path)),
+              SimpleNamespace(name="models/run/nested/tokenizer.json", size=2, crc32c="stale")]
+    client = MagicMock()
+    client.list_blobs.return_value = remote
+    client.bucket.return_value.blob.side_effect = lambda name: SimpleNamespace(name=name)
+
+    with patch("trainer.task.storage.Client", return_value=client), \
+            patch("trainer.task.LARGE_FILE_SIZE", 50), \
+            patch("trainer.task.transfer_manager.upload_many", return_value=[None]) as upload_many, \
+            patch("trainer.task.transfer_manager.upload_chunks_concurrently") as upload_chunks:
+        uploaded = upload_to_gcs(model_dir, "gs://vertexai_train/models/run", "vertexai_train", workers=4)
+
+    assert uploaded == 2
+    client.list_blobs.assert_called_once_with("vertexai_train", prefix="models/run")
+    assert [blob.name for _, blob in upload_many.call_args.args[0]] == ["models/run/nested/tokenizer.json"]
+    assert upload_chunks.call_args.args[1].name == "models/run/model.safetensors"
+    assert upload_chunks.call_args.kwargs["max_workers"] == 4
+
+
+@pytest.mark.parametrize("flags", [
+    ["--checkpoint_dir", "checkpoints", "--checkpoint_every", "1"],
+    ["--tensor_cache_dir", "tensor_cache", "--training_mode", "frozen_vision", "--feature_cache_dir", "features"],
+    ["--shard_dir", "shards", "--categories", "men_shoes", "women_shoes", "--samples_per_shard", "4",
+     "--training_mode", "lora"],
+    ["--hard_negative_refresh", "1", "--cluster_size", "2", "--grad_cache_chunk", "2", "--bf16"],
+])
+def test_train_runs_end_to_end(tmp_path, monkeypatch, flags):
+    data_root = make_data_root(tmp_path, ["men_shoes", "women_shoes"], 8)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["task.py", "--category", "men_shoes", "--data_root", data_root,
+                                      "--output_dir", "exported", "--batch_size", "4", "--num_workers", "0",
+                                      "--total_test_cases", "4", "--gallery_size", "0", *flags])
+
+    # A tiny model at CLIP's 224 pixel input size stands in for the pretrained one
+    with patch("trainer.task.CLIPProcessor.from_pretrained", return_value=make_processor(tmp_path, 224)), \
+            patch("trainer.task.CLIPModel.from_pretrained", return_value=make_model(224, 32)):
+        task.main()
+
+    exported = set(os.listdir(tmp_path / "exported"))
+    assert {"config.json", "model.safetensors", "test_results.json"} <= exported
+    # Run reports and logs are kept out of the uploaded model
+    assert not {"training_report.json", "step_telemetry.jsonl"} & exported
+    assert os.path.exists(tmp_path / "local_run_logs" / "training_report.json")
+    assert os.path.exists(tmp_path / "local_run_logs" / "step_telemetry.jsonl")
+    with open(tmp_path / "exported" / "test_results.json") as f:
+        assert 0.0 <= json.load(f)["accuracy"] <= 1.0
+
+
+def test_resumed_train_continues_the_step_count(tmp_path, monkeypatch):
+    data_root = make_data_root(tmp_path, ["men_shoes"], 8)
+    monkeypatch.chdir(tmp_path)
+    argv = ["task.py", "--category", "men_shoes", "--data_root", data_root, "--output_dir", "exported",
+            "--batch_size", "4", "--num_workers", "0", "--gallery_size", "0", "--checkpoint_dir", "checkpoints"]
+
+    for epochs in ("1", "2"):
+        monkeypatch.setattr(sys, "argv", [*argv, "--epochs", epochs, "--resume_from", "latest"])
+        with patch("trainer.task.CLIPProcessor.from_pretrained", return_value=make_processor(tmp_path, 224)), \
+                patch("trainer.task.CLIPModel.from_pretrained", return_value=make_model(224, 32)):
+            task.main()
+
+    with open(tmp_path / "local_run_logs" / "step_telemetry.jsonl") as f:
+        assert [json.loads(line)["step"] for line in f] == [1, 2, 3, 4]
@@ -0,0 +1,98 @@
+"""
+Parameter-efficient training modes for FashionCLIP.
+
+    full           every parameter is trained (the original behaviour)
+    frozen_vision  the vision tower is frozen; text tower, projections and
+                   logit scale are trained
+    projection     only the two projection heads and the logit scale
+    lora           low-rank adapters on the attention projections of both
+                   towers; everything else is frozen
+
+LoRA adapters are merged back into plain nn.Linear weights before saving,
+so exported checkpoints load as an ordinary CLIPModel for serving.
+"""
+
+import math
+import torch
+from torch import nn
+
+TRAINING_MODES = ("full", "frozen_vision", "projection", "lora")
+LORA_TARGETS = ("q_proj", "k_proj", "v_proj", "out_proj")
+
+
+class LoRALinear(nn.Module):
+    """A frozen nn.Linear plus a trainable low-rank update B @ A scaled by alpha / rank."""
+
+    def __init__(self, base, rank=8, alpha=16, dropout=0.0):
+        super().__init__()
+        self.base = base
+        for param in self.base.parameters():
+            param.requires_grad_(False)
+        self.lora_a = nn.Parameter(torch.empty(rank, base.in_features))
+        self.lora_b = nn.Parameter(torch.zeros(base.out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_a, a=math.sqrt(5))
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout) if dropout else nn.Identity()
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_a.T @ self.lora_b.T) * self.scaling
+
+    def merged(self):
+        """A plain nn.Linear with the adapter folded into its weight."""
+        linear = nn.Linear(self.base.in_features, self.base.out_features, bias=self.base.bias is not None,
+                           device=self.base.weight.device, dtype=self.base.weight.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(self.base.weight + self.scaling * (self.lora_b @ self.lora_a))
+            if self.base.bias is not None:
+                linear.bias.copy_(self.base.bias)
+        return linear
+
+
+def add_lora(model, rank=8, alpha=16, dropout=0.0, targets=LORA_TARGETS):
+    """Wraps every nn.Linear named in targets with a LoRALinear. Returns how many were wrapped."""
+    wrapped = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if name in targets and isinstance(child, nn.Linear):
+                setattr(module, name, LoRALinear(child, rank, alpha, dropout))
+                wrapped += 1
+    return wrapped
+
+
+def merge_lora(model):
+    """Replaces every LoRALinear with its merged nn.Linear. Returns how many were merged."""
+    merged = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merged())
+                merged += 1
+    return merged
+
+
+def configure_training_mode(model, mode, lora_rank=8, lora_alpha=16, lora_dropout=0.0):
+    """Freezes and adapts model for mode in place. Returns the parameters to optimize."""
+    if mode not in TRAINING_MODES:
+        raise ValueError(f"Unknown training mode {mode!r}, expected one of {TRAINING_MODES}")
+
+    if mode == "full":
+        model.requires_grad_(True)
+    elif mode == "frozen_vision":
+        model.requires_grad_(True)
+        model.vision_model.requires_grad_(False)
+    elif mode == "projection":
+        model.requires_grad_(False)
+        model.visual_projection.requires_grad_(True)
+        model.text_projection.requires_grad_(True)
+        model.logit_scale.requires_grad_(True)
+    elif mode == "lora":
+        model.requires_grad_(False)
+        add_lora(model, lora_rank, lora_alpha, lora_dropout)
+    return [param for param in model.parameters() if param.requires_grad]
+
+
+def count_parameters(model):
+    """(trainable, total) parameter counts."""
+    trainable = sum(param.numel() for param in model.parameters() if param.requires_grad)
+    total = sum(param.numel() for param in model.parameters())
+    return trainable, total
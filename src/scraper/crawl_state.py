@@ -0,0 +1,228 @@
+import sqlite3
+import time
+from dedup import NUM_BANDS, hamming_distance, hash_bands
+
+# Download statuses recorded per item
+STATUS_PENDING = 'pending'
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_FAILED = 'failed'
+
+
+class CrawlState:
+    """
+    Local SQLite store that remembers every scraped item between crawls.
+
+    One row per item id holds the image URL, the download status, the
+    content hash of the last successful download and when the item was last
+    seen, so repeat crawls only queue new or changed items.
+
+    A second table maps every distinct content hash to the first item that
+    produced it, so copies of the same photo under other ids are recorded
+    as duplicates instead of being stored and processed again.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT PRIMARY KEY,
+                image_url TEXT,
+                status TEXT NOT NULL,
+                content_hash TEXT,
+                error TEXT,
+                duplicate_of TEXT,
+                last_seen REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_items_status ON items (status)')
+        band_columns = ', '.join(f'band{i} TEXT' for i in range(NUM_BANDS))
+        self.conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS contents (
+                content_hash TEXT PRIMARY KEY,
+                item_id TEXT NOT NULL,
+                perceptual_hash TEXT,
+                {band_columns}
+            )
+            """
+        )
+        for i in range(NUM_BANDS):
+            self.conn.execute(
+                f'CREATE INDEX IF NOT EXISTS idx_contents_band{i} ON contents (band{i})')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def get(self, item_id):
+        """Returns the stored row for an item as a dict, or None."""
+        row = self.conn.execute(
+            'SELECT item_id, image_url, status, content_hash, error, duplicate_of, last_seen '
+            'FROM items WHERE item_id = ?', (str(item_id),)).fetchone()
+        if row is None:
+            return None
+        keys = ['item_id', 'image_url', 'status',
+                'content_hash', 'error', 'duplicate_of', 'last_seen']
+        return dict(zip(keys, row))
+
+    def downloads(self):
+        """
+        Returns {item_id: duplicate_of} for every downloaded item and the set
+        of every known item id, in one query instead of a lookup per item.
+        """
+        rows = self.conn.execute('SELECT item_id, status, duplicate_of FROM items').fetchall()
+        downloaded = {item_id: duplicate_of for item_id, status, duplicate_of in rows
+                      if status == STATUS_DOWNLOADED}
+        return downloaded, {item_id for item_id, _, _ in rows}
+
+    def is_downloaded(self, item_id, image_url=None):
+        """
+        Single indexed lookup replacing the per-image filesystem check.
+        When image_url is given, a changed URL counts as not downloaded.
+        """
+        row = self.conn.execute(
+            'SELECT image_url, status FROM items WHERE item_id = ?',
+            (str(item_id),)).fetchone()
+        if row is None or row[1] != STATUS_DOWNLOADED:
+            return False
+        return image_url is None or row[0] == image_url
+
+    def observe(self, items, seen_at=None):
+        """
+        Records a crawl's (item_id, image_url) pairs and returns the ids that
+        are new, whose image URL changed, or that were never downloaded.
+        """
+        seen_at = seen_at if seen_at is not None else time.time()
+        pending = []
+        known = {item_id: (image_url, status) for item_id, image_url, status in
+                 self.conn.execute('SELECT item_id, image_url, status FROM items')}
+        for item_id, image_url in items:
+            item_id = str(item_id)
+            row = known.get(item_id)
+            if row is None:
+                self.conn.execute(
+                    'INSERT INTO items (item_id, image_url, status, last_seen) '
+                    'VALUES (?, ?, ?, ?)',
+                    (item_id, image_url, STATUS_PENDING, seen_at))
+                pending.append(item_id)
+            elif row[0] != image_url:
+                # The listing now points to another image: download it again
+                self.conn.execute(
+                    'UPDATE items SET image_url = ?, status = ?, '
+                    'content_hash = NULL, error = NULL, duplicate_of = NULL, last_seen = ? '
+                    'WHERE item_id = ?',
+                    (image_url, STATUS_PENDING, seen_at, item_id))
+                pending.append(item_id)
+            else:
+                self.conn.execute(
+                    'UPDATE items SET last_seen = ? WHERE item_id = ?',
+                    (seen_at, item_id))
+                if row[1] != STATUS_DOWNLOADED:
+                    pending.append(item_id)
+        self.conn.commit()
+        return pending
+
+    def mark_downloaded(self, item_id, image_url, content_hash=None, duplicate_of=None):
+        self.conn.execute(
+            """
+            INSERT INTO items (item_id, image_url, status, content_hash, error, duplicate_of, last_seen)
+            VALUES (?, ?, ?, ?, NULL, ?, ?)
+            ON CONFLICT(item_id) DO UPDATE SET
+                image_url = excluded.image_url,
+                status = excluded.status,
+                content_hash = excluded.content_hash,
+                error = NULL,
+                duplicate_of = excluded.duplicate_of,
+                last_seen = excluded.last_seen
+            """,
+            (str(item_id), image_url, STATUS_DOWNLOADED, content_hash,
+             None if duplicate_of is None else str(duplicate_of), time.time()))
+
+    def mark_failed(self, item_id, image_url, error):
+        self.conn.execute(
+            """
+            INSERT INTO items (item_id, image_url, status, error, last_seen)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(item_id) DO UPDATE SET
+                image_url = excluded.image_url,
+                status = excluded.status,
+                error = excluded.error,
+                last_seen = excluded.last_seen
+            """,
+            (str(item_id), image_url, STATUS_FAILED, error, time.time()))
+
+    def register_content(self, item_id, content_hash, perceptual_hash=None, max_distance=None):
+        """
+        Maps a downloaded item to its content. Returns the id of the item that
+        already holds identical content (or, when max_distance is set, content
+        within that perceptual hash distance), or None if the content is new
+        and item_id becomes its canonical owner.
+        """
+        item_id = str(item_id)
+        row = self.conn.execute(
+            'SELECT item_id FROM contents WHERE content_hash = ?',
+            (content_hash,)).fetchone()
+        if row is not None:
+            return None if row[0] == item_id else row[0]
+
+        if perceptual_hash is not None and max_distance is not None:
+            match = self.find_near_duplicate(perceptual_hash, max_distance)
+            if match is not None and match != item_id:
+                return match
+
+        bands = hash_bands(perceptual_hash) if perceptual_hash else [None] * NUM_BANDS
+        placeholders = ', '.join('?' * (NUM_BANDS + 3))
+        band_names = ', '.join(f'band{i}' for i in range(NUM_BANDS))
+        self.conn.execute(
+            f'INSERT INTO contents (content_hash, item_id, perceptual_hash, {band_names}) '
+            f'VALUES ({placeholders})',
+            [content_hash, item_id, perceptual_hash] + bands)
+        return None
+
+    def find_near_duplicate(self, perceptual_hash, max_distance):
+        """
+        Returns the item id of the closest stored perceptual hash within
+        max_distance bits. Candidates come from the band indexes, which is
+        exhaustive for distances below NUM_BANDS.
+        """
+        bands = hash_bands(perceptual_hash)
+        where = ' OR '.join(f'band{i} = ?' for i in range(NUM_BANDS))
+        candidates = self.conn.execute(
+            f'SELECT item_id, perceptual_hash FROM contents WHERE {where}',
+            bands).fetchall()
+        best_id, best_distance = None, max_distance + 1
+        for candidate_id, candidate_hash in candidates:
+            distance = hamming_distance(perceptual_hash, candidate_hash)
+            if distance < best_distance:
+                best_id, best_distance = candidate_id, distance
+        return best_id
+
+    def duplicates(self):
+        """Returns every item recorded as a copy of another item."""
+        rows = self.conn.execute(
+            'SELECT item_id, duplicate_of, content_hash FROM items '
+            'WHERE duplicate_of IS NOT NULL ORDER BY item_id').fetchall()
+        return [{'id': item_id, 'duplicate_of': duplicate_of, 'content_hash': content_hash}
+                for item_id, duplicate_of, content_hash in rows]
+
+    def counts(self):
+        """Returns the number of items per download status."""
+        rows = self.conn.execute(
+            'SELECT status, COUNT(*) FROM items GROUP BY status').fetchall()
+        return dict(rows)
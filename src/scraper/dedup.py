@@ -0,0 +1,44 @@
+import hashlib
+from io import BytesIO
+
+# Size of the difference hash grid, giving HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+# Number of equal bands the perceptual hash is split into for lookups.
+# Two hashes within distance < NUM_BANDS share at least one band exactly.
+NUM_BANDS = 8
+
+
+def content_hash(content):
+    """Returns the SHA-256 hex digest of the downloaded image bytes."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(content):
+    """
+    Computes a 64-bit difference hash (dHash) of an image as a hex string.
+    Resized or re-encoded copies of the same photo land within a few bits.
+    """
+    # Pillow is only needed when near-duplicate detection is enabled
+    from PIL import Image
+
+    with Image.open(BytesIO(content)) as image:
+        pixels = image.convert('L').resize(
+            (HASH_SIZE + 1, HASH_SIZE)).tobytes()
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def hash_bands(phash):
+    """Splits a perceptual hash into NUM_BANDS hex bands for indexed lookup."""
+    width = len(phash) // NUM_BANDS
+    return [phash[i * width:(i + 1) * width] for i in range(NUM_BANDS)]
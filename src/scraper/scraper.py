@@ -2,15 +2,17 @@
 from apify_client import ApifyClient
 import pandas as pd
 from io import StringIO
-import requests
 from dotenv import load_dotenv
 import os
 import sys
 import aiohttp
 import asyncio
+from functools import lru_cache
 from google.cloud import secretmanager
 from apify import Actor
 from aiohttp import ClientTimeout
+from crawl_state import CrawlState
+from dedup import content_hash, perceptual_hash
 
 # Load the .env file
 load_dotenv()
@@ -28,21 +30,47 @@ bad_urls_men_file_name = os.getenv('BAD_URLS_MEN')
 bad_urls_women_file_name = os.getenv('BAD_URLS_WOMEN')
 
 scrape_data = os.getenv('SCRAP_IMAGES')
+crawl_state_file_name = os.getenv('CRAWL_STATE_DB', 'crawl_state.sqlite')
+duplicates_men_file_name = os.getenv('DUPLICATES_MEN', 'duplicates_men.csv')
+# Maximum perceptual hash distance for near-duplicates, unset to only drop exact copies
+near_duplicate_distance = os.getenv('NEAR_DUPLICATE_DISTANCE') or None
+if near_duplicate_distance is not None:
+    near_duplicate_distance = int(near_duplicate_distance)
+
+
+# The Apify token and client are created on first use, so importing this
+# module (tests, short-lived pipeline containers) makes no network calls
+@lru_cache(maxsize=None)
+def get_apify_token():
+    # An explicitly provided token skips the Secret Manager round trip
+    if os.getenv('APIFY_TOKEN'):
+        return os.environ['APIFY_TOKEN']
+    secret_client = secretmanager.SecretManagerServiceClient()
+    response = secret_client.access_secret_version(
+        request={"name": os.getenv('APIFY_GCP_SECRET_ACCESS')}
+        )
+    secret_value = response.payload.data.decode("UTF-8")
+    # The Apify SDK (Actor, proxy configuration) reads the token from the environment
+    os.environ['APIFY_TOKEN'] = secret_value
+    return secret_value
 
-# Initialize the ApifyClient with your API token
-client = secretmanager.SecretManagerServiceClient()
-response = client.access_secret_version(
-    request={"name": os.getenv('APIFY_GCP_SECRET_ACCESS')}
-    )
-secret_value = "apify_api_fmyOzdUdJa6NnRysW2LKPGccavak5R3YiHro"
-client = ApifyClient(secret_value)
 
-os.environ['APIFY_TOKEN'] = secret_value
+@lru_cache(maxsize=None)
+def get_apify_client():
+    # Initialize the ApifyClient with your API token
+    return ApifyClient(get_apify_token())
+
 
 num_items_to_download = int(os.getenv('MAX_ITEMS'))
 
+apify_api_url = os.getenv('APIFY_API_URL', 'https://api.apify.com/v2')
+dataset_page_size = int(os.getenv('DATASET_PAGE_SIZE', '1000'))
+max_pending_downloads = int(os.getenv('MAX_PENDING_DOWNLOADS', '500'))
+# When set, items are streamed from this Apify dataset instead of the metadata CSV
+apify_dataset_id = os.getenv('APIFY_DATASET_ID')
 
-def get_items_seed(url):
+
+def run_actor(url):
     # Prepare the Actor input for each page
     run_input = {
         "startUrls": [{"url": url}],
@@ -56,34 +84,70 @@ def get_items_seed(url):
     }
 
     # Run the Actor and wait for it to finish
-    run = client.actor("mKTnbkisJ8BAiIbsP").call(run_input=run_input)
+    run = get_apify_client().actor("mKTnbkisJ8BAiIbsP").call(run_input=run_input)
+
+    return run["defaultDatasetId"]
+
+
+# Asynchronously yield the dataset items one CSV page (offset/limit) at a time
+async def fetch_dataset_pages(session, dataset_id, page_size=None, api_url=None):
+    page_size = page_size or dataset_page_size
+    api_url = api_url or apify_api_url
+    offset = 0
+    while True:
+        params = {'format': 'csv', 'offset': offset, 'limit': page_size}
+        async with session.get(f"{api_url}/datasets/{dataset_id}/items", params=params,
+                               timeout=ClientTimeout(total=600)) as response:
+            response.raise_for_status()
+            content = await response.read()
+
+        # The 'utf-8-sig' will handle the BOM
+        decoded_data = content.decode('utf-8-sig')
+        if not decoded_data.strip():
+            break
+        page = pd.read_csv(StringIO(decoded_data))
+        if page.empty:
+            break
+        yield page
+
+        # A short page is the last one
+        if len(page) < page_size:
+            break
+        offset += page_size
+
+
+async def collect_dataset(dataset_id, page_size=None, api_url=None):
+    async with aiohttp.ClientSession() as session:
+        pages = [page async for page in fetch_dataset_pages(
+            session, dataset_id, page_size, api_url)]
+    return pd.concat(pages, ignore_index=True) if pages else pd.DataFrame()
+
 
-    dataset_id = run["defaultDatasetId"]
+def get_items_seed(url):
+    dataset_id = run_actor(url)
+    return asyncio.run(collect_dataset(dataset_id))
 
-    # Fetch and print Actor results from the run's dataset (if there are any)
-    # for item in client.dataset(run["defaultDatasetId"]).iterate_items():
-    #     print(item)
-    # Fetch Actor results from the run's dataset
-    # all_items.append(item)
-    # API URL to get the dataset in CSV format
-    api_url = f"https://api.apify.com/v2/datasets/{dataset_id}/items?format=csv"
+# Path an item's image is saved under
+def image_path(output_folder, item_id):
+    return os.path.join(output_folder, f"image_{item_id}.jpg")
 
-    # Fetch the CSV file
-    response = requests.get(api_url)
 
-    # Decode the byte string to UTF-8 and remove BOM
-    # The 'utf-8-sig' will handle the BOM
-    decoded_data = response.content.decode('utf-8-sig')
+# Function to record an image that is already on disk in the crawl state
+# without downloading it again
+def adopt_existing_image(state, id, url, image_name):
+    with open(image_name, 'rb') as f:
+        content = f.read()
+    digest = content_hash(content)
+    phash = perceptual_hash(content) if near_duplicate_distance is not None else None
+    duplicate_of = state.register_content(id, digest, phash, near_duplicate_distance)
+    state.mark_downloaded(id, url, content_hash=digest, duplicate_of=duplicate_of)
 
-    # Use StringIO to treat the decoded string as a file-like object
-    csv_data = StringIO(decoded_data)
-    df = pd.read_csv(csv_data)
-    return df
 
 # Function to asynchronously download a single image using Apify proxy
-async def download_image(session, url, image_name, bad_urls, id, proxy_url):
-    # Check if the image already exists locally to skip downloading
-    if os.path.exists(image_name):
+async def download_image(session, url, image_name, bad_urls, id, proxy_url, state=None):
+    # Check if the image was already downloaded to skip it. With a crawl
+    # state, schedule_downloads only queues items that still need it
+    if state is None and os.path.exists(image_name):
         print(f"{image_name} already exists, skipping download.")
         return
 
@@ -91,74 +155,181 @@ async def download_image(session, url, image_name, bad_urls, id, proxy_url):
         # Fetch the image using Apify's proxy service
         async with session.get(url, proxy=proxy_url, timeout=ClientTimeout(total=600)) as response:
             if response.status == 200:
-                # Save the image
-                with open(image_name, 'wb') as f:
-                    f.write(await response.read())
-                print(f"Photo successfully downloaded as {image_name}")
+                content = await response.read()
+                digest = content_hash(content)
+                duplicate_of = None
+                if state is not None:
+                    # Copies of an image already stored under another id are
+                    # only recorded, so later stages never process them twice
+                    phash = perceptual_hash(content) if near_duplicate_distance is not None else None
+                    duplicate_of = state.register_content(
+                        id, digest, phash, near_duplicate_distance)
+
+                if duplicate_of is None:
+                    # Save the image
+                    with open(image_name, 'wb') as f:
+                        f.write(content)
+                    print(f"Photo successfully downloaded as {image_name}")
+                else:
+                    print(f"{image_name} duplicates item {duplicate_of}, not saved")
+                if state is not None:
+                    state.mark_downloaded(
+                        id, url, content_hash=digest, duplicate_of=duplicate_of)
             else:
                 # Log the failed download
                 print(
                     f"Failed to download {image_name}. Status code: {response.status}")
                 bad_urls.append(
                     {'url': url, 'id': id, 'error': f'Failed with status code {response.status}'})
+                if state is not None:
+                    state.mark_failed(
+                        id, url, f'Failed with status code {response.status}')
     except Exception as e:
         # Log any exceptions
         print(f"Error downloading {url}: {e}")
         bad_urls.append({'url': url, 'id': id, 'error': str(e)})
+        if state is not None:
+            state.mark_failed(id, url, str(e))
+
+# Function to create the download tasks for a DataFrame of items
+def schedule_downloads(session, urls_df, output_folder, bad_urls, proxy_url, state=None):
+    # With a crawl state, only new, changed or not yet downloaded items are queued
+    if state is not None:
+        seen = [(row.get(id_col_name), row.get(image_url_col))
+                for _, row in urls_df.iterrows() if row.get(image_url_col)]
+        # One query and one folder listing, checked by set membership per item
+        downloaded, known_ids = state.downloads()
+        on_disk = {entry.name for entry in os.scandir(output_folder) if entry.is_file()} \
+            if os.path.isdir(output_folder) else set()
+
+        def saved(item_id):
+            return os.path.basename(image_path(output_folder, item_id)) in on_disk
+
+        # Images already on disk that the state has never seen, e.g. a folder
+        # crawled before the state existed, are recorded instead of downloaded
+        unknown_on_disk = [(item_id, url) for item_id, url in seen
+                           if str(item_id) not in known_ids and saved(item_id)]
+        pending_ids = set(state.observe(seen))
+        for item_id, url in unknown_on_disk:
+            adopt_existing_image(state, item_id, url, image_path(output_folder, item_id))
+            pending_ids.discard(str(item_id))
+        # Downloaded images that were deleted locally are fetched again;
+        # duplicates are recorded without a file of their own
+        for item_id, url in seen:
+            item_id = str(item_id)
+            if item_id not in pending_ids and item_id in downloaded \
+                    and downloaded[item_id] is None and not saved(item_id):
+                pending_ids.add(item_id)
+        print(f"{len(pending_ids)} of {len(seen)} items are new, changed or missing locally")
+
+    tasks = []
+    for i, row in urls_df.iterrows():
+        url = row.get(image_url_col)
+        if url and state is not None and str(row.get(id_col_name)) not in pending_ids:
+            continue
+        if url:
+            # Construct the image name based on the id column
+            image_name = image_path(output_folder, row.get(id_col_name))
+            # Schedule the download task, passing the proxy_url
+            tasks.append(download_image(
+                session, url, image_name, bad_urls, row.get(id_col_name), proxy_url, state))
+        else:
+            print(f"URL missing in row {i + 1}")
+            bad_urls.append({'url': 'Missing', 'id': row.get(
+                id_col_name), 'error': 'No URL provided'})
+    return tasks
+
+
+# Function to convert the collected failures to a DataFrame
+def bad_urls_frame(bad_urls):
+    if bad_urls:
+        bad_urls_df = pd.DataFrame(bad_urls)
+        print(f"Bad URLs collected: {len(bad_urls_df)}")
+        return bad_urls_df
+    else:
+        # Return an empty DataFrame if no errors
+        return pd.DataFrame(columns=['url', 'id', 'error'])
+
+
+async def new_proxy_url():
+    # Set up Apify proxy configuration to use residential proxies
+    proxy_configuration = await Actor.create_proxy_configuration(
+        groups=['RESIDENTIAL']  # Use Apify's residential proxies
+    )
+    return await proxy_configuration.new_url()  # Get the proxy URL
+
 
 # Function to download multiple images asynchronously and return a DataFrame of failed downloads
-async def download_images(urls_df, output_folder):
+async def download_images(urls_df, output_folder, state=None):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
     bad_urls = []  # List to store information about failed downloads
 
-    # Set up Apify proxy configuration to use residential proxies
+    get_apify_token()
     async with Actor:
-        proxy_configuration = await Actor.create_proxy_configuration(
-            groups=['RESIDENTIAL']  # Use Apify's residential proxies
-        )
-        proxy_url = await proxy_configuration.new_url()  # Get the proxy URL
-        proxies = {
-            'http': proxy_url,
-            'https': proxy_url,
-        }
+        proxy_url = await new_proxy_url()
 
         # Create an aiohttp session with a limited connection pool
         # Limit to 30 concurrent connections per host
         connector = aiohttp.TCPConnector(limit_per_host=30)
         async with aiohttp.ClientSession(connector=connector) as session:
-            tasks = []
-            for i, row in urls_df.iterrows():
-                url = row.get(image_url_col)
-                if url:
-                    # Construct the image name based on the id column
-                    image_name = os.path.join(
-                        output_folder, f"image_{row.get(id_col_name)}.jpg")
-                    # Schedule the download task, passing the proxy_url
-                    tasks.append(download_image(
-                        session, url, image_name, bad_urls, row.get(id_col_name), proxy_url))
-                else:
-                    print(f"URL missing in row {i + 1}")
-                    bad_urls.append({'url': 'Missing', 'id': row.get(
-                        id_col_name), 'error': 'No URL provided'})
+            tasks = schedule_downloads(
+                session, urls_df, output_folder, bad_urls, proxy_url, state)
 
             # Await the completion of all tasks
             await asyncio.gather(*tasks)
 
+    if state is not None:
+        state.commit()
+
     # Convert bad_urls list to a Pandas DataFrame and return it
-    if bad_urls:
-        bad_urls_df = pd.DataFrame(bad_urls)
-        print(f"Bad URLs collected: {len(bad_urls_df)}")
-        return bad_urls_df
-    else:
-        # Return an empty DataFrame if no errors
-        return pd.DataFrame(columns=['url', 'id', 'error'])
+    return bad_urls_frame(bad_urls)
+
+
+# Function to stream a dataset page by page and download its images while
+# later pages are still being fetched
+async def download_dataset_images(dataset_id, output_folder, state=None, page_size=None, api_url=None):
+    os.makedirs(output_folder, exist_ok=True)
+    bad_urls = []
+
+    get_apify_token()
+    async with Actor:
+        proxy_url = await new_proxy_url()
+
+        connector = aiohttp.TCPConnector(limit_per_host=30)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            pending = set()
+            async for page in fetch_dataset_pages(session, dataset_id, page_size, api_url):
+                for task in schedule_downloads(session, page, output_folder, bad_urls, proxy_url, state):
+                    pending.add(asyncio.ensure_future(task))
+
+                # Bound the in-flight downloads so memory does not grow with the crawl
+                while len(pending) > max_pending_downloads:
+                    _, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if pending:
+                await asyncio.wait(pending)
+
+    if state is not None:
+        state.commit()
+
+    return bad_urls_frame(bad_urls)
 
 if __name__ == '__main__':
     try:
-        df_men = pd.read_csv(os.path.join(meta_data_folder, men_file_name))
-        bad_image_metadata_men = asyncio.run(download_images(
-            df_men, os.path.join(images_folder, os.path.splitext(men_file_name)[0])))
+        men_images_folder = os.path.join(images_folder, os.path.splitext(men_file_name)[0])
+        with CrawlState(os.path.join(meta_data_folder, crawl_state_file_name)) as state:
+            if apify_dataset_id:
+                bad_image_metadata_men = asyncio.run(download_dataset_images(
+                    apify_dataset_id, men_images_folder, state))
+            else:
+                df_men = pd.read_csv(os.path.join(meta_data_folder, men_file_name))
+                bad_image_metadata_men = asyncio.run(download_images(
+                    df_men, men_images_folder, state))
+            print(f"Crawl state: {state.counts()}")
+            pd.DataFrame(state.duplicates(), columns=['id', 'duplicate_of', 'content_hash']).to_csv(
+                os.path.join(meta_data_folder, duplicates_men_file_name), index=False)
         print("Images saved for men")
         bad_image_metadata_men.to_csv(os.path.join(
             meta_data_folder, bad_urls_men_file_name), index=False)
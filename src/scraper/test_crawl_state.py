@@ -0,0 +1,78 @@
+import pytest
+from crawl_state import CrawlState, STATUS_DOWNLOADED, STATUS_FAILED, STATUS_PENDING
+
+
+@pytest.fixture
+def state(tmp_path):
+    """Creates a crawl state store in a temporary directory."""
+    with CrawlState(str(tmp_path / 'crawl_state.sqlite')) as store:
+        yield store
+
+
+def test_observe_returns_new_items(state):
+    pending = state.observe([(1, 'http://a/1.jpg'), (2, 'http://a/2.jpg')])
+    assert pending == ['1', '2']
+    assert state.get(1)['status'] == STATUS_PENDING
+
+
+def test_repeat_crawl_skips_downloaded_items(state):
+    state.observe([(1, 'http://a/1.jpg'), (2, 'http://a/2.jpg')])
+    state.mark_downloaded(1, 'http://a/1.jpg', content_hash='ff')
+
+    pending = state.observe([(1, 'http://a/1.jpg'), (2, 'http://a/2.jpg'), (3, 'http://a/3.jpg')])
+    assert pending == ['2', '3']
+    assert state.is_downloaded(1)
+    assert state.get(1)['content_hash'] == 'ff'
+
+
+def test_changed_url_is_downloaded_again(state):
+    state.mark_downloaded(1, 'http://a/1.jpg', content_hash='ff')
+    assert state.is_downloaded(1, 'http://a/1.jpg')
+    assert not state.is_downloaded(1, 'http://a/1_v2.jpg')
+
+    pending = state.observe([(1, 'http://a/1_v2.jpg')])
+    assert pending == ['1']
+    row = state.get(1)
+    assert row['image_url'] == 'http://a/1_v2.jpg'
+    assert row['content_hash'] is None
+
+
+def test_downloads_lists_every_downloaded_item_in_one_query(state):
+    state.observe([(1, 'http://a/1.jpg'), (2, 'http://a/2.jpg'), (3, 'http://a/3.jpg')])
+    state.mark_downloaded(1, 'http://a/1.jpg', content_hash='aa')
+    state.mark_downloaded(2, 'http://a/2.jpg', content_hash='aa', duplicate_of=1)
+
+    downloaded, known_ids = state.downloads()
+    assert downloaded == {'1': None, '2': '1'}
+    assert known_ids == {'1', '2', '3'}
+
+
+def test_failed_items_are_retried_and_state_persists(tmp_path):
+    db_path = str(tmp_path / 'crawl_state.sqlite')
+    with CrawlState(db_path) as state:
+        state.mark_failed(1, 'http://a/1.jpg', 'Failed with status code 404')
+        state.mark_downloaded(2, 'http://a/2.jpg')
+
+    with CrawlState(db_path) as state:
+        assert state.counts() == {STATUS_FAILED: 1, STATUS_DOWNLOADED: 1}
+        assert state.observe([(1, 'http://a/1.jpg'), (2, 'http://a/2.jpg')]) == ['1']
+
+
+def test_exact_duplicate_content_maps_to_first_item(state):
+    assert state.register_content(1, 'aa') is None
+    assert state.register_content(2, 'aa') == '1'
+    # Re-registering the canonical item is not a duplicate
+    assert state.register_content(1, 'aa') is None
+
+    state.mark_downloaded(2, 'http://a/2.jpg', content_hash='aa', duplicate_of='1')
+    assert state.duplicates() == [{'id': '2', 'duplicate_of': '1', 'content_hash': 'aa'}]
+
+
+def test_near_duplicate_lookup_by_perceptual_hash(state):
+    assert state.register_content(1, 'aa', 'ffffffffffffffff', max_distance=4) is None
+    # Two bits away from item 1
+    assert state.register_content(2, 'bb', 'fffffffffffffffc', max_distance=4) == '1'
+    # Unrelated image
+    assert state.register_content(3, 'cc', '0000000000000000', max_distance=4) is None
+    # Without a distance only exact copies count
+    assert state.register_content(4, 'dd', 'fffffffffffffffc') is None
@@ -0,0 +1,30 @@
+from io import BytesIO
+from PIL import Image
+from dedup import content_hash, perceptual_hash, hamming_distance, hash_bands
+
+
+def make_image(size, fmt='JPEG'):
+    """Creates a horizontal gradient image and returns its encoded bytes."""
+    image = Image.new('L', size)
+    image.putdata([int(255 * x / size[0]) for _ in range(size[1]) for x in range(size[0])])
+    buffer = BytesIO()
+    image.convert('RGB').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def test_content_hash_is_stable():
+    assert content_hash(b'abc') == content_hash(b'abc')
+    assert content_hash(b'abc') != content_hash(b'abd')
+
+
+def test_perceptual_hash_matches_resized_copy():
+    original = make_image((400, 300))
+    resized = make_image((200, 150), fmt='PNG')
+    assert content_hash(original) != content_hash(resized)
+    assert hamming_distance(perceptual_hash(original), perceptual_hash(resized)) <= 2
+
+
+def test_hash_bands_split_evenly():
+    bands = hash_bands('0123456789abcdef')
+    assert len(bands) == 8
+    assert ''.join(bands) == '0123456789abcdef'
@@ -1,9 +1,17 @@
 import os
+import sys
+import time
+import asyncio
+import subprocess
 import pandas as pd
 import pytest
 from pathlib import Path
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import scraper
 from scraper import download_images  # Replace with your actual module name
+from crawl_state import CrawlState
 import shutil
 
 # Set up test environment variables
@@ -12,6 +20,7 @@ os.environ['SCRAPED_RAW_IMAGES'] = './test_data/images'
 os.environ['MEN_FILE_NAME'] = 'men_test_metadata.csv'
 os.environ['COLUMN_ID_NAME'] = 'id'
 os.environ['URL_IMAGE'] = 'image_url'
+os.environ['APIFY_TOKEN'] = 'test-token'
 
 
 @pytest.fixture(scope="module")
@@ -53,3 +62,111 @@ async def test_download_images_with_invalid_urls(setup_environment):
                 bad_urls_df, pd.DataFrame), "Bad URLs output is not a DataFrame"
             assert len(
                 bad_urls_df) == 1, "Expected one bad URL but got a different count"
+
+
+@pytest.fixture
+async def apify_fixture_server():
+    """Serves a paginated dataset and its images in place of the Apify API."""
+    items = pd.DataFrame({
+        scraper.id_col_name: [1, 2, 3, 4, 5],
+        scraper.image_url_col: [f'/images/{i}.jpg' for i in range(1, 6)],
+    })
+    events = []
+
+    async def dataset_items(request):
+        offset = int(request.query['offset'])
+        limit = int(request.query['limit'])
+        if offset > 0:
+            # Later pages are slow, downloads of earlier pages should not wait for them
+            await asyncio.sleep(0.2)
+        events.append(('page', offset))
+        page = items.iloc[offset:offset + limit]
+        return web.Response(body=page.to_csv(index=False).encode('utf-8-sig'),
+                            content_type='text/csv')
+
+    async def image(request):
+        events.append(('image', request.match_info['name']))
+        return web.Response(body=b'\xFF\xD8\xFF' + request.match_info['name'].encode(),
+                            content_type='image/jpeg')
+
+    app = web.Application()
+    app.router.add_get('/v2/datasets/{dataset_id}/items', dataset_items)
+    app.router.add_get('/images/{name}', image)
+    server = TestServer(app)
+    await server.start_server()
+    base_url = str(server.make_url(''))
+    items[scraper.image_url_col] = base_url + items[scraper.image_url_col]
+    yield f'{base_url}/v2', events
+    await server.close()
+
+
+async def test_fetch_dataset_pages(apify_fixture_server):
+    api_url, events = apify_fixture_server
+    df = await scraper.collect_dataset('dataset-id', page_size=2, api_url=api_url)
+    assert len(df) == 5
+    assert [e for e in events if e[0] == 'page'] == [('page', 0), ('page', 2), ('page', 4)]
+
+
+async def test_download_dataset_images_overlaps_paging(apify_fixture_server, tmp_path):
+    api_url, events = apify_fixture_server
+    actor = MagicMock()
+    with patch('scraper.Actor', actor), \
+            patch('scraper.new_proxy_url', AsyncMock(return_value=None)):
+        bad_urls_df = await scraper.download_dataset_images(
+            'dataset-id', tmp_path, page_size=2, api_url=api_url)
+
+    assert bad_urls_df.empty
+    assert len(list(tmp_path.glob('image_*.jpg'))) == 5
+    # The first images were requested before the last page was served
+    assert events.index(('image', '1.jpg')) < events.index(('page', 4))
+
+
+# Upper bound for a cold import, the scraper runs as a short-lived pipeline container
+IMPORT_BUDGET_SECONDS = 10
+
+
+def test_import_is_offline_and_fast():
+    """Importing the module must not reach Secret Manager and should stay fast."""
+    env = dict(os.environ, GOOGLE_APPLICATION_CREDENTIALS='/nonexistent/secret.json')
+    env.pop('APIFY_TOKEN', None)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', 'import scraper'],
+                            cwd=Path(__file__).parent, env=env, capture_output=True)
+    elapsed = time.perf_counter() - start
+
+    assert result.returncode == 0, result.stderr.decode()
+    assert elapsed < IMPORT_BUDGET_SECONDS
+
+
+def test_apify_client_is_created_once():
+    with patch('scraper.ApifyClient') as mock_client:
+        scraper.get_apify_client.cache_clear()
+        try:
+            assert scraper.get_apify_client() is scraper.get_apify_client()
+            mock_client.assert_called_once_with('test-token')
+        finally:
+            scraper.get_apify_client.cache_clear()
+
+
+async def test_crawl_state_and_images_folder_must_agree(apify_fixture_server, tmp_path):
+    api_url, events = apify_fixture_server
+    images = tmp_path / 'images'
+    images.mkdir()
+    # Downloaded before the crawl state existed
+    (images / 'image_1.jpg').write_bytes(b'\xFF\xD8\xFFold')
+    actor = MagicMock()
+    with patch('scraper.Actor', actor), \
+            patch('scraper.new_proxy_url', AsyncMock(return_value=None)), \
+            CrawlState(str(tmp_path / 'crawl_state.sqlite')) as state:
+        await scraper.download_dataset_images('dataset-id', images, state, page_size=5, api_url=api_url)
+        assert ('image', '1.jpg') not in events
+        assert state.is_downloaded(1)
+        assert len(list(images.glob('image_*.jpg'))) == 5
+
+        # A file deleted locally is restored even though the state lists it as downloaded
+        (images / 'image_3.jpg').unlink()
+        events.clear()
+        await scraper.download_dataset_images('dataset-id', images, state, page_size=5, api_url=api_url)
+
+    assert [event for event in events if event[0] == 'image'] == [('image', '3.jpg')]
+    assert (images / 'image_3.jpg').exists()